@@ -2,6 +2,9 @@
 # -*- encoding: utf-8 -*-
 
 from db_api import Connection, MySQLdb
+import binlog_parser
+import contextlib
+import os
 import time
 import logging
 
@@ -16,12 +19,15 @@ class UserExistsError(Exception):
 class Map(dict):
     def __init__(self, **entries):
         super(Map, self).__init__(entries)
-    def __getattribute__(self, item):
+    def __getattr__(self, item):
         return self.get(item, None)
 
 class MySQLInstance(object):
     """common operation for mysql
     """
+    # set by binlog_scan()
+    _header_reader = None
+
     def __init__(self, host, database, user, password, charset="utf8", **kwargs):
         self.conn = Connection(host=host, db=database, user=user, passwd=password, charset=charset, **kwargs)
         self.user = user
@@ -96,7 +102,7 @@ class MySQLInstance(object):
         :param scope: GLOBAL/SESSION
         """
         sql = "SHOW {0} VARIABLES LIKE %s ".format(scope)
-        rs = self.conn.query(sql, var_name)
+        rs = self.conn.query(sql, None, var_name)
         return dict([(each_val["Variable_name"], each_val["Value"]) for each_val in rs if rs])
 
     def is_read_only(self, scope="GLOBAL"):
@@ -359,38 +365,56 @@ class MySQLInstance(object):
                 break
         return 0
 
-    def change_master_to(self, host, port, user, password, file_name=None, pos=None):
+    @property
+    def gtid_mode_on(self):
+        gtid = self.get_mysql_variables("gtid_mode")
+        return gtid.get("gtid_mode", "").upper() == "ON"
+
+    def change_master_to(self, host, port, user, password, file_name=None, pos=None,
+                         auto_position=None, master=None):
+        """
+        :param auto_position: use MASTER_AUTO_POSITION=1, default is on when gtid_mode is ON
+        :param master: MySQLInstance of the new master, used to read SHOW MASTER STATUS
+                       when neither gtid nor file/pos is given
+        """
+        if auto_position is None:
+            auto_position = self.gtid_mode_on
+        if not auto_position and not file_name and not pos:
+            if master is None:
+                master = self.__class__("%s:%s" % (host, port), self.database, self.user,
+                                        self.password, self.charset)
+            m_status = master.show_master_status()
+            file_name = m_status["File"]
+            pos = m_status["Position"]
+
         stop_slave = "STOP SLAVE"
         self.conn.execute(stop_slave)
-        change_sql = "CHANGE MASTER TO MASTER_HOST=%s, MASTER_PORT=%s, MASTER_USER=%s, " \
-                     "MASTER_PASSWORD=%s, MASTER_LOG_FILE=%s, MASTER_LOG_POS=%s"
-        # gtid_sql = "CHANGE MASTER TO MASTER_HOST=%s, MASTER_PORT=%s, MASTER_USER=%s, " \
-        #            "MASTER_PASSWORD=%s, MASTER_AUTO_POSITION=1"
         try:
-            # fixme: add support for gtid, query if the gtid mode is on
-            # gtid = self.get_mysql_variables('gtid_mode')
-            # if gtid and gtid["gtid_mode"] == "ON":
-            #     self.conn.execute(gtid_sql, host, int(port), user, password)
-            # else:
-            #     if not file_name and not pos:
-            #         target_conn = DBHandler("%s:%s" % (host, port), self.database, self.user,
-            #                                 self.password, self.charset)
-            #         m_status = target_conn.show_master_status()
-            #         file_name = m_status["File"]
-            #         pos = m_status["Position"]
-            #     self.conn.execute(change_sql, host, int(port), user, password, file_name, int(pos))
-            if not file_name and not pos:
-                target_conn = DBHandler("%s:%s" % (host, port), self.database, self.user,
-                                        self.password, self.charset)
-                m_status = target_conn.show_master_status()
-                file_name = m_status["File"]
-                pos = m_status["Position"]
-            self.conn.execute(change_sql, host, int(port), user, password, file_name, int(pos))
+            if auto_position:
+                gtid_sql = "CHANGE MASTER TO MASTER_HOST=%s, MASTER_PORT=%s, MASTER_USER=%s, " \
+                           "MASTER_PASSWORD=%s, MASTER_AUTO_POSITION=1"
+                self.conn.execute(gtid_sql, None, host, int(port), user, password)
+            else:
+                change_sql = "CHANGE MASTER TO MASTER_HOST=%s, MASTER_PORT=%s, MASTER_USER=%s, " \
+                             "MASTER_PASSWORD=%s, MASTER_LOG_FILE=%s, MASTER_LOG_POS=%s"
+                self.conn.execute(change_sql, None, host, int(port), user, password, file_name, int(pos))
             return 0
         finally:
             start_slave = "START SLAVE"
             self.conn.execute(start_slave)
 
+    def wait_slave_ok(self, timeout=30, interval=0.5):
+        """
+        :return: True if both replication threads are running within `timeout` seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.slave_ok():
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
     def stop_slave(self):
         sql = "STOP SLAVE"
         return self.conn.execute(sql)
@@ -470,31 +494,209 @@ class MySQLInstance(object):
 
     def get_binlog_events(self, log_file, start=0, count=1):
         sql = "SHOW BINLOG EVENTS IN %s LIMIT %s, %s"
-        return self.conn.query(sql, log_file, start, count)
+        return self.conn.query(sql, None, log_file, int(start), int(count))
+
+    def get_binlog_events_from(self, log_file, pos=4, count=1):
+        """
+        fetch events by position instead of offset, so the server can seek
+        straight to `pos` rather than skipping `start` events every time
+        """
+        sql = "SHOW BINLOG EVENTS IN %s FROM %s LIMIT %s"
+        return self.conn.query(sql, None, log_file, int(pos), int(count))
+
+    def iter_binlog_events(self, log_file=None, start_pos=4, stop_file=None, batch_size=1000):
+        """
+        lazily walk binlog events across files, batch by batch
+        :param log_file: first binlog file to scan, default is the oldest one
+        :param start_pos: position to start from in `log_file`
+        :param stop_file: last binlog file to scan (included), default is the newest one
+        :param batch_size: events fetched per SHOW BINLOG EVENTS round trip
+        :return: generator of event rows (Log_name, Pos, Event_type, Server_id,
+                 End_log_pos, Info)
+        """
+        log_files = [each["Log_name"] for each in self.get_binlog_list()]
+        if log_file is not None:
+            if log_file not in log_files:
+                raise ValueError("binlog %s not found" % log_file)
+            log_files = log_files[log_files.index(log_file):]
+        if stop_file is not None:
+            if stop_file not in log_files:
+                raise ValueError("binlog %s not found" % stop_file)
+            log_files = log_files[:log_files.index(stop_file) + 1]
+
+        for idx, each_file in enumerate(log_files):
+            pos = start_pos if idx == 0 else 4
+            while True:
+                events = self.get_binlog_events_from(each_file, pos, batch_size)
+                for event in events:
+                    yield event
+                if len(events) < batch_size:
+                    break
+                # End_log_pos of the last event is where the next one begins
+                pos = events[-1]["End_log_pos"]
+
+    def get_binlog_event_positions(self, log_file, batch_size=1000):
+        """
+        :return: [(Pos, End_log_pos), ...] of all events in `log_file`
+        """
+        return [(each["Pos"], each["End_log_pos"])
+                for each in self.iter_binlog_events(log_file, stop_file=log_file, batch_size=batch_size)]
 
     def get_binlog_content(self, log_file, start_pos=4, end_pos=120):
-        from .utils import execute_shell
+        import subprocess
         ip, port = self.host.split(':')
-        cmd = "mysqlbinlog --no-defaults -h%s -P%s -u%s -p%s --read-from-remote-server %s " \
-              "--start-position=%s --stop-position=%s" % (ip, port, self.user, self.password,
-                                                          log_file, start_pos, end_pos)
-        return execute_shell(cmd)
+        cmd = ["mysqlbinlog", "--no-defaults", "-h%s" % ip, "-P%s" % port, "-u%s" % self.user,
+               "--read-from-remote-server", log_file,
+               "--start-position=%s" % start_pos, "--stop-position=%s" % end_pos]
+        # keep the password out of the process list
+        env = dict(os.environ, MYSQL_PWD=self.password or "")
+        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        return sp.communicate()[0]
 
     @property
-    def binlog_start_time(self):
+    def binlog_dir(self):
+        """
+        :return: directory holding the binlogs if they are readable from this host, else None
+        """
+        if hasattr(self, "_binlog_dir"):
+            return self._binlog_dir
+        self._binlog_dir = None
+        if "/" not in self.host and self.host.split(":")[0] not in ("127.0.0.1", "localhost"):
+            return None
+        basename = self.get_mysql_variables("log_bin_basename").get("log_bin_basename")
+        if basename:
+            log_dir = os.path.dirname(basename)
+        else:
+            log_dir = self.get_mysql_variables("datadir").get("datadir")
+        if log_dir and os.access(log_dir, os.R_OK):
+            self._binlog_dir = log_dir
+        return self._binlog_dir
+
+    def get_binlog_event_header(self, log_file, pos=4):
+        """
+        read the header of the event at `pos` without spawning mysqlbinlog:
+        from the local file if the binlogs are readable here, otherwise
+        from a binlog dump over a dedicated connection, shared by the reads
+        of a binlog_scan() block
+        :return: binlog_parser.EventHeader or None
+        """
+        log_dir = self.binlog_dir
+        if log_dir and os.path.isfile(os.path.join(log_dir, log_file)):
+            return binlog_parser.read_event_header(os.path.join(log_dir, log_file), int(pos))
+
+        with self.binlog_scan() as reader:
+            return reader.read(log_file, int(pos))
+
+    @contextlib.contextmanager
+    def binlog_scan(self):
+        """
+        read the remote event headers of the block over one replication
+        connection, kept open between reads (see binlog_parser.RemoteHeaderReader),
+        instead of a new connection and binlog dump per header
+        :return: the binlog_parser.RemoteHeaderReader in use
+        """
+        if self._header_reader is not None:
+            yield self._header_reader
+            return
+        self._header_reader = binlog_parser.RemoteHeaderReader(lambda: MySQLdb.connect(**self.conn._db_args))
+        try:
+            yield self._header_reader
+        finally:
+            reader, self._header_reader = self._header_reader, None
+            reader.close()
+
+    def get_binlog_event_time(self, log_file, pos, end_pos):
+        """
+        :return: unix timestamp of the event at `pos` in `log_file`, None if not found
+        """
+        try:
+            header = self.get_binlog_event_header(log_file, pos)
+            return header.timestamp if header else None
+        except (NotImplementedError, binlog_parser.BinlogFormatError, MySQLdb.Error), e:
+            LOGGER.warning("read binlog event header failed, fall back to mysqlbinlog: %s" % e)
+
         import re
         re_cmp = re.compile('^#(\d+\s+\d+:\d+:\d+)')
-        binlog_list = self.get_binlog_list()
-        first_log_file = binlog_list[0].get('Log_name')
-        first_event = self.get_binlog_events(first_log_file)
-        log_content = self.get_binlog_content(first_log_file, first_event[0].get('Pos'),
-                                              first_event[0].get('End_log_pos'))
+        log_content = self.get_binlog_content(log_file, pos, end_pos)
         for line in log_content.split('\n'):
             re_mth = re_cmp.match(line)
             if re_mth:
-                return time.strftime('%Y-%m-%d %H:%M:%S', time.strptime(re_mth.group(1), '%y%m%d %H:%M:%S'))
+                return int(time.mktime(time.strptime(re_mth.group(1), '%y%m%d %H:%M:%S')))
         return None
 
+    @property
+    def binlog_start_time(self):
+        binlog_list = self.get_binlog_list()
+        first_log_file = binlog_list[0].get('Log_name')
+        # the format description event always sits at position 4
+        ts = self.get_binlog_event_time(first_log_file, 4, 120)
+        if ts is None:
+            return None
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+    def search_binlog_by_time(self, timestamp):
+        """
+        find the last event written at or before `timestamp`.
+        binlog files are bisected by the time of their first event. In the
+        matched file the event index is doubled until an event is later than
+        `timestamp`, then bisected; each probe fetches a single event with
+        SHOW BINLOG EVENTS ... LIMIT offset, 1, so only O(log(files) + log(events))
+        events are fetched and timestamps read, the server skips the events
+        before the offset itself. Remote timestamps share one binlog_scan().
+        :param timestamp: unix timestamp or '%Y-%m-%d %H:%M:%S' string
+        :return: (log_file, pos) or None if `timestamp` is earlier than all binlogs
+        """
+        if isinstance(timestamp, basestring):
+            timestamp = int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')))
+
+        with self.binlog_scan():
+            log_files = [each["Log_name"] for each in self.get_binlog_list()]
+            first_times = {}
+
+            def file_start_time(log_file):
+                if log_file not in first_times:
+                    event = self.get_binlog_events_from(log_file)[0]
+                    first_times[log_file] = self.get_binlog_event_time(log_file, event["Pos"], event["End_log_pos"])
+                return first_times[log_file]
+
+            lo, hi = 0, len(log_files)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if file_start_time(log_files[mid]) <= timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == 0:
+                return None
+            log_file = log_files[lo - 1]
+
+            # {index: event} of the probed events, None past the last event
+            events = {}
+
+            def at_or_before(index):
+                if index not in events:
+                    rs = self.get_binlog_events(log_file, index, 1)
+                    events[index] = rs[0] if rs else None
+                event = events[index]
+                if event is None:
+                    return False
+                ts = self.get_binlog_event_time(log_file, event["Pos"], event["End_log_pos"])
+                return ts is not None and ts <= timestamp
+
+            # the first event is at or before `timestamp`, find one after it
+            lo, hi = 0, 1
+            while at_or_before(hi):
+                lo, hi = hi, hi * 2
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if at_or_before(mid):
+                    lo = mid
+                else:
+                    hi = mid
+            if lo not in events:
+                events[lo] = self.get_binlog_events(log_file, lo, 1)[0]
+            return log_file, events[lo]["Pos"]
+
     @property
     def super_privileges(self):
         def verify_super(privs):
@@ -529,6 +731,97 @@ class MySQLInstance(object):
                 sql = "REVOKE {privs} ON {scope} FROM %s@%s".format(privs=p, scope=s)
                 self.conn.execute(sql, u, h)
 
+def repoint_replicas(replicas, master, user, password, timeout=60, max_workers=16, verify=True):
+    """
+    point a batch of replicas to a new master concurrently, e.g. during failover.
+    gtid mode is detected once on the master: MASTER_AUTO_POSITION=1 is used if it is ON,
+    otherwise every replica gets the same SHOW MASTER STATUS coordinates, so the master
+    should not take writes (read_only) while re-pointing.
+    :param replicas: list of MySQLInstance
+    :param master: MySQLInstance of the new master
+    :param user: replication user
+    :param password: replication password
+    :param timeout: seconds allowed per replica, including the slave_ok verification
+    :param max_workers: replicas re-pointed at the same time, at least 1
+    :param verify: wait until Slave_IO_Running/Slave_SQL_Running are Yes
+    :return: {replica.host: Map(ok=True/False, error=None/str)}
+    """
+    import threading
+    import Queue
+
+    if max_workers < 1:
+        raise ValueError("max_workers must be at least 1, got %r" % (max_workers, ))
+    host, port = master.host.split(":") if ":" in master.host else (master.host, 3306)
+    auto_position = master.gtid_mode_on
+    file_name = pos = None
+    if not auto_position:
+        m_status = master.show_master_status()
+        file_name = m_status["File"]
+        pos = m_status["Position"]
+
+    pending = Queue.Queue()
+    for replica in replicas:
+        pending.put(replica)
+    results = {}
+    # {replica.host: deadline} of the replicas taken by a worker
+    started = {}
+    done = threading.Condition()
+
+    def repoint(replica):
+        try:
+            replica.change_master_to(host, port, user, password, file_name, pos,
+                                     auto_position=auto_position, master=master)
+            if verify and not replica.wait_slave_ok(timeout):
+                return Map(ok=False, error="slave is not running after %ss" % timeout)
+            return Map(ok=True, error=None)
+        except Exception, e:
+            LOGGER.error("repoint %s to %s failed: %s" % (replica.host, master.host, e))
+            return Map(ok=False, error=str(e))
+
+    def work():
+        while True:
+            with done:
+                try:
+                    replica = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                started[replica.host] = time.time() + timeout
+            rs = repoint(replica)
+            with done:
+                results[replica.host] = rs
+                done.notify()
+
+    num_workers = min(max_workers, len(replicas))
+    for i in range(num_workers):
+        worker = threading.Thread(target=work)
+        worker.setDaemon(True)
+        worker.start()
+
+    # a hung replica keeps its worker, so in the worst case every worker
+    # spends `timeout` on each of its share of the replicas
+    deadline = time.time() + timeout * ((len(replicas) + max_workers - 1) // max_workers)
+    with done:
+        while len(results) < len(replicas):
+            now = time.time()
+            running = [each for each_host, each in started.items() if each_host not in results]
+            if now >= deadline:
+                break
+            # nothing will finish in time: the running replicas are past their
+            # deadline and either none is left or all the workers hang on them
+            if all(each <= now for each in running) and (pending.empty() or len(running) >= num_workers):
+                break
+            done.wait(min([deadline] + [each for each in running if each > now]) - now)
+        # workers still running may write into `results` later, hand back a snapshot
+        rs = dict(results)
+        for replica in replicas:
+            if replica.host in rs:
+                continue
+            if replica.host in started:
+                rs[replica.host] = Map(ok=False, error="timeout after %ss" % timeout)
+            else:
+                rs[replica.host] = Map(ok=False, error="not started, all workers hung")
+    return rs
+
 class LocalMySQLInstance(MySQLInstance):
     def __init__(self, port, user="root", password="", database="", charset="utf8", **kwargs):
         super(LocalMySQLInstance, self).__init__("%s:%s" % ("127.0.0.1", port) if str(port).isdigit() else port,
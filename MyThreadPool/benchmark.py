@@ -0,0 +1,204 @@
+# -*- coding: UTF-8 -*-
+"""Micro-benchmarks for threadpool.py.
+
+Usage::
+
+    python benchmark.py batch [num_tasks] [num_workers]
+    python benchmark.py stealing [num_tasks] [num_producers]
+    python benchmark.py dispatch [num_tasks] [num_producers]
+    python benchmark.py stats [num_tasks] [num_workers]
+
+``batch`` compares the throughput (tasks/s) of tiny tasks submitted one
+request per task against batches of 10, 100 and 1000 tasks per request
+(``makeRequests(..., chunksize=n)``).
+
+``stealing`` compares the single shared request queue with the work
+stealing dispatcher (``ThreadPool(..., work_stealing=True)``) at 8, 32 and
+128 workers, with several threads submitting tiny tasks. Besides the
+throughput it reports the mean time a worker spent in ``get()`` per request,
+which includes waiting for the queue lock.
+
+``dispatch`` times the request queues alone: several threads put requests
+into a ``PriorityRequestQueue`` or a ``WorkStealingQueue`` and 8, 32 and
+128 threads take them out, without running them or going through the rest
+of the pool.
+
+``stats`` prices ``collect_stats``: the time ``PoolStats`` takes to record
+a request, and the throughput of tiny tasks with and without it (best of 3
+runs, the pool figures are noisy on a busy or single-CPU machine).
+
+"""
+from __future__ import print_function
+
+import collections
+import sys
+import threading
+import time
+
+from threadpool import (PoolStats, PriorityRequestQueue, ThreadPool,
+    WorkRequest, WorkStealingQueue, makeRequests)
+
+
+def tiny_task(x):
+    return x + 1
+
+
+def bench_batch(num_tasks=100000, num_workers=8,
+        chunksizes=(1, 10, 100, 1000)):
+    print("%d tasks, %d workers" % (num_tasks, num_workers))
+    print("%10s %12s %12s" % ("chunksize", "seconds", "tasks/s"))
+    for chunksize in chunksizes:
+        pool = ThreadPool(num_workers)
+        done = []
+        start = time.time()
+        for req in makeRequests(tiny_task, range(num_tasks),
+                callback=lambda r, x: done.append(x), chunksize=chunksize):
+            pool.putRequest(req)
+        pool.wait()
+        elapsed = time.time() - start
+        assert len(done) == num_tasks
+        print("%10d %12.3f %12.0f" % (chunksize, elapsed,
+            num_tasks / elapsed))
+        pool.dismissWorkers(num_workers, do_join=True)
+
+
+def _timeGets(pool):
+    """Wrap the pool's request queue to sum the time spent in get()."""
+    queue = pool._requests_queue
+    get = queue.get
+    spent = collections.defaultdict(float)
+
+    def timed_get(*args, **kwds):
+        start = time.time()
+        try:
+            return get(*args, **kwds)
+        finally:
+            spent[threading.currentThread().ident] += time.time() - start
+    queue.get = timed_get
+    return spent
+
+
+def bench_stealing(num_tasks=200000, num_producers=4,
+        worker_counts=(8, 32, 128)):
+    print("%d tasks, %d producer threads" % (num_tasks, num_producers))
+    print("%8s %10s %12s %12s %16s" % ("workers", "dispatch", "seconds",
+        "tasks/s", "get() us/task"))
+    per_producer = num_tasks // num_producers
+    for num_workers in worker_counts:
+        for work_stealing in (False, True):
+            pool = ThreadPool(0, work_stealing=work_stealing)
+            spent = _timeGets(pool)
+            pool.createWorkers(num_workers)
+            futures = []
+
+            def produce():
+                submitted = [pool.submit(tiny_task, i)
+                    for i in range(per_producer)]
+                futures.extend(submitted)
+
+            start = time.time()
+            producers = [threading.Thread(target=produce)
+                for i in range(num_producers)]
+            for producer in producers:
+                producer.start()
+            for producer in producers:
+                producer.join()
+            for future in futures:
+                future.result()
+            elapsed = time.time() - start
+            total = per_producer * num_producers
+            print("%8d %10s %12.3f %12.0f %16.1f" % (num_workers,
+                work_stealing and "stealing" or "queue", elapsed,
+                total / elapsed, sum(spent.values()) / total * 1e6))
+            pool.dismissWorkers(num_workers, do_join=True)
+
+
+def _dispatch(queue, num_tasks, num_producers, num_workers):
+    """Seconds to pass num_tasks requests through ``queue``."""
+    taken = threading.Semaphore(0)
+    stop = object()
+
+    def consume():
+        while queue.get() is not stop:
+            taken.release()
+    workers = [threading.Thread(target=consume) for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    request = WorkRequest(tiny_task, [0])
+    per_producer = num_tasks // num_producers
+
+    def produce():
+        for i in range(per_producer):
+            queue.put(request)
+    start = time.time()
+    producers = [threading.Thread(target=produce)
+        for i in range(num_producers)]
+    for producer in producers:
+        producer.start()
+    for i in range(per_producer * num_producers):
+        taken.acquire()
+    elapsed = time.time() - start
+    for worker in workers:
+        queue.put(stop)
+    for thread in producers + workers:
+        thread.join()
+    return elapsed
+
+
+def bench_dispatch(num_tasks=200000, num_producers=4,
+        worker_counts=(8, 32, 128)):
+    print("%d tasks, %d producer threads" % (num_tasks, num_producers))
+    print("%8s %10s %12s %12s" % ("workers", "dispatch", "seconds",
+        "tasks/s"))
+    total = num_tasks // num_producers * num_producers
+    for num_workers in worker_counts:
+        for name, queue in (("queue", PriorityRequestQueue()),
+                ("stealing", WorkStealingQueue())):
+            elapsed = _dispatch(queue, num_tasks, num_producers, num_workers)
+            print("%8d %10s %12.3f %12.0f" % (num_workers, name, elapsed,
+                total / elapsed))
+
+
+def bench_stats(num_tasks=100000, num_workers=8, rounds=3):
+    stats = PoolStats()
+    request = WorkRequest(tiny_task, [1])
+    request.enqueued, request.started = 1.0, 1.1
+    request.finished, request.collected = 1.2, 1.3
+    start = time.time()
+    for i in range(num_tasks):
+        stats.recordFinished(request)
+        stats.recordCollected(request)
+    print("recording a request: %.2f us" %
+        ((time.time() - start) / num_tasks * 1e6))
+
+    print("%d tasks, %d workers" % (num_tasks, num_workers))
+    print("%14s %12s %12s" % ("collect_stats", "seconds", "tasks/s"))
+    for collect_stats in (False, True):
+        best = None
+        for i in range(rounds):
+            pool = ThreadPool(num_workers, collect_stats=collect_stats)
+            start = time.time()
+            for req in makeRequests(tiny_task, range(num_tasks),
+                    callback=lambda r, x: None):
+                pool.putRequest(req)
+            pool.wait()
+            elapsed = time.time() - start
+            best = min(best or elapsed, elapsed)
+            pool.dismissWorkers(num_workers, do_join=True)
+        print("%14s %12.3f %12.0f" % (collect_stats, best,
+            num_tasks / best))
+
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'stealing': bench_stealing,
+    'dispatch': bench_dispatch,
+    'stats': bench_stats,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
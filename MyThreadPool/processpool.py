@@ -0,0 +1,317 @@
+# -*- coding: UTF-8 -*-
+"""Process based counterpart of ``threadpool.ThreadPool``.
+
+``ProcessPool`` runs work requests in worker processes instead of threads,
+so CPU bound callables are not serialized by the GIL. It takes the same
+``WorkRequest``/``BatchWorkRequest`` objects (e.g. from ``makeRequests``)
+and offers the same ``putRequest``/``poll``/``wait`` interface, with the
+callbacks invoked in the polling process, so switching backends is a
+matter of changing the constructor::
+
+    >>> pool = ProcessPool(poolsize)        # was: ThreadPool(poolsize)
+    >>> requests = makeRequests(some_callable, list_of_args, callback)
+    >>> [pool.putRequest(req) for req in requests]
+    >>> pool.wait()
+
+Requests are not sent one by one: ``putRequest`` buffers them and every
+``batch_size`` requests the buffer is pickled in chunks and sent to the
+workers, which send their results back per chunk as well. A worker runs a
+whole chunk, so a flush makes at least one chunk per worker. Buffered
+requests are also flushed by ``flush``, ``poll`` and ``wait``.
+
+Differences to ``ThreadPool``:
+
+* The callable and its arguments, results and exceptions must be picklable;
+  a module level function works, a lambda doesn't. Requests which can't be
+  pickled fail right away with the pickling error.
+* The exception info handed to ``exc_callback`` has no traceback object,
+  the formatted traceback of the worker process is stored in the
+  ``remoteTraceback`` attribute of the request instead.
+* ``priority`` is ignored, requests are processed in submission order.
+  Expired requests fail with ``RequestExpired`` as usual.
+* Requests can only be cancelled until they are sent to the workers and a
+  ``timeout`` is not enforced.
+
+"""
+__docformat__ = "restructuredtext en"
+
+__all__ = [
+    'ProcessPool',
+]
+
+# standard library modules
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import cPickle as pickle    # Python 2
+except ImportError:
+    import pickle
+
+try:
+    import Queue            # Python 2
+except ImportError:
+    import queue as Queue   # Python 3
+
+from threadpool import (BatchWorkRequest, NoResultsPending,
+    NoWorkersAvailable, RequestExpired, WorkFuture, WorkRequest,
+    _cancelled, _claimFirst, _handle_thread_exception)
+
+
+def _handle_process_exception(request, exc_info):
+    """Default exception handler callback for requests run in a process.
+
+    Prints the traceback formatted by the worker process.
+
+    """
+    sys.stderr.write(getattr(request, 'remoteTraceback', None) or
+        ''.join(traceback.format_exception_only(*exc_info[:2])))
+
+
+def _remoteExcInfo():
+    """Return the current exception as a picklable ``(type, value, tb)``."""
+    exc_type, exc_value, tb = sys.exc_info()
+    formatted = ''.join(traceback.format_exception(exc_type, exc_value, tb))
+    try:
+        pickle.loads(pickle.dumps(exc_value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        exc_type, exc_value = RuntimeError, RuntimeError(repr(exc_value))
+    return exc_type, exc_value, formatted
+
+
+def _runRemote(callable_, args, kwds):
+    """Run a callable in the worker process: (failed, result, traceback)."""
+    try:
+        return False, callable_(*args, **kwds), None
+    except:
+        exc_type, exc_value, formatted = _remoteExcInfo()
+        return True, (exc_type, exc_value, None), formatted
+
+
+def _workerMain(tasks_queue, results_queue):
+    """Main loop of a worker process.
+
+    Gets pickled batches of ``(requestID, deadline, callable, args, kwds,
+    is_batch)`` from ``tasks_queue`` until it gets ``None`` and sends back a
+    pickled list of ``(requestID, failed, result, traceback)`` per batch.
+
+    """
+    while True:
+        data = tasks_queue.get()
+        if data is None:
+            break
+        results = []
+        for requestID, deadline, callable_, args, kwds, is_batch in \
+                pickle.loads(data):
+            if deadline is not None and time.time() > deadline:
+                results.append((requestID, True, None, 'expired'))
+            elif is_batch:
+                items = [_runRemote(callable_, item_args, item_kwds or {})
+                    for item_args, item_kwds in args]
+                results.append((requestID, False, items, None))
+            else:
+                results.append((requestID, ) +
+                    _runRemote(callable_, args, kwds))
+        results_queue.put(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+
+
+class ProcessPool:
+    """A pool of worker processes, distributing work requests and collecting
+    results with the same interface as ``threadpool.ThreadPool``.
+
+    See the module docstring for more information.
+
+    """
+
+    def __init__(self, num_workers, batch_size=100, drop_expired=False):
+        """Set up the pool and start num_workers worker processes.
+
+        ``batch_size`` is the maximum number of work requests pickled and
+        sent to the workers together, smaller chunks are sent when there
+        are fewer than ``batch_size`` requests per worker. ``drop_expired`` is the same as for
+        ``ThreadPool``.
+
+        """
+        self._tasks_queue = multiprocessing.Queue()
+        self._remote_results = multiprocessing.Queue()
+        self._results_queue = Queue.Queue()
+        self.batch_size = batch_size
+        self.drop_expired = drop_expired
+        self.workers = []
+        self.dismissedWorkers = []
+        self.workRequests = {}
+        self._buffer = []
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collectResults)
+        self._collector.setDaemon(1)
+        self._collector.start()
+        self.createWorkers(num_workers)
+
+    def createWorkers(self, num_workers):
+        """Add num_workers worker processes to the pool."""
+        for i in range(num_workers):
+            worker = multiprocessing.Process(target=_workerMain,
+                args=(self._tasks_queue, self._remote_results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def dismissWorkers(self, num_workers, do_join=False):
+        """Tell num_workers worker processes to quit after the requests
+        already sent to them."""
+        self.flush()
+        dismiss_list = []
+        for i in range(min(num_workers, len(self.workers))):
+            dismiss_list.append(self.workers.pop())
+            self._tasks_queue.put(None)
+        if do_join:
+            for worker in dismiss_list:
+                worker.join()
+        else:
+            self.dismissedWorkers.extend(dismiss_list)
+
+    def joinAllDismissedWorkers(self):
+        """Wait for all worker processes that have been dismissed."""
+        for worker in self.dismissedWorkers:
+            worker.join()
+        self.dismissedWorkers = []
+
+    def workerCount(self):
+        """Return the number of worker processes."""
+        return len(self.workers)
+
+    def putRequest(self, request, block=True, timeout=None):
+        """Buffer a work request to be sent to the workers with the next
+        batch and save its id for later.
+
+        Returns a ``WorkFuture`` for the result of the request. ``block``
+        and ``timeout`` are accepted for compatibility, the request queue of
+        a process pool is unbounded.
+
+        """
+        assert isinstance(request, WorkRequest)
+        # don't reuse old work requests
+        assert not getattr(request, 'exception', None)
+        request.enqueued = time.time()
+        request.future = WorkFuture(request)
+        if request.exc_callback is _handle_thread_exception:
+            request.exc_callback = _handle_process_exception
+        self.workRequests[request.requestID] = request
+        self._buffer.append(request)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+        return request.future
+
+    def flush(self):
+        """Send the buffered work requests to the workers."""
+        buffered, self._buffer = self._buffer, []
+        started = []
+        for request in buffered:
+            if _claimFirst(request._startClaims, self):
+                started.append(request)
+            else:
+                # cancelled, just let poll forget it
+                self._results_queue.put((request, None))
+        buffered = started
+        if not buffered:
+            return
+        with self._lock:
+            for request in buffered:
+                self._inflight[request.requestID] = request
+        # a worker takes a whole chunk, so make at least one per worker
+        chunk_size = min(self.batch_size,
+            -(-len(buffered) // max(len(self.workers), 1)))
+        for start in range(0, len(buffered), chunk_size):
+            self._send(buffered[start:start + chunk_size])
+
+    def _send(self, requests):
+        """Pickle a chunk of work requests and put it on the task queue."""
+        tasks = [self._task(request) for request in requests]
+        try:
+            data = pickle.dumps(tasks, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # find out which requests can't be pickled, send the others
+            sendable = []
+            for request, task in zip(requests, tasks):
+                try:
+                    pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+                    sendable.append(task)
+                except Exception:
+                    self._fail(request, sys.exc_info())
+            if not sendable:
+                return
+            data = pickle.dumps(sendable, pickle.HIGHEST_PROTOCOL)
+        self._tasks_queue.put(data)
+
+    def _task(self, request):
+        if isinstance(request, BatchWorkRequest):
+            return (request.requestID, request.deadline,
+                request.itemCallable, request.items, None, True)
+        return (request.requestID, request.deadline, request.callable,
+            request.args, request.kwds, False)
+
+    def _fail(self, request, exc_info):
+        with self._lock:
+            self._inflight.pop(request.requestID, None)
+        request.exception = True
+        self._deliver(request, exc_info)
+
+    def _deliver(self, request, result):
+        request.future._set(result)
+        self._results_queue.put((request, result))
+
+    def _collectResults(self):
+        """Turn the results sent back by the workers into ``(request,
+        result)`` pairs for ``poll``, completing the futures on the way."""
+        while True:
+            results = pickle.loads(self._remote_results.get())
+            for requestID, failed, result, formatted in results:
+                with self._lock:
+                    request = self._inflight.pop(requestID)
+                if formatted == 'expired':
+                    request.expired = True
+                    try:
+                        raise RequestExpired("deadline passed %.3fs ago" %
+                            (time.time() - request.deadline))
+                    except RequestExpired:
+                        result = sys.exc_info()
+                elif isinstance(request, BatchWorkRequest):
+                    result = [item[:2] for item in result]
+                elif formatted is not None:
+                    request.remoteTraceback = formatted
+                request.exception = failed
+                self._deliver(request, result)
+
+    def poll(self, block=False):
+        """Process any new results in the queue."""
+        self.flush()
+        while True:
+            # still results pending?
+            if not self.workRequests:
+                raise NoResultsPending
+            # are there still workers to process remaining requests?
+            elif block and not self.workers:
+                raise NoWorkersAvailable
+            try:
+                # get back next results
+                request, result = self._results_queue.get(block=block)
+                if _cancelled(request) or \
+                        (request.expired and self.drop_expired):
+                    del self.workRequests[request.requestID]
+                    continue
+                request._handleResult(result)
+                del self.workRequests[request.requestID]
+            except Queue.Empty:
+                break
+
+    def wait(self):
+        """Wait for results, blocking until all have arrived."""
+        while 1:
+            try:
+                self.poll(True)
+            except NoResultsPending:
+                break
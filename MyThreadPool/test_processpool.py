@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+"""Behaviour tests for processpool.py.
+
+Run from this directory::
+
+    python -m unittest test_processpool
+
+"""
+import os
+import time
+import unittest
+
+from processpool import ProcessPool, pickle
+from threadpool import WorkRequest, makeRequests
+
+
+def square(x):
+    return x * x
+
+
+def fail(x):
+    raise ValueError("bad %s" % x)
+
+
+def sleepy_pid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(4)
+        self.results = {}
+        self.failures = {}
+
+    def tearDown(self):
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+
+    def callback(self, request, result):
+        self.results[request.args[0]] = result
+
+    def exc_callback(self, request, exc_info):
+        self.failures[request.args[0]] = exc_info
+
+    def test_results_and_callbacks(self):
+        futures = [self.pool.putRequest(request) for request in
+            makeRequests(square, range(10), self.callback, self.exc_callback)]
+        self.pool.wait()
+        self.assertEqual(self.results, dict((i, i * i) for i in range(10)))
+        self.assertEqual([future.result(0) for future in futures],
+            [i * i for i in range(10)])
+        self.assertEqual(self.pool.workRequests, {})
+
+    def test_batches(self):
+        for request in makeRequests(square, range(25), self.callback,
+                self.exc_callback, chunksize=4):
+            self.pool.putRequest(request)
+        self.pool.wait()
+        self.assertEqual(self.results, dict((i, i * i) for i in range(25)))
+
+    def test_exception(self):
+        for request in makeRequests(fail, [1, 2], self.callback,
+                self.exc_callback):
+            self.pool.putRequest(request)
+        future = self.pool.putRequest(WorkRequest(fail, [3]))
+        # the requests are only sent with a full batch or by flush
+        self.pool.flush()
+        self.assertRaises(ValueError, future.result, 5)
+        self.pool.wait()
+        self.assertEqual(self.results, {})
+        self.assertEqual(sorted(self.failures), [1, 2])
+        exc_type, exc_value, tb = self.failures[1]
+        self.assertTrue(exc_type is ValueError)
+        self.assertEqual(str(exc_value), "bad 1")
+        self.assertTrue(tb is None)
+
+    def test_unpicklable_request(self):
+        requests = makeRequests(lambda x: x, [1], self.callback,
+            self.exc_callback) + makeRequests(square, [2], self.callback,
+            self.exc_callback)
+        futures = [self.pool.putRequest(request) for request in requests]
+        self.pool.flush()
+        # failed while flushing, without waiting for the workers
+        self.assertTrue(futures[0].done())
+        self.pool.wait()
+        self.assertEqual(self.results, {2: 4})
+        self.assertTrue(issubclass(self.failures[1][0],
+            (pickle.PicklingError, TypeError, AttributeError)))
+
+    def test_requests_are_spread_over_the_workers(self):
+        futures = [self.pool.putRequest(WorkRequest(sleepy_pid, [0.2]))
+            for i in range(8)]
+        start = time.time()
+        self.pool.wait()
+        self.assertTrue(time.time() - start < 1.2)
+        self.assertEqual(len(set(future.result(0) for future in futures)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,551 @@
+# -*- coding: UTF-8 -*-
+"""Behaviour tests for threadpool.py.
+
+Run from this directory::
+
+    python -m unittest test_threadpool
+
+"""
+import logging
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+try:
+    import Queue            # Python 2
+except ImportError:
+    import queue as Queue   # Python 3
+
+from threadpool import (AutoScaler, BatchWorkRequest, NoResultsPending,
+    RequestCancelled, RequestExpired, RequestTimedOut, ThreadPool, WorkRequest,
+    as_completed, makeRequests, workerResource)
+
+
+class _LateIdleWorkers(dict):
+    """``WorkStealingQueue._idle`` replacement: the first emptiness check by
+    the ``producer`` thread waits until a worker registered as idle and then
+    says there is none, the interleaving which used to lose the request."""
+
+    def __init__(self, producer):
+        dict.__init__(self)
+        self.producer = producer
+        self.registered = threading.Event()
+        self.delayed = False
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.registered.set()
+
+    def __bool__(self):
+        if threading.currentThread() is self.producer and not self.delayed:
+            self.delayed = True
+            self.registered.wait(5)
+            return False
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+
+def sleep_and_return(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _blockWorker(pool):
+    """Keep the only worker of ``pool`` busy until the returned event is set,
+    so the requests put meanwhile are queued."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+    pool.putRequest(WorkRequest(block))
+    started.wait(2)
+    return release
+
+
+class PriorityTest(unittest.TestCase):
+
+    def test_priority_then_deadline_then_fifo(self):
+        pool = ThreadPool(1)
+        release = _blockWorker(pool)
+        order = []
+        soon = time.time() + 60
+        for name, priority, deadline in [("low", 0, None),
+                ("low-deadline", 0, soon), ("high", 5, None),
+                ("high-late", 5, soon + 10), ("high-soon", 5, soon),
+                ("high-2", 5, None)]:
+            pool.putRequest(WorkRequest(order.append, [name],
+                priority=priority, deadline=deadline))
+        self.assertEqual(pool.queueDepth(), {0: 2, 5: 4})
+        release.set()
+        pool.wait()
+        self.assertEqual(order, ["high-soon", "high-late", "high", "high-2",
+            "low-deadline", "low"])
+        pool.dismissWorkers(1)
+
+    def test_expired_request_is_not_run(self):
+        for drop_expired in (False, True):
+            pool = ThreadPool(1, drop_expired=drop_expired)
+            release = _blockWorker(pool)
+            ran, failures = [], []
+            request = WorkRequest(ran.append, [1], deadline=time.time() + 0.1,
+                exc_callback=lambda request, exc_info: failures.append(
+                    exc_info[0]))
+            pool.putRequest(request)
+            time.sleep(0.2)
+            release.set()
+            pool.wait()
+            self.assertEqual(ran, [])
+            self.assertTrue(request.expired)
+            self.assertEqual(failures, [] if drop_expired else [RequestExpired])
+            pool.dismissWorkers(1)
+
+
+class FutureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(4)
+
+    def tearDown(self):
+        self.pool.dismissWorkers(4, do_join=True)
+
+    def test_as_completed(self):
+        futures = [self.pool.submit(sleep_and_return, seconds)
+            for seconds in (0.3, 0.1, 0.2)]
+        self.assertEqual([future.result() for future in as_completed(futures, 2)],
+            [0.1, 0.2, 0.3])
+
+    def test_exception(self):
+        future = self.pool.submit(int, "x")
+        self.assertRaises(ValueError, future.result, 2)
+        self.assertTrue(future.exception()[0] is ValueError)
+        self.assertEqual(self.pool.submit(abs, -1).exception(2), None)
+
+    def test_exception_keeps_its_traceback(self):
+        def failing(x):
+            raise ValueError(x)
+
+        def raised_in(func, *args):
+            try:
+                func(*args)
+            except ValueError:
+                return [frame[2] for frame in
+                    traceback.extract_tb(sys.exc_info()[2])]
+            self.fail("no ValueError")
+        self.assertTrue("failing" in
+            raised_in(self.pool.submit(failing, 1).result, 2))
+        self.assertTrue("failing" in raised_in(list,
+            self.pool.map(failing, [1])))
+        self.assertTrue("failing" in raised_in(list,
+            self.pool.map(failing, [1, 2], chunksize=2)))
+
+    def test_map(self):
+        items = [0.05, 0.01, 0.03, 0.02]
+        self.assertEqual(list(self.pool.map(sleep_and_return, items)), items)
+        self.assertEqual(sorted(self.pool.map(sleep_and_return, items,
+            ordered=False)), sorted(items))
+        self.assertEqual(list(self.pool.map(abs, range(-50, 0), chunksize=8)),
+            list(range(50, 0, -1)))
+
+
+def divide(x, by=1):
+    return x // by
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(2)
+        self.results = []
+        self.failures = []
+
+    def tearDown(self):
+        self.pool.dismissWorkers(2, do_join=True)
+
+    def callback(self, request, result):
+        self.results.append((request.requestID, request.args, result))
+
+    def exc_callback(self, request, exc_info):
+        self.failures.append((request.requestID, request.args, exc_info[0]))
+
+    def pollAll(self):
+        while True:
+            try:
+                self.pool.poll(True)
+            except NoResultsPending:
+                return
+
+    def test_callbacks_per_item(self):
+        items = [6, 7, ([8], {'by': 2}), ([9], {'by': 0}), 10]
+        requests = makeRequests(divide, items, self.callback,
+            self.exc_callback, chunksize=2)
+        self.assertEqual([len(request.items) for request in requests],
+            [2, 2, 1])
+        self.assertTrue(all(isinstance(request, BatchWorkRequest)
+            for request in requests))
+        for request in requests:
+            self.pool.putRequest(request)
+        self.pollAll()
+        first, second, third = [request.requestID for request in requests]
+        self.assertEqual(sorted(self.results), sorted([((first, 0), [6], 6),
+            ((first, 1), [7], 7), ((second, 0), [8], 4),
+            ((third, 0), [10], 10)]))
+        self.assertEqual(self.failures, [((second, 1), [9], ZeroDivisionError)])
+
+    def test_expired_batch_fails_every_item(self):
+        requests = makeRequests(divide, [1, 2, 3], self.callback,
+            self.exc_callback, deadline=time.time() - 1, chunksize=3)
+        self.pool.putRequest(requests[0])
+        self.pollAll()
+        batch = requests[0].requestID
+        self.assertEqual(self.results, [])
+        self.assertEqual(self.failures, [((batch, i), [i + 1], RequestExpired)
+            for i in range(3)])
+
+
+class _Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(2, collect_stats=True)
+
+    def tearDown(self):
+        self.pool.stopStatsReporter()
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+
+    def runDivisions(self):
+        ignore = lambda request, value: None
+        for request in makeRequests(divide, [4, 6, ([1], {'by': 0})],
+                ignore, ignore) + [WorkRequest(divide, [1], callback=ignore,
+                exc_callback=ignore, deadline=time.time() - 1)]:
+            self.pool.putRequest(request)
+        self.pool.wait()
+
+    def test_counters(self):
+        self.runDivisions()
+        stats = self.pool.stats()
+        self.assertEqual((stats['workers'], stats['busy'], stats['queued'],
+            stats['pending']), (2, 0, 0, 0))
+        entry = stats['callables']['test_threadpool.divide']
+        self.assertEqual((entry['count'], entry['failures'], entry['expired']),
+            (4, 1, 1))
+        # the expired request never ran
+        self.assertEqual([entry[phase]['samples'] for phase in
+            ('queued', 'run', 'drain')], [4, 3, 4])
+        run = entry['run']
+        self.assertTrue(0 <= run['p50'] <= run['p99'] <= run['max'])
+        self.assertEqual(sum(count for bound, count in run['histogram']), 3)
+        self.pool._stats.reset()
+        self.assertEqual(self.pool.stats()['callables'], {})
+
+    def test_off_by_default(self):
+        pool = ThreadPool(1)
+        try:
+            self.assertEqual(pool.submit(divide, 4).result(2), 4)
+            self.assertEqual(pool.stats()['callables'], {})
+        finally:
+            pool.dismissWorkers(1, do_join=True)
+
+    def test_reporter(self):
+        logger = logging.getLogger('test_threadpool.stats')
+        logger.propagate = False
+        records = _Records()
+        logger.addHandler(records)
+        try:
+            self.runDivisions()
+            self.pool.startStatsReporter(0.05, logger=logger,
+                level=logging.WARNING, reset=True)
+            for i in range(200):
+                if len(records.messages) >= 3:
+                    break
+                time.sleep(0.01)
+        finally:
+            logger.removeHandler(records)
+        self.assertEqual(records.messages[0],
+            "threadpool: workers=2 busy=0 queued=0 pending=0")
+        self.assertTrue(records.messages[1].startswith("threadpool: "
+            "test_threadpool.divide count=4 failures=1 expired=1 queued p50="),
+            records.messages[1])
+        # reset after the first report, nothing ran since
+        self.assertEqual(records.messages[2], records.messages[0])
+
+
+class BackpressureTest(unittest.TestCase):
+
+    def test_bounded_queues_with_collector(self):
+        pool = ThreadPool(2, q_size=2, resq_size=2, collector=True)
+        results = []
+
+        def produce():
+            for request in makeRequests(abs, range(-200, 0),
+                    callback=lambda request, result: results.append(result)):
+                pool.putRequest(request)
+            pool.wait()
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(10)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(sorted(results), list(range(1, 201)))
+        pool.dismissWorkers(2)
+
+    def test_max_inflight(self):
+        pool = ThreadPool(2, max_inflight=2)
+        release = threading.Event()
+        for i in range(2):
+            pool.putRequest(WorkRequest(release.wait, [5]))
+        request = WorkRequest(abs, [-1])
+        self.assertRaises(Queue.Full, pool.putRequest, request, False)
+        self.assertRaises(Queue.Full, pool.putRequest, request, True, 0.2)
+        release.set()
+        # without a collector putRequest collects a result itself to make room
+        self.assertEqual(pool.putRequest(request, True, 2).result(2), 1)
+        pool.wait()
+        self.assertEqual(pool._inflight, 0)
+        pool.dismissWorkers(2)
+
+
+class TimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.stopWatchdog()
+        self.pool.dismissWorkers(self.pool.workerCount())
+
+    def test_timeout_fires_once(self):
+        results = []
+        failures = []
+        request = WorkRequest(sleep_and_return, [1],
+            callback=lambda request, result: results.append(result),
+            exc_callback=lambda request, exc_info: failures.append(exc_info),
+            timeout=0.2)
+        future = self.pool.putRequest(request)
+        self.assertRaises(RequestTimedOut, future.result, 2)
+        # let the watchdog look at the still running request a few times
+        time.sleep(1.2)
+        self.pool.wait()
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0][0] is RequestTimedOut)
+        self.assertTrue(request.timedOut is True)
+        self.assertEqual(self.pool.watchdog.timedOut, 1)
+        # the worker finished meanwhile, its late result is dropped
+        self.assertEqual(results, [])
+        self.assertRaises(NoResultsPending, self.pool.poll)
+        self.assertRaises(RequestTimedOut, future.result, 0)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(self.pool._inflight, 0)
+
+    def test_fast_request_is_not_timed_out(self):
+        request = WorkRequest(sleep_and_return, [0.01], timeout=1)
+        self.assertEqual(self.pool.putRequest(request).result(2), 0.01)
+        self.assertFalse(request.timedOut)
+
+    def test_cancel_queued_request(self):
+        results = []
+        blocker = threading.Event()
+        self.pool.putRequest(WorkRequest(blocker.wait, [5]))
+        self.pool.putRequest(WorkRequest(blocker.wait, [5]))
+        request = WorkRequest(sleep_and_return, [0],
+            callback=lambda request, result: results.append(result))
+        future = self.pool.putRequest(request)
+        self.assertTrue(future.cancel())
+        self.assertTrue(request.cancel())
+        blocker.set()
+        self.pool.wait()
+        self.assertTrue(future.cancelled())
+        self.assertRaises(RequestCancelled, future.result, 1)
+        self.assertEqual(results, [])
+
+    def test_cancel_running_request_fails(self):
+        started = threading.Event()
+
+        def work():
+            started.set()
+            time.sleep(0.1)
+            return 1
+        future = self.pool.putRequest(WorkRequest(work))
+        started.wait(2)
+        self.assertFalse(future.cancel())
+        self.assertEqual(future.result(2), 1)
+
+
+class WorkStealingTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+
+    def test_put_while_worker_goes_idle(self):
+        self.pool = ThreadPool(0, work_stealing=True)
+        futures = []
+
+        def produce():
+            self.pool._requests_queue._idle = \
+                _LateIdleWorkers(threading.currentThread())
+            futures.append(self.pool.submit(abs, -1))
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.1)
+        self.pool.createWorkers(1)
+        producer.join(5)
+        self.assertEqual(futures[0].result(2), 1)
+
+    def test_many_small_requests(self):
+        self.pool = ThreadPool(4, work_stealing=True)
+        for i in range(2000):
+            self.assertEqual(self.pool.submit(abs, -i).result(2), i)
+        futures = [self.pool.submit(abs, -i) for i in range(2000)]
+        self.assertEqual([future.result(2) for future in futures],
+            list(range(2000)))
+
+
+class DismissTest(unittest.TestCase):
+
+    def test_dismiss_with_full_queue(self):
+        pool = ThreadPool(2, q_size=2)
+        blocker = threading.Event()
+        for i in range(4):
+            pool.putRequest(WorkRequest(blocker.wait, [5]))
+        self.assertEqual(pool._requests_queue.qsize(), 2)
+        dismisser = threading.Thread(target=pool.dismissWorkers, args=(2, ))
+        dismisser.start()
+        dismisser.join(2)
+        self.assertFalse(dismisser.is_alive())
+        self.assertEqual(pool.workerCount(), 0)
+        blocker.set()
+        pool.joinAllDismissedWorkers()
+        self.assertEqual(pool.workers, [])
+        # the sentinels went first, the queued requests are left
+        self.assertEqual(pool._requests_queue.qsize(), 2)
+
+
+class AutoScalerTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.scaler.dismiss()
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+
+    def firstCheck(self):
+        # the autoscaler checks once when started, then sleeps for interval
+        for i in range(200):
+            if self.scaler.status()['size'] != self.size:
+                return
+            time.sleep(0.01)
+
+    def test_scale_up(self):
+        self.pool = ThreadPool(1)
+        release = _blockWorker(self.pool)
+        futures = [self.pool.submit(abs, -i) for i in range(3)]
+        time.sleep(0.1)
+        self.size = 1
+        self.scaler = AutoScaler(self.pool, 1, 4, target_wait=0.05, step=2,
+            interval=3600)
+        self.firstCheck()
+        self.assertEqual(self.pool.workerCount(), 3)
+        self.assertEqual([future.result(2) for future in futures], [0, 1, 2])
+        release.set()
+        # at most max_workers
+        release = threading.Event()
+        for i in range(3):
+            self.pool.submit(release.wait, 5)
+        self.pool.submit(abs, 1)
+        time.sleep(0.1)
+        self.scaler.check()
+        self.assertEqual(self.pool.workerCount(), 4)
+        self.scaler.check()
+        self.assertEqual(self.pool.workerCount(), 4)
+        release.set()
+
+    def test_scale_down(self):
+        self.pool = ThreadPool(6)
+        self.size = 6
+        # one idle worker dismissed and the excess over max_workers, counted
+        # after that dismissal
+        self.scaler = AutoScaler(self.pool, 2, 4, idle_timeout=0,
+            interval=3600)
+        self.firstCheck()
+        self.assertEqual(self.pool.workerCount(), 4)
+        self.assertEqual(self.scaler.status()['size'], 4)
+        for i in range(3):
+            time.sleep(0.01)
+            self.scaler.check()
+        self.assertEqual(self.pool.workerCount(), 2)
+
+
+class WorkerLifecycleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.pool = ThreadPool(2, initializer=self.initializer,
+            finalizer=self.finalizer)
+
+    def tearDown(self):
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+
+    def initializer(self, worker):
+        self.events.append(('init', worker.name))
+
+    def finalizer(self, worker):
+        self.events.append(('final', worker.name))
+
+    def connection(self):
+        worker = threading.current_thread().name
+        return workerResource('conn', lambda: {'worker': worker},
+            lambda conn: self.events.append(('teardown', conn['worker'])))
+
+    def workerEvents(self, name):
+        return [event for event, worker in self.events if worker == name]
+
+    def test_resources_are_torn_down_before_the_finalizer(self):
+        started = []
+        both = threading.Event()
+
+        def useConnection():
+            conn = self.connection()
+            self.assertTrue(self.connection() is conn)
+            started.append(conn)
+            if len(started) == 2:
+                both.set()
+            both.wait(5)
+            return conn
+        futures = [self.pool.submit(useConnection) for i in range(2)]
+        conns = [future.result(5) for future in futures]
+        names = sorted(conn['worker'] for conn in conns)
+        self.assertEqual(names, sorted(w.name for w in self.pool.workers))
+
+        # dismissing a worker
+        self.pool.dismissWorkers(1, do_join=True)
+        gone = self.pool.dismissedWorkers[0].name
+        self.assertEqual(self.workerEvents(gone), ['init', 'teardown', 'final'])
+        kept = [name for name in names if name != gone][0]
+        self.assertEqual(self.workerEvents(kept), ['init'])
+        # the kept worker goes on with its connection
+        conn = self.pool.submit(self.connection).result(5)
+        self.assertTrue(conn in conns and conn['worker'] == kept)
+
+        # shutting the pool down
+        self.pool.dismissWorkers(self.pool.workerCount(), do_join=True)
+        self.assertEqual(self.workerEvents(kept), ['init', 'teardown', 'final'])
+
+    def test_resource_outside_of_a_worker(self):
+        self.assertFalse(self.connection() is self.connection())
+        # and it's the caller's to release
+        self.pool.dismissWorkers(2, do_join=True)
+        self.assertEqual(len(self.workerEvents(
+            threading.current_thread().name)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
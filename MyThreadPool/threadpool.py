@@ -34,12 +34,27 @@ Website : http://chrisarndt.de/projects/threadpool/
 __docformat__ = "restructuredtext en"
 
 __all__ = [
+    'as_completed',
+    'AutoScaler',
+    'BatchWorkRequest',
     'makeRequests',
     'NoResultsPending',
     'NoWorkersAvailable',
+    'PoolStats',
+    'PriorityRequestQueue',
+    'RequestCancelled',
+    'ResultCollector',
+    'RequestExpired',
+    'RequestTimedOut',
+    'ResultTimeout',
+    'StatsReporter',
     'ThreadPool',
+    'Watchdog',
+    'WorkFuture',
     'WorkRequest',
-    'WorkerThread'
+    'WorkStealingQueue',
+    'WorkerThread',
+    'workerResource'
 ]
 
 __author__ = "Christopher Arndt"
@@ -48,8 +63,13 @@ __license__ = "MIT license"
 
 
 # standard library modules
+import collections
+import heapq
+import itertools
+import logging
 import sys
 import threading
+import time
 import traceback
 
 try:
@@ -57,6 +77,8 @@ try:
 except ImportError:
     import queue as Queue   # Python 3
 
+LOGGER = logging.getLogger(__name__)
+
 
 # exceptions
 class NoResultsPending(Exception):
@@ -67,6 +89,22 @@ class NoWorkersAvailable(Exception):
     """No worker threads available to process remaining requests."""
     pass
 
+class RequestExpired(Exception):
+    """The deadline of a work request passed before a worker picked it up."""
+    pass
+
+class ResultTimeout(Exception):
+    """A result was not available within the given timeout."""
+    pass
+
+class RequestCancelled(Exception):
+    """The work request was cancelled before a worker picked it up."""
+    pass
+
+class RequestTimedOut(Exception):
+    """The work request ran longer than its timeout."""
+    pass
+
 
 # internal module helper functions
 def _handle_thread_exception(request, exc_info):
@@ -78,9 +116,56 @@ def _handle_thread_exception(request, exc_info):
     traceback.print_exception(*exc_info)
 
 
+if sys.version_info[0] >= 3:
+    def _reraise(exc_type, exc_value, exc_tb):
+        """Raise an exception of ``sys.exc_info()`` again with its original
+        traceback."""
+        raise exc_value.with_traceback(exc_tb)
+else:
+    # the three argument raise is a syntax error for Python 3
+    exec("def _reraise(exc_type, exc_value, exc_tb):\n"
+        "    raise exc_type, exc_value, exc_tb\n")
+
+
+def _claimFirst(claims, claimant):
+    """Append ``claimant`` to the ``claims`` list and return True if it was
+    the first. ``list.append`` is atomic, so of several threads racing for
+    the same claim exactly one wins, without taking a lock. The winner gets
+    True again if it claims once more (``Watchdog.check`` hands its claim
+    on to ``_deliver`` that way), so a request must not be claimed twice
+    for different outcomes."""
+    claims.append(claimant)
+    return claims[0] is claimant
+
+
+def _cancelled(request):
+    """Return True if ``cancel`` won the race for starting the request."""
+    return request._startClaims[:1] == ['cancel']
+
+
+def _excInfo(exc_class, message):
+    """Return the ``sys.exc_info()`` tuple of a freshly raised exception."""
+    try:
+        raise exc_class(message)
+    except exc_class:
+        return sys.exc_info()
+
+
+def _invokeCallbacks(request, result):
+    """Hand the result of a request to its callbacks."""
+    # has an exception occured?
+    if request.exception and request.exc_callback:
+        request.exc_callback(request, result)
+    # hand results to callback, if any
+    if request.callback and not \
+           (request.exception and request.exc_callback):
+        request.callback(request, result)
+
+
 # utility functions
 def makeRequests(callable_, args_list, callback=None,
-        exc_callback=_handle_thread_exception):
+        exc_callback=_handle_thread_exception, priority=0, deadline=None,
+        chunksize=1, timeout=None):
     """Create several work requests for same callable with different arguments.
 
     Convenience function for creating several work requests for the same
@@ -92,26 +177,470 @@ def makeRequests(callable_, args_list, callback=None,
     positional arguments and a dictionary of keyword arguments or a single,
     non-tuple argument.
 
-    See docstring for ``WorkRequest`` for info on ``callback`` and
-    ``exc_callback``.
+    See docstring for ``WorkRequest`` for info on ``callback``,
+    ``exc_callback``, ``priority``, ``deadline`` and ``timeout``.
+
+    If ``chunksize > 1``, consecutive items are grouped into
+    ``BatchWorkRequest`` objects of up to ``chunksize`` items each, which a
+    worker runs in one go. This saves most of the queueing overhead for
+    small tasks; callbacks are still invoked once per item. The ``timeout``
+    of a batch applies to running all its items.
 
     """
     requests = []
-    for item in args_list:
-        if isinstance(item, tuple):
-            requests.append(
-                WorkRequest(callable_, item[0], item[1], callback=callback,
-                    exc_callback=exc_callback)
-            )
-        else:
+    if chunksize > 1:
+        args_iter = iter(args_list)
+        while True:
+            chunk = list(itertools.islice(args_iter, chunksize))
+            if not chunk:
+                break
             requests.append(
-                WorkRequest(callable_, [item], None, callback=callback,
-                    exc_callback=exc_callback)
+                BatchWorkRequest(callable_, chunk, callback=callback,
+                    exc_callback=exc_callback, priority=priority,
+                    deadline=deadline, timeout=timeout)
             )
+        return requests
+    for item in args_list:
+        args, kwds = _splitArgs(item)
+        requests.append(
+            WorkRequest(callable_, args, kwds, callback=callback,
+                exc_callback=exc_callback, priority=priority,
+                deadline=deadline, timeout=timeout)
+        )
     return requests
 
 
+def as_completed(futures, timeout=None):
+    """Iterate over ``WorkFuture`` objects as their requests complete.
+
+    Futures are yielded in the order their work requests finished, no matter
+    in which order they were given. If ``timeout`` (seconds) is given and not
+    all futures are done by then, ``ResultTimeout`` is raised.
+
+    """
+    done_queue = Queue.Queue()
+    pending = set(futures)
+    for future in pending:
+        future.add_done_callback(done_queue.put)
+    if timeout is not None:
+        end_time = time.time() + timeout
+    while pending:
+        try:
+            if timeout is None:
+                future = done_queue.get()
+            else:
+                future = done_queue.get(True, max(end_time - time.time(), 0))
+        except Queue.Empty:
+            raise ResultTimeout("%d of the futures are not done" %
+                len(pending))
+        if future in pending:
+            pending.discard(future)
+            yield future
+
+
+def _chunks(callable_, args_list, chunksize):
+    """Group ``args_list`` into ``BatchWorkRequest`` arguments for ``map``."""
+    args_iter = iter(args_list)
+    while True:
+        chunk = list(itertools.islice(args_iter, chunksize))
+        if not chunk:
+            break
+        yield ((callable_, [_splitArgs(item) for item in chunk]), {})
+
+
+def _runBatch(callable_, items):
+    """Call ``callable_`` for each ``(args, kwds)`` pair of ``items``,
+    returning a ``(failed, result or exception info)`` tuple for each."""
+    results = []
+    for args, kwds in items:
+        try:
+            results.append((False, callable_(*args, **(kwds or {}))))
+        except:
+            results.append((True, sys.exc_info()))
+    return results
+
+
+def workerResource(key, factory, teardown=None):
+    """Return a resource owned by the current worker thread.
+
+    The first call for ``key`` on a worker thread creates the resource with
+    ``factory()``, later calls on the same thread return that object, so
+    e.g. a database connection per DSN is opened once per worker instead of
+    once per request::
+
+        def check(dsn, sql):
+            conn = workerResource(dsn, lambda: Connection(**DSNS[dsn]),
+                lambda conn: conn.close())
+            return conn.query(sql)
+
+    ``teardown(resource)`` is called when the worker exits. Outside of a
+    worker thread a new resource is created on every call and it's up to the
+    caller to release it.
+
+    """
+    worker = threading.currentThread()
+    if isinstance(worker, WorkerThread):
+        return worker.getResource(key, factory, teardown)
+    return factory()
+
+
+def _callableName(callable_):
+    """Name under which the statistics of a callable are kept."""
+    callable_ = getattr(callable_, 'func', callable_)   # functools.partial
+    name = getattr(callable_, '__name__', None) or type(callable_).__name__
+    module = getattr(callable_, '__module__', None)
+    return module and '%s.%s' % (module, name) or name
+
+
+def _percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def _splitArgs(item):
+    """Turn an ``args_list`` item of ``makeRequests`` into (args, kwds)."""
+    if isinstance(item, tuple):
+        return item[0], item[1]
+    return [item], None
+
+
+# queues
+class PriorityRequestQueue(Queue.Queue):
+    """Work request queue handing out the most urgent request first.
+
+    Requests are ordered by descending ``priority``, then by ascending
+    ``deadline`` (requests without a deadline come last), then in FIFO order.
+    The number of queued requests per priority level is kept in ``depth``.
+
+    """
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.depth = {}
+        self._counter = itertools.count()
+
+    def _putSentinel(self, item):
+        # dismissal sentinels go before any work request
+        heapq.heappush(self.queue,
+            (float('-inf'), 0, next(self._counter), item))
+
+    def putSentinel(self, item):
+        """Queue a dismissal sentinel right away, even if the queue is full:
+        dismissing workers must not wait for them to make room."""
+        with self.mutex:
+            self._putSentinel(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        if isinstance(item, _Dismissal):
+            return self._putSentinel(item)
+        priority = getattr(item, 'priority', 0)
+        deadline = getattr(item, 'deadline', None)
+        if deadline is None:
+            deadline = float('inf')
+        heapq.heappush(self.queue,
+            (-priority, deadline, next(self._counter), item))
+        self.depth[priority] = self.depth.get(priority, 0) + 1
+
+    def _get(self):
+        item = heapq.heappop(self.queue)[-1]
+        if isinstance(item, _Dismissal):
+            return item
+        priority = getattr(item, 'priority', 0)
+        self.depth[priority] -= 1
+        if not self.depth[priority]:
+            del self.depth[priority]
+        return item
+
+    def detachWorker(self):
+        """Called by a worker thread when it exits."""
+        pass
+
+    def depthByPriority(self):
+        """Return a ``{priority: number of queued requests}`` snapshot."""
+        with self.mutex:
+            return dict(self.depth)
+
+    def enqueuedTimes(self):
+        """Return the ``enqueued`` times of the queued work requests."""
+        with self.mutex:
+            return [entry[-1].enqueued for entry in self.queue
+                if getattr(entry[-1], 'enqueued', None)]
+
+
+class WorkStealingQueue(object):
+    """Request queue with one deque per worker thread and work stealing.
+
+    ``put`` hands a request straight to a waiting worker if there is one,
+    otherwise it appends it round-robin to the deques of the busy workers.
+    A worker takes requests from the front of its own deque and, when that
+    is empty, steals from the back of the other deques before it goes to
+    sleep. Appending to and popping from a ``collections.deque`` is atomic,
+    so as long as all workers are busy no lock is taken; the shared lock
+    only protects the idle workers.
+
+    A sleeping worker blocks on a lock of its own, which is released by
+    whoever takes the worker out of the idle workers, so waking it up is a
+    single lock release and the worker never has to look for itself in a
+    list. The deques are scanned with ``filter``, which skips the empty
+    ones at C speed even with many workers.
+
+    A worker registers as idle before it looks at all the deques a last
+    time, and ``put`` checks for idle workers again after appending. So
+    either the worker's last look finds the request or ``put`` sees the
+    worker waiting and wakes it up.
+
+    It can be used in place of ``PriorityRequestQueue`` by ``ThreadPool``
+    (``work_stealing=True``), but requests are processed in FIFO order per
+    worker, priorities are ignored and the queue is unbounded.
+
+    """
+
+    def __init__(self):
+        # deques of the running workers, fed by put()
+        self._deques = []
+        # requests put before any worker asked for one
+        self._inbox = collections.deque()
+        # everything requests can be taken from: the workers' deques, the
+        # inbox and the deques left behind by dismissed workers
+        self._all = [self._inbox]
+        # {id(deque): (deque, wakeup lock)} of the workers waiting for a
+        # request, taken out by the thread releasing the lock
+        self._idle = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    def _slot(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            wakeup = threading.Lock()
+            wakeup.acquire()
+            slot = self._local.slot = (collections.deque(), wakeup)
+            with self._lock:
+                self._deques = self._deques + [slot[0]]
+                self._all = [slot[0]] + self._all
+        return slot
+
+    def _retire(self, own):
+        """Stop handing requests to the deque of an exiting thread. What is
+        left in it is stolen by the other workers."""
+        self._local.slot = None
+        with self._lock:
+            self._deques = [d for d in self._deques if d is not own]
+            # deques compare by content, look them up by identity
+            active = set(id(d) for d in self._deques)
+            self._all = [d for d in self._all
+                if d is self._inbox or id(d) in active or d]
+            if own:
+                idle, self._idle = self._idle, {}
+            else:
+                idle = {}
+        # wake up everybody, so the leftovers get stolen
+        for each_deque, wakeup in idle.values():
+            wakeup.release()
+
+    def detachWorker(self):
+        """Called by a worker thread when it exits. If it wasn't dismissed
+        by a sentinel (see ``Watchdog``), its deque is retired now."""
+        slot = getattr(self._local, 'slot', None)
+        if slot is not None:
+            self._retire(slot[0])
+
+    def putSentinel(self, item):
+        """Queue a dismissal sentinel, the queue is never full."""
+        self.put(item)
+
+    def put(self, item, block=True, timeout=None):
+        """Queue a request; ``block`` and ``timeout`` are ignored."""
+        if self._idle:
+            with self._lock:
+                if self._idle:
+                    target, wakeup = self._idle.popitem()[1]
+                    target.append(item)
+                    wakeup.release()
+                    return
+        deques = self._deques or [self._inbox]
+        target = deques[next(self._next) % len(deques)]
+        if isinstance(item, _Dismissal):
+            # dismissal sentinels go before any work request
+            target.appendleft(item)
+        else:
+            target.append(item)
+        if self._idle:
+            # a worker went idle meanwhile and may have looked at ``target``
+            # before the request got there
+            with self._lock:
+                if self._idle:
+                    self._idle.popitem()[1][1].release()
+
+    def _take(self, own):
+        """Pop a request from ``own`` or steal one, None if all are empty."""
+        try:
+            return own.popleft()
+        except IndexError:
+            pass
+        for victim in filter(None, self._all):
+            if victim is not own:
+                try:
+                    return victim.pop()
+                except IndexError:
+                    pass
+        return None
+
+    def get(self, block=True, timeout=None):
+        """Return the next request for the calling thread, waiting for one
+        if there is none; ``block`` and ``timeout`` are ignored."""
+        own, wakeup = self._slot()
+        item = self._take(own)
+        while item is None:
+            with self._lock:
+                self._idle[id(own)] = (own, wakeup)
+            # look everywhere once more while registered as idle: a put()
+            # appending after this look sees us waiting and wakes us up
+            item = self._take(own)
+            if item is None:
+                wakeup.acquire()
+                item = self._take(own)
+                continue
+            with self._lock:
+                woken = self._idle.pop(id(own), None) is None
+            if woken:
+                # taken out of the idle workers meanwhile, the lock is (about
+                # to be) released for us
+                wakeup.acquire()
+        if isinstance(item, _Dismissal):
+            self._retire(own)
+        return item
+
+    def qsize(self):
+        return sum(len(d) for d in self._all)
+
+    def depthByPriority(self):
+        """Return the number of queued requests, all counted as priority 0."""
+        depth = len([item for item in self._snapshot()
+            if not isinstance(item, _Dismissal)])
+        return {0: depth} if depth else {}
+
+    def enqueuedTimes(self):
+        """Return the ``enqueued`` times of the queued work requests."""
+        return [item.enqueued for item in self._snapshot()
+            if getattr(item, 'enqueued', None)]
+
+    def _snapshot(self):
+        items = []
+        for d in self._all:
+            while True:
+                try:
+                    items.extend(list(d))
+                    break
+                except RuntimeError:
+                    # deque mutated during iteration, try again
+                    pass
+        return items
+
+
 # classes
+# statistics
+class PoolStats(object):
+    """Rolling latency histograms of the requests processed by a pool.
+
+    For each callable (the item callable for a ``BatchWorkRequest``) the
+    last ``window`` samples of three phases are kept:
+
+    * ``queued``: from ``putRequest`` until a worker picked the request up,
+    * ``run``: until the callable returned or raised,
+    * ``drain``: until ``poll`` picked up the result. Requests from
+      ``submit`` are not collected by ``poll`` and have no drain time.
+
+    Besides, the total number of requests, failed requests and expired
+    requests per callable is counted. ``snapshot()`` summarizes it all.
+
+    """
+
+    PHASES = ('queued', 'run', 'drain')
+    #: upper bounds (seconds) of the histogram buckets, the last one is open
+    BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60, float('inf'))
+
+    def __init__(self, window=1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._callables = {}
+
+    def _entry(self, request):
+        name = _callableName(getattr(request, 'itemCallable',
+            request.callable))
+        entry = self._callables.get(name)
+        if entry is None:
+            entry = self._callables[name] = {'count': 0, 'failures': 0,
+                'expired': 0}
+            for phase in self.PHASES:
+                entry[phase] = collections.deque(maxlen=self.window)
+        return entry
+
+    def recordFinished(self, request):
+        """Record the queue and run time of a request done by a worker."""
+        with self._lock:
+            entry = self._entry(request)
+            entry['count'] += 1
+            if request.expired:
+                entry['expired'] += 1
+            elif request.exception:
+                entry['failures'] += 1
+            if request.enqueued and request.started:
+                entry['queued'].append(request.started - request.enqueued)
+            if request.started and not request.expired:
+                entry['run'].append(request.finished - request.started)
+
+    def recordCollected(self, request):
+        """Record the time the result of a request waited for ``poll``."""
+        if request.finished:
+            with self._lock:
+                self._entry(request)['drain'].append(
+                    request.collected - request.finished)
+
+    def reset(self):
+        """Forget all samples and counts."""
+        with self._lock:
+            self._callables = {}
+
+    def _summary(self, samples):
+        ordered = sorted(samples)
+        summary = {'samples': len(ordered)}
+        if ordered:
+            summary.update(mean=sum(ordered) / len(ordered),
+                p50=_percentile(ordered, 0.5), p90=_percentile(ordered, 0.9),
+                p99=_percentile(ordered, 0.99), max=ordered[-1])
+        histogram, i = [], 0
+        for bound in self.BUCKETS:
+            count = 0
+            while i < len(ordered) and ordered[i] <= bound:
+                count += 1
+                i += 1
+            histogram.append((bound, count))
+        summary['histogram'] = histogram
+        return summary
+
+    def snapshot(self):
+        """Return ``{callable name: stats}`` where stats has the ``count``,
+        ``failures`` and ``expired`` totals and a summary per phase with the
+        number of ``samples``, their ``mean``, ``p50``, ``p90``, ``p99`` and
+        ``max`` and a ``histogram``: a list of ``(upper bound, count)``.
+        """
+        with self._lock:
+            copied = dict((name, dict((key, isinstance(value,
+                collections.deque) and list(value) or value)
+                for key, value in entry.items()))
+                for name, entry in self._callables.items())
+        for entry in copied.values():
+            for phase in self.PHASES:
+                entry[phase] = self._summary(entry[phase])
+        return copied
+
+
 class WorkerThread(threading.Thread):
     """Background thread connected to the requests/results queues.
 
@@ -120,53 +649,243 @@ class WorkerThread(threading.Thread):
 
     """
 
-    def __init__(self, requests_queue, results_queue, poll_timeout=5, **kwds):
+    def __init__(self, requests_queue, results_queue, poll_timeout=5,
+            wait_times=None, initializer=None, finalizer=None, stats=None,
+            **kwds):
         """Set up thread in daemonic mode and start it immediatedly.
 
         ``requests_queue`` and ``results_queue`` are instances of
         ``Queue.Queue`` passed by the ``ThreadPool`` class when it creates a
         new worker thread.
 
+        ``poll_timeout`` is ignored and only kept for backwards compatibility:
+        idle threads block on the queue until they get a request or are
+        dismissed by a sentinel.
+
+        If ``wait_times`` is given (a ``collections.deque``), the time each
+        request spent queued is appended to it when the thread picks it up.
+        If ``stats`` is given (a ``PoolStats``), every processed request is
+        recorded in it.
+
+        ``initializer(worker)`` is called in the new thread before it picks
+        up any request and ``finalizer(worker)`` just before it exits, after
+        the resources obtained with ``getResource`` have been torn down.
+
         """
         threading.Thread.__init__(self, **kwds)
         self.setDaemon(1)
         self._requests_queue = requests_queue
         self._results_queue = results_queue
         self._poll_timeout = poll_timeout
+        self._wait_times = wait_times
+        self._stats = stats
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._resources = collections.OrderedDict()
         self._dismissed = threading.Event()
+        self.busy = False
+        self.idleSince = time.time()
+        self.current = None
         self.start()
 
     def run(self):
+        """Set up the thread, process the job queue until told to exit and
+        release the thread's resources."""
+        try:
+            if self._initializer is not None:
+                self._initializer(self)
+            self._processRequests()
+        finally:
+            self._requests_queue.detachWorker()
+            self._releaseResources()
+            if self._finalizer is not None:
+                self._finalizer(self)
+
+    def getResource(self, key, factory, teardown=None):
+        """Return the resource of this thread stored under ``key``, creating
+        it with ``factory()`` first if needed (see ``workerResource``).
+        """
+        try:
+            return self._resources[key][0]
+        except KeyError:
+            resource = factory()
+            self._resources[key] = (resource, teardown)
+            return resource
+
+    def _releaseResources(self):
+        while self._resources:
+            key, (resource, teardown) = self._resources.popitem()
+            if teardown is not None:
+                try:
+                    teardown(resource)
+                except Exception:
+                    traceback.print_exc()
+
+    def _processRequests(self):
         """Repeatedly process the job queue until told to exit."""
-        while True:
-            if self._dismissed.isSet():
-                # we are dismissed, break out of loop
+        while not self._dismissed.isSet():
+            # block until there is something to do. The pool tells idle
+            # threads to exit by queueing a ``_Dismissal`` sentinel, so there
+            # is no need to wake up periodically and requests are never put
+            # back into the queue out of order.
+            request = self._requests_queue.get()
+            if isinstance(request, _Dismissal):
+                request.claim(self)
                 break
-            # get next work request. If we don't get a new request from the
-            # queue after self._poll_timout seconds, we jump to the start of
-            # the while loop again, to give the thread a chance to exit.
-            try:
-                request = self._requests_queue.get(True, self._poll_timeout)
-            except Queue.Empty:
+            if not _claimFirst(request._startClaims, self):
+                # cancelled while queued, just let poll forget it
+                if not request.detached:
+                    self._results_queue.put((request, None))
                 continue
-            else:
-                if self._dismissed.isSet():
-                    # we are dismissed, put back request in queue and exit loop
-                    self._requests_queue.put(request)
-                    break
-                try:
-                    result = request.callable(*request.args, **request.kwds)
-                    self._results_queue.put((request, result))
-                except:
-                    request.exception = True
-                    self._results_queue.put((request, sys.exc_info()))
+            request.started = time.time()
+            if self._wait_times is not None and request.enqueued:
+                self._wait_times.append(request.started - request.enqueued)
+            if request.deadline is not None and \
+                    time.time() > request.deadline:
+                # too late, fail the request without running it
+                request.expired = True
+                self._deliver(request, _excInfo(RequestExpired,
+                    "deadline passed %.3fs ago" %
+                    (time.time() - request.deadline)), exception=True)
+                continue
+            self.busy = True
+            self.current = request
+            try:
+                result = request.callable(*request.args, **request.kwds)
+                failed = False
+            except:
+                result = sys.exc_info()
+                failed = True
+            self.current = None
+            self._deliver(request, result, failed)
+            self.busy = False
+            self.idleSince = time.time()
+
+    def _deliver(self, request, result, exception=False, claimant=None):
+        """Complete the request's future and queue the result for ``poll``.
+
+        Only the first delivery of a request counts: the result of a request
+        which was failed by the ``Watchdog`` for running too long is dropped.
+
+        """
+        if not _claimFirst(request._doneClaims, claimant or self):
+            return
+        request.exception = exception
+        request.finished = time.time()
+        if self._stats is not None:
+            self._stats.recordFinished(request)
+        if request.future is not None:
+            request.future._set(result)
+        if not request.detached:
+            self._results_queue.put((request, result))
 
     def dismiss(self):
         """Sets a flag to tell the thread to exit when done with current job.
+
+        An idle thread only notices the flag after it got its next request;
+        use ``ThreadPool.dismissWorkers`` to stop idle threads right away.
+
         """
         self._dismissed.set()
 
 
+class _Dismissal(object):
+    """Sentinel telling the worker thread which picks it up to exit.
+
+    It is queued ahead of all work requests, so the next idle worker exits
+    immediately. ``claimed`` is set once a worker took it and ``worker`` is
+    that thread.
+
+    """
+
+    def __init__(self, on_claim):
+        self.worker = None
+        self.claimed = threading.Event()
+        self._on_claim = on_claim
+
+    def claim(self, worker):
+        self.worker = worker
+        self._on_claim(self)
+        self.claimed.set()
+
+
+class WorkFuture(object):
+    """The eventual result of a work request.
+
+    It is completed by the worker thread as soon as the callable returned,
+    independently of ``ThreadPool.poll``, which still invokes the request's
+    callbacks on the polling thread.
+
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if the work request has been processed."""
+        return self._done
+
+    def cancel(self):
+        """Cancel the request if it didn't start yet, see
+        ``WorkRequest.cancel``."""
+        return self.request.cancel()
+
+    def cancelled(self):
+        """Return True if the request was cancelled."""
+        return self.request.cancelled
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise ResultTimeout("request %s is not done" %
+                    self.request.requestID)
+
+    def result(self, timeout=None):
+        """Return the value returned by the callable, waiting at most
+        ``timeout`` seconds for it. If the callable raised an exception (or
+        the request expired), that exception is raised here.
+        """
+        self._wait(timeout)
+        if self.request.exception:
+            _reraise(*self._result)
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the ``sys.exc_info()`` tuple of the failed request, or None
+        if it succeeded, waiting at most ``timeout`` seconds for it.
+        """
+        self._wait(timeout)
+        return self._result if self.request.exception else None
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` once the request is done, on the worker thread,
+        or right away if it is done already.
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result):
+        with self._condition:
+            self._result = result
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+
 class WorkRequest:
     """A request to execute a callable for putting in the request queue later.
 
@@ -177,7 +896,8 @@ class WorkRequest:
     """
 
     def __init__(self, callable_, args=None, kwds=None, requestID=None,
-            callback=None, exc_callback=_handle_thread_exception):
+            callback=None, exc_callback=_handle_thread_exception, priority=0,
+            deadline=None, timeout=None):
         """Create a work request for a callable and attach callbacks.
 
         A work request consists of the a callable to be executed by a
@@ -202,6 +922,28 @@ class WorkRequest:
         ``ThreadPool`` object to store the results of that work request in a
         dictionary. It defaults to the return value of ``id(self)``.
 
+        Requests with a higher ``priority`` (int, default 0) are picked up
+        before those with a lower one; within a priority level the request
+        with the earliest ``deadline`` goes first. ``deadline`` is an absolute
+        time as returned by ``time.time()``. A request still queued when its
+        deadline has passed is not run: it is handed to ``exc_callback`` with
+        a ``RequestExpired`` exception and has its ``expired`` attribute set
+        (or is discarded silently if the pool was created with
+        ``drop_expired=True``).
+
+        If the callable runs longer than ``timeout`` seconds, the request is
+        failed with a ``RequestTimedOut`` error by the pool's ``Watchdog``
+        and whatever the callable returns afterwards is dropped. The worker
+        thread can't be interrupted though, it stays busy until the callable
+        returns (see ``ThreadPool.startWatchdog`` to replace it meanwhile).
+
+        A request can be withdrawn with ``cancel`` until a worker picks it up.
+
+        The attributes ``enqueued``, ``started``, ``finished`` and
+        ``collected`` are set to the ``time.time()`` at which the request was
+        put into the queue, picked up by a worker, done and picked up by
+        ``poll``, respectively, and are None until then.
+
         """
         if requestID is None:
             self.requestID = id(self)
@@ -211,6 +953,21 @@ class WorkRequest:
             except TypeError:
                 raise TypeError("requestID must be hashable.")
         self.exception = False
+        self.expired = False
+        self.cancelled = False
+        self.timedOut = False
+        self.timeout = timeout
+        # see _claimFirst: who started (or cancelled) and who finished it
+        self._startClaims = []
+        self._doneClaims = []
+        self.enqueued = None
+        self.started = None
+        self.finished = None
+        self.collected = None
+        self.future = None
+        self.detached = False
+        self.priority = priority
+        self.deadline = deadline
         self.callback = callback
         self.exc_callback = exc_callback
         self.callable = callable_
@@ -221,6 +978,88 @@ class WorkRequest:
         return "<WorkRequest id=%s args=%r kwargs=%r exception=%s>" % \
             (self.requestID, self.args, self.kwds, self.exception)
 
+    def cancel(self):
+        """Cancel the request unless a worker picked it up already.
+
+        Returns True if the request is cancelled. Its future then raises
+        ``RequestCancelled``; no callback is invoked, ``poll`` just forgets
+        the request when the workers get to it in the queue.
+
+        """
+        if not _claimFirst(self._startClaims, 'cancel'):
+            return self.cancelled
+        _claimFirst(self._doneClaims, 'cancel')
+        self.cancelled = True
+        self.exception = True
+        if self.future is None:
+            self.future = WorkFuture(self)
+        self.future._set(_excInfo(RequestCancelled,
+            "request %s was cancelled" % self.requestID))
+        return True
+
+    def _handleResult(self, result):
+        _invokeCallbacks(self, result)
+
+
+class BatchWorkRequest(WorkRequest):
+    """A work request calling the same callable for several argument sets.
+
+    The whole batch is queued and picked up as one request and a worker runs
+    all its items in a row. The result of the batch is a list with a
+    ``(failed, result)`` tuple per item, where ``result`` is the exception
+    info if ``failed`` is true. When the batch is polled, the callbacks are
+    invoked once per item with a lightweight ``_BatchItem`` in place of the
+    request, carrying the item's ``args``, ``kwds``, ``exception`` flag and
+    a ``(batch requestID, index)`` ``requestID``.
+
+    """
+
+    def __init__(self, callable_, args_list, requestID=None, callback=None,
+            exc_callback=_handle_thread_exception, priority=0,
+            deadline=None, timeout=None):
+        """``args_list`` items are given as for ``makeRequests``."""
+        WorkRequest.__init__(self, self._runItems, None, None, requestID,
+            callback, exc_callback, priority, deadline, timeout)
+        self.itemCallable = callable_
+        self.items = [_splitArgs(item) for item in args_list]
+
+    def __str__(self):
+        return "<BatchWorkRequest id=%s items=%d exception=%s>" % \
+            (self.requestID, len(self.items), self.exception)
+
+    def _runItems(self):
+        return _runBatch(self.itemCallable, self.items)
+
+    def _handleResult(self, result):
+        if self.exception:
+            # the batch as a whole failed, e.g. it expired before it ran
+            result = [(True, result)] * len(self.items)
+        for index, ((args, kwds), (failed, value)) in \
+                enumerate(zip(self.items, result)):
+            _invokeCallbacks(_BatchItem(self, index, args, kwds, failed),
+                value)
+
+
+class _BatchItem(object):
+    """Stand-in for a ``WorkRequest`` when the callbacks of a batch item
+    are invoked."""
+
+    __slots__ = ('batch', 'requestID', 'args', 'kwds', 'exception',
+        'callback', 'exc_callback')
+
+    def __init__(self, batch, index, args, kwds, exception):
+        self.batch = batch
+        self.requestID = (batch.requestID, index)
+        self.args = args
+        self.kwds = kwds or {}
+        self.exception = exception
+        self.callback = batch.callback
+        self.exc_callback = batch.exc_callback
+
+    def __str__(self):
+        return "<WorkRequest id=%s args=%r kwargs=%r exception=%s>" % \
+            (self.requestID, self.args, self.kwds, self.exception)
+
 class ThreadPool:
     """A thread pool, distributing work requests and collecting results.
 
@@ -228,7 +1067,10 @@ class ThreadPool:
 
     """
 
-    def __init__(self, num_workers, q_size=0, resq_size=0, poll_timeout=5):
+    def __init__(self, num_workers, q_size=0, resq_size=0, poll_timeout=5,
+            drop_expired=False, initializer=None, finalizer=None,
+            work_stealing=False, collect_stats=False, collector=False,
+            max_inflight=None):
         """Set up the thread pool and start num_workers worker threads.
 
         ``num_workers`` is the number of worker threads to start initially.
@@ -247,59 +1089,345 @@ class ThreadPool:
             the possibilty of a deadlock, when the results queue is not pulled
             regularly and too many jobs are put in the work requests queue.
             To prevent this, always set ``timeout > 0`` when calling
-            ``ThreadPool.putRequest()`` and catch ``Queue.Full`` exceptions.
+            ``ThreadPool.putRequest()`` and catch ``Queue.Full`` exceptions,
+            or use the ``collector`` mode.
+
+        With ``collector`` a ``ResultCollector`` thread drains the results
+        queue as they come in and invokes the callbacks, so results never
+        pile up and ``poll`` just reports the progress. Callbacks then run
+        on the collector thread; requests they put are queued by the
+        collector between results, it never blocks on a full request queue.
+
+        ``max_inflight`` limits the number of requests put but not yet
+        collected (or done, for ``submit``): ``putRequest`` blocks until one
+        is, which bounds the memory used by both queues. Without a collector
+        the blocked ``putRequest`` collects results itself, invoking their
+        callbacks on the calling thread.
+
+        Work requests are dispatched by priority and deadline (see
+        ``WorkRequest``). If ``drop_expired`` is true, requests whose deadline
+        passed while queued are discarded without invoking any callback,
+        otherwise their ``exc_callback`` receives a ``RequestExpired`` error.
+
+        ``initializer`` and ``finalizer`` are called with the worker thread
+        when each worker starts and exits (see ``WorkerThread``). Resources
+        which should live as long as a worker, like database connections,
+        are best obtained with ``workerResource``.
+
+        With ``work_stealing`` each worker gets its own request deque and
+        idle workers steal from the others (see ``WorkStealingQueue``), which
+        avoids contention on a single queue lock with many workers and high
+        request rates. Only the dispatch gets cheaper, so it pays off for
+        tiny requests (see ``benchmark.py dispatch`` and ``stealing``).
+        ``q_size`` and request priorities are ignored then.
+
+        With ``collect_stats`` the latencies of all processed requests are
+        recorded in a ``PoolStats`` object (see ``stats``). That costs a few
+        microseconds per request, over 10% of the time the pool spends on a
+        tiny one (``benchmark.py stats``), so it is off by default.
 
         """
-        self._requests_queue = Queue.Queue(q_size)
+        if work_stealing:
+            self._requests_queue = WorkStealingQueue()
+        else:
+            self._requests_queue = PriorityRequestQueue(q_size)
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._wait_times = collections.deque(maxlen=1024)
+        self._stats = collect_stats and PoolStats() or None
+        self.max_inflight = max_inflight
+        self._inflight = 0
+        self._collected = threading.Condition()
+        self._workers_lock = threading.RLock()
+        self.drop_expired = drop_expired
+        self.autoscaler = None
+        self.statsReporter = None
+        self.watchdog = None
         self._results_queue = Queue.Queue(resq_size)
         self.workers = []
         self.dismissedWorkers = []
+        self._dismissals = []
         self.workRequests = {}
+        self.collector = None
         self.createWorkers(num_workers, poll_timeout)
+        if collector:
+            self.collector = ResultCollector(self)
 
     def createWorkers(self, num_workers, poll_timeout=5):
         """Add num_workers worker threads to the pool.
 
-        ``poll_timout`` sets the interval in seconds (int or float) for how
-        ofte threads should check whether they are dismissed, while waiting for
-        requests.
+        ``poll_timeout`` is ignored and only kept for backwards compatibility.
 
         """
-        for i in range(num_workers):
-            self.workers.append(WorkerThread(self._requests_queue,
-                self._results_queue, poll_timeout=poll_timeout))
+        with self._workers_lock:
+            for i in range(num_workers):
+                self.workers.append(WorkerThread(self._requests_queue,
+                    self._results_queue, poll_timeout=poll_timeout,
+                    wait_times=self._wait_times, stats=self._stats,
+                    initializer=self._initializer,
+                    finalizer=self._finalizer))
 
     def dismissWorkers(self, num_workers, do_join=False):
-        """Tell num_workers worker threads to quit after their current task."""
-        dismiss_list = []
-        for i in range(min(num_workers, len(self.workers))):
-            worker = self.workers.pop()
-            worker.dismiss()
-            dismiss_list.append(worker)
+        """Tell num_workers worker threads to quit.
+
+        A dismissal sentinel is queued ahead of all work requests for each
+        thread to dismiss, so idle threads quit immediately and busy ones
+        after their current task, whichever gets to a sentinel first. A
+        thread is removed from ``workers`` when it picked up its sentinel.
+
+        """
+        with self._workers_lock:
+            num_workers = min(num_workers,
+                len(self.workers) - len(self._dismissals))
+            dismissals = [_Dismissal(self._workerDismissed)
+                for i in range(num_workers)]
+            self._dismissals.extend(dismissals)
+        for dismissal in dismissals:
+            self._requests_queue.putSentinel(dismissal)
 
         if do_join:
-            for worker in dismiss_list:
-                worker.join()
-        else:
-            self.dismissedWorkers.extend(dismiss_list)
+            for dismissal in dismissals:
+                dismissal.claimed.wait()
+                dismissal.worker.join()
+
+    def _workerDismissed(self, dismissal):
+        """Called by a worker thread when it picked up a dismissal sentinel."""
+        with self._workers_lock:
+            self._dismissals.remove(dismissal)
+            self.workers.remove(dismissal.worker)
+            self.dismissedWorkers.append(dismissal.worker)
+
+    def workerCount(self):
+        """Return the number of worker threads not told to quit yet."""
+        with self._workers_lock:
+            return len(self.workers) - len(self._dismissals)
 
     def joinAllDismissedWorkers(self):
         """Perform Thread.join() on all worker threads that have been dismissed.
         """
-        for worker in self.dismissedWorkers:
+        for dismissal in list(self._dismissals):
+            dismissal.claimed.wait()
+        with self._workers_lock:
+            dismissed, self.dismissedWorkers = self.dismissedWorkers, []
+        for worker in dismissed:
             worker.join()
-        self.dismissedWorkers = []
 
     def putRequest(self, request, block=True, timeout=None):
-        """Put work request into work queue and save its id for later."""
+        """Put work request into work queue and save its id for later.
+
+        Returns a ``WorkFuture`` for the result of the request. With
+        ``max_inflight`` set, ``block`` and ``timeout`` also apply to waiting
+        for an in-flight slot; ``Queue.Full`` is raised if none got free.
+
+        """
         assert isinstance(request, WorkRequest)
         # don't reuse old work requests
         assert not getattr(request, 'exception', None)
-        self._requests_queue.put(request, block, timeout)
-        self.workRequests[request.requestID] = request
+        request.future = WorkFuture(request)
+        if request.timeout is not None and self.watchdog is None:
+            with self._workers_lock:
+                if self.watchdog is None:
+                    self.watchdog = Watchdog(self)
+        self._acquire(request, block, timeout)
+        request.enqueued = time.time()
+        if self.collector is not None and \
+                threading.currentThread() is self.collector:
+            # put from a callback, the collector must not wait for itself
+            self.collector.defer(request)
+            return request.future
+        try:
+            self._requests_queue.put(request, block, timeout)
+        except Queue.Full:
+            self._release(request)
+            raise
+        return request.future
+
+    def _acquire(self, request, block, timeout):
+        """Register a request as in flight, waiting for a free slot if
+        ``max_inflight`` is reached."""
+        if timeout is not None:
+            end_time = time.time() + timeout
+        in_collector = threading.currentThread() is self.collector
+        while True:
+            with self._collected:
+                if not self.max_inflight or in_collector or \
+                        self._inflight < self.max_inflight:
+                    self._inflight += 1
+                    if request.detached:
+                        request.future.add_done_callback(
+                            lambda future: self._release(future.request))
+                    else:
+                        self.workRequests[request.requestID] = request
+                    return
+                remaining = None
+                if timeout is not None:
+                    remaining = end_time - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Queue.Full
+                if self.collector is not None or not self.workRequests:
+                    # wait for the collector or for a ``submit`` request
+                    self._collected.wait(remaining)
+                    continue
+            # nobody else collects the results, make room ourselves
+            self._collectOne(remaining)
+
+    def _release(self, request):
+        with self._collected:
+            self._inflight -= 1
+            self.workRequests.pop(request.requestID, None)
+            self._collected.notify_all()
+
+    def _collect(self, request, result):
+        """Hand a result from the results queue to the request's callbacks.
+        """
+        request.collected = time.time()
+        if self._stats is not None:
+            self._stats.recordCollected(request)
+        try:
+            if not (_cancelled(request) or
+                    (request.expired and self.drop_expired)):
+                request._handleResult(result)
+        finally:
+            self._release(request)
+
+    def _collectOne(self, timeout=None):
+        """Collect the next result, waiting at most ``timeout`` seconds."""
+        try:
+            request, result = self._results_queue.get(True, timeout)
+        except Queue.Empty:
+            return
+        self._collect(request, result)
+
+    def submit(self, callable_, *args, **kwds):
+        """Schedule ``callable_(*args, **kwds)`` and return its ``WorkFuture``.
+
+        Unlike requests passed to ``putRequest``, the request is not tracked
+        by the pool: its result is only available through the future and
+        ``poll``/``wait`` don't see it.
+
+        """
+        request = WorkRequest(callable_, args, kwds, exc_callback=None)
+        request.detached = True
+        return self.putRequest(request)
+
+    def map(self, callable_, args_list, max_inflight=None, ordered=True,
+            chunksize=1):
+        """Call ``callable_`` for each item of ``args_list`` in the pool and
+        iterate over the results.
+
+        The items are handled like those of ``makeRequests``. ``args_list``
+        may be any iterable, it is consumed lazily so that at most
+        ``max_inflight`` requests (default twice the number of workers) are
+        queued or running at any time. Results come in the order of
+        ``args_list``, or as they complete if ``ordered`` is false. An
+        exception raised by the callable is raised when its result is
+        reached.
+
+        With ``chunksize > 1`` the items are sent to the workers in batches
+        (see ``BatchWorkRequest``) and ``max_inflight`` counts batches.
+
+        """
+        if chunksize > 1:
+            batches = self.map(_runBatch, _chunks(callable_, args_list,
+                chunksize), max_inflight, ordered)
+            for batch_results in batches:
+                for failed, value in batch_results:
+                    if failed:
+                        _reraise(*value)
+                    yield value
+            return
+        if max_inflight is None:
+            max_inflight = 2 * max(self.workerCount(), 1)
+        if ordered:
+            pending = collections.deque()
+            for item in args_list:
+                if len(pending) >= max_inflight:
+                    yield pending.popleft().result()
+                args, kwds = _splitArgs(item)
+                pending.append(self.submit(callable_, *args, **(kwds or {})))
+            while pending:
+                yield pending.popleft().result()
+        else:
+            done_queue = Queue.Queue()
+            inflight = 0
+            for item in args_list:
+                if inflight >= max_inflight:
+                    yield done_queue.get().result()
+                    inflight -= 1
+                args, kwds = _splitArgs(item)
+                self.submit(callable_, *args, **(kwds or {})
+                    ).add_done_callback(done_queue.put)
+                inflight += 1
+            while inflight:
+                yield done_queue.get().result()
+                inflight -= 1
+
+    def startAutoscaler(self, min_workers, max_workers, **kwds):
+        """Let an ``AutoScaler`` thread resize the pool from now on.
+
+        Keyword arguments are passed on to ``AutoScaler``. Returns the
+        autoscaler, which is also available as the ``autoscaler`` attribute.
+
+        """
+        self.stopAutoscaler()
+        self.autoscaler = AutoScaler(self, min_workers, max_workers, **kwds)
+        return self.autoscaler
+
+    def startWatchdog(self, interval=0.1, replace_stuck=False, **kwds):
+        """Let a ``Watchdog`` thread enforce the request timeouts from now on.
+
+        A watchdog with the default settings is started by ``putRequest``
+        for the first request with a ``timeout``. With ``replace_stuck``, a
+        worker whose request timed out is replaced by a new one (see
+        ``Watchdog``). Returns the watchdog, which is also available as the
+        ``watchdog`` attribute.
+
+        """
+        self.stopWatchdog()
+        self.watchdog = Watchdog(self, interval, replace_stuck, **kwds)
+        return self.watchdog
+
+    def stopWatchdog(self):
+        """Stop enforcing the request timeouts."""
+        if self.watchdog is not None:
+            self.watchdog.dismiss()
+            self.watchdog.join()
+            self.watchdog = None
+
+    def _replaceWorker(self, worker):
+        """Take a stuck worker out of the pool and start a new one instead.
+        The stuck thread exits as soon as its callable returns."""
+        with self._workers_lock:
+            if worker not in self.workers:
+                return False
+            self.workers.remove(worker)
+            worker.dismiss()
+            self.createWorkers(1)
+        return True
+
+    def stopAutoscaler(self):
+        """Stop resizing the pool automatically, keeping its current size."""
+        if self.autoscaler is not None:
+            self.autoscaler.dismiss()
+            self.autoscaler.join()
+            self.autoscaler = None
 
     def poll(self, block=False):
-        """Process any new results in the queue."""
+        """Process any new results in the queue.
+
+        In ``collector`` mode the results are processed by the collector
+        thread; ``poll(True)`` waits until it processed at least one.
+
+        """
+        if self.collector is not None:
+            with self._collected:
+                if not self.workRequests:
+                    raise NoResultsPending
+                elif block and not self.workers:
+                    raise NoWorkersAvailable
+                elif block:
+                    self._collected.wait()
+            return
         while True:
             # still results pending?
             if not self.workRequests:
@@ -310,19 +1438,64 @@ class ThreadPool:
             try:
                 # get back next results
                 request, result = self._results_queue.get(block=block)
-                # has an exception occured?
-                if request.exception and request.exc_callback:
-                    request.exc_callback(request, result)
-                # hand results to callback, if any
-                if request.callback and not \
-                       (request.exception and request.exc_callback):
-                    request.callback(request, result)
-                del self.workRequests[request.requestID]
+                self._collect(request, result)
             except Queue.Empty:
                 break
 
+    def queueDepth(self):
+        """Return the number of queued work requests per priority level."""
+        return self._requests_queue.depthByPriority()
+
+    def stats(self):
+        """Return a snapshot of the pool's state and request latencies.
+
+        The dict has the number of ``workers``, ``busy`` workers, ``queued``
+        requests and requests whose results are ``pending`` collection by
+        ``poll``. ``callables`` is the ``PoolStats.snapshot()`` of the
+        processed requests, empty if the pool doesn't collect statistics.
+
+        """
+        with self._workers_lock:
+            busy = len([w for w in self.workers if w.busy])
+        return {'workers': self.workerCount(), 'busy': busy,
+            'queued': self._requests_queue.qsize(),
+            'pending': len(self.workRequests),
+            'callables': self._stats and self._stats.snapshot() or {}}
+
+    def startStatsReporter(self, interval=60, **kwds):
+        """Log the pool's ``stats()`` every ``interval`` seconds from now on.
+        The latencies are only reported for a pool created with
+        ``collect_stats=True``.
+
+        Keyword arguments are passed on to ``StatsReporter``. Returns the
+        reporter, which is also available as the ``statsReporter`` attribute.
+
+        """
+        self.stopStatsReporter()
+        self.statsReporter = StatsReporter(self, interval, **kwds)
+        return self.statsReporter
+
+    def stopStatsReporter(self):
+        """Stop logging the pool's statistics."""
+        if self.statsReporter is not None:
+            self.statsReporter.dismiss()
+            self.statsReporter.join()
+            self.statsReporter = None
+
     def wait(self):
-        """Wait for results, blocking until all have arrived."""
+        """Wait for results, blocking until all have arrived.
+
+        In ``collector`` mode this waits until no request is in flight,
+        including those from ``submit``.
+
+        """
+        if self.collector is not None:
+            with self._collected:
+                while self._inflight:
+                    if not self.workers:
+                        raise NoWorkersAvailable
+                    self._collected.wait(1)
+            return
         while 1:
             try:
                 self.poll(True)
@@ -330,6 +1503,273 @@ class ThreadPool:
                 break
 
 
+class AutoScaler(threading.Thread):
+    """Background thread growing and shrinking a ``ThreadPool``.
+
+    Every ``interval`` seconds the autoscaler looks at the queue latency,
+    i.e. the longer of the mean time requests waited in the queue since the
+    last check and the age of the oldest request still queued. If it is
+    above ``target_wait`` seconds, up to ``step`` workers are added; workers
+    which have been idle for more than ``idle_timeout`` seconds are
+    dismissed one per check. The pool size is kept within
+    ``min_workers``..``max_workers``.
+
+    The figures of the last check are available through ``status()``.
+
+    """
+
+    def __init__(self, pool, min_workers, max_workers, target_wait=0.5,
+            idle_timeout=30, interval=1, step=1, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.setDaemon(1)
+        if not 0 <= min_workers <= max_workers:
+            raise ValueError("need 0 <= min_workers <= max_workers")
+        self.pool = pool
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_wait = target_wait
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.step = step
+        self._dismissed = threading.Event()
+        self._status = {'size': pool.workerCount(), 'queued': 0,
+            'queue_latency': 0.0, 'utilization': 0.0}
+        self.start()
+
+    def status(self):
+        """Return a dict with the pool ``size``, the number of ``queued``
+        requests, the ``queue_latency`` in seconds and the ``utilization``
+        (busy workers / workers) as of the last check.
+        """
+        return dict(self._status)
+
+    def _queueLatency(self):
+        waits = self.pool._wait_times
+        samples = []
+        while waits:
+            try:
+                samples.append(waits.popleft())
+            except IndexError:
+                break
+        latency = sum(samples) / len(samples) if samples else 0.0
+        enqueued = self.pool._requests_queue.enqueuedTimes()
+        if enqueued:
+            latency = max(latency, time.time() - min(enqueued))
+        return latency, len(enqueued)
+
+    def check(self):
+        """Resize the pool once according to the current load."""
+        pool = self.pool
+        latency, queued = self._queueLatency()
+        now = time.time()
+        with pool._workers_lock:
+            workers = list(pool.workers)
+            size = len(workers) - len(pool._dismissals)
+        busy = len([w for w in workers if w.busy])
+
+        if size < self.min_workers:
+            pool.createWorkers(self.min_workers - size)
+        elif latency > self.target_wait and size < self.max_workers:
+            pool.createWorkers(min(self.step, self.max_workers - size))
+        elif size > self.min_workers and not queued and [w for w in workers
+                if not w.busy and now - w.idleSince > self.idle_timeout]:
+            pool.dismissWorkers(1)
+        # count again, the branches above (or the pool's owner) resized it
+        excess = pool.workerCount() - self.max_workers
+        if excess > 0:
+            pool.dismissWorkers(excess)
+
+        self._status = {'size': pool.workerCount(), 'queued': queued,
+            'queue_latency': latency,
+            'utilization': float(busy) / size if size else 0.0}
+
+    def run(self):
+        while not self._dismissed.isSet():
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+            self._dismissed.wait(self.interval)
+
+    def dismiss(self):
+        """Stop the autoscaler after its current check."""
+        self._dismissed.set()
+
+
+class Watchdog(threading.Thread):
+    """Background thread failing the work requests which run too long.
+
+    Every ``interval`` seconds it looks at the requests the workers of a
+    ``ThreadPool`` are running. A request running for longer than its
+    ``timeout`` is marked with ``timedOut``, failed with a ``RequestTimedOut``
+    error (its future raises it and ``exc_callback`` gets it from ``poll``)
+    and the result its callable eventually returns is dropped.
+
+    Python threads can't be killed, so the worker stays busy until the
+    callable returns. With ``replace_stuck`` the worker is taken out of the
+    pool and replaced by a new thread at once, so a hanging call (e.g. a
+    database query without a timeout) doesn't cost pool capacity; the old
+    thread exits when the call returns, if ever.
+
+    """
+
+    def __init__(self, pool, interval=0.1, replace_stuck=False, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.setDaemon(1)
+        self.pool = pool
+        self.interval = interval
+        self.replace_stuck = replace_stuck
+        self.timedOut = 0
+        self.replaced = 0
+        self._dismissed = threading.Event()
+        self.start()
+
+    def check(self):
+        """Fail the requests which exceeded their timeout once."""
+        pool = self.pool
+        with pool._workers_lock:
+            workers = list(pool.workers)
+        now = time.time()
+        for worker in workers:
+            request = worker.current
+            if request is None or request.timeout is None or \
+                    request.timedOut or request._doneClaims or \
+                    now - request.started <= request.timeout:
+                # the worker stays on a timed out request until it returns
+                continue
+            if not _claimFirst(request._doneClaims, self):
+                # just finished
+                continue
+            request.timedOut = True
+            worker._deliver(request, _excInfo(RequestTimedOut,
+                "request %s still running after %.3fs" % (request.requestID,
+                now - request.started)), exception=True, claimant=self)
+            self.timedOut += 1
+            if self.replace_stuck and pool._replaceWorker(worker):
+                self.replaced += 1
+
+    def run(self):
+        while not self._dismissed.isSet():
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+            self._dismissed.wait(self.interval)
+
+    def dismiss(self):
+        """Stop the watchdog after its current check."""
+        self._dismissed.set()
+
+
+class ResultCollector(threading.Thread):
+    """Background thread collecting the results of a ``ThreadPool``.
+
+    It takes the results from the pool's results queue as soon as they
+    arrive and invokes the callbacks of their requests, so the workers never
+    block on a full results queue. Requests put by the callbacks are queued
+    by the collector itself between results (see ``defer``).
+
+    """
+
+    def __init__(self, pool, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.setDaemon(1)
+        self.pool = pool
+        self._deferred = collections.deque()
+        self.start()
+
+    def defer(self, request):
+        """Queue ``request`` as soon as there is room in the request queue.
+        """
+        self._deferred.append(request)
+
+    def _flushDeferred(self):
+        while self._deferred:
+            try:
+                self.pool._requests_queue.put(self._deferred[0], False)
+            except Queue.Full:
+                break
+            self._deferred.popleft()
+
+    def run(self):
+        pool = self.pool
+        while True:
+            self._flushDeferred()
+            try:
+                # while requests are deferred, check regularly for room
+                item = pool._results_queue.get(True,
+                    self._deferred and 0.01 or None)
+            except Queue.Empty:
+                continue
+            if item is None:
+                break
+            try:
+                pool._collect(*item)
+            except Exception:
+                traceback.print_exc()
+
+    def dismiss(self):
+        """Stop the collector after the results queued so far."""
+        self.pool._results_queue.put(None)
+
+
+class StatsReporter(threading.Thread):
+    """Background thread logging the ``stats()`` of a ``ThreadPool``.
+
+    Every ``interval`` seconds one line with the pool state and one line per
+    callable with its counts and the median and 99th percentile of each
+    phase are logged with ``level`` to ``logger`` (default: this module's
+    logger). With ``reset`` the statistics are cleared after each report, so
+    every report covers only the last interval.
+
+    """
+
+    def __init__(self, pool, interval=60, logger=None, level=logging.INFO,
+            reset=False, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.setDaemon(1)
+        self.pool = pool
+        self.interval = interval
+        self.logger = logger or LOGGER
+        self.level = level
+        self.reset = reset
+        self._dismissed = threading.Event()
+        self.start()
+
+    def report(self):
+        """Log the pool's statistics once."""
+        stats = self.pool.stats()
+        if self.reset and self.pool._stats is not None:
+            self.pool._stats.reset()
+        self.logger.log(self.level, "threadpool: workers=%d busy=%d "
+            "queued=%d pending=%d", stats['workers'], stats['busy'],
+            stats['queued'], stats['pending'])
+        for name, entry in sorted(stats['callables'].items()):
+            phases = []
+            for phase in PoolStats.PHASES:
+                summary = entry[phase]
+                if summary['samples']:
+                    phases.append("%s p50=%.4fs p99=%.4fs" % (phase,
+                        summary['p50'], summary['p99']))
+            self.logger.log(self.level, "threadpool: %s count=%d failures=%d "
+                "expired=%d %s", name, entry['count'], entry['failures'],
+                entry['expired'], ' '.join(phases))
+
+    def run(self):
+        while True:
+            self._dismissed.wait(self.interval)
+            if self._dismissed.isSet():
+                break
+            try:
+                self.report()
+            except Exception:
+                traceback.print_exc()
+
+    def dismiss(self):
+        """Stop the reporter, without a final report."""
+        self._dismissed.set()
+
+
 ################
 # USAGE EXAMPLE
 ################
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Per-instance binlog position <-> time index, persisted on disk.
+
+For every binlog file the index keeps its first/last event timestamp and a
+sparse list of (timestamp, position) samples. Only binlogs which are new or
+have grown since the last refresh are scanned, so answering "which
+file/position corresponds to time T" is two bisections over the cached
+data and doesn't touch the server for files already indexed.
+
+Typical usage::
+
+    db = MySQLInstance("10.0.0.1:3306", "test", "root", "")
+    index = BinlogTimeIndex(db)
+    index.refresh()
+    print index.lookup("2017-03-01 12:00:00")   # ('mysql-bin.000042', 1073741)
+
+Event timestamps are the start time of the statement, so they are only
+roughly increasing inside a binlog: lookup() returns the sample at or before
+T, which is a safe place to start reading from, not the exact event.
+'''
+
+import bisect
+import json
+import logging
+import os
+import tempfile
+import time
+
+import binlog_parser
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = "/tmp/binlog_index"
+
+
+def _to_timestamp(timestamp):
+    if isinstance(timestamp, basestring):
+        return int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')))
+    return int(timestamp)
+
+
+class BinlogTimeIndex(object):
+
+    def __init__(self, instance, cache_dir=DEFAULT_CACHE_DIR, sample_every=1000, batch_size=1000):
+        '''
+            params:
+                instance: DBHandler.MySQLInstance of the server whose binlogs are indexed
+                cache_dir: where the index files are kept, one json file per instance
+                sample_every: keep one (timestamp, position) sample per this many events
+                batch_size: events fetched per SHOW BINLOG EVENTS round trip
+        '''
+        self.instance = instance
+        self.sample_every = sample_every
+        self.batch_size = batch_size
+        self.path = os.path.join(cache_dir, "%s.json" % instance.host.replace("/", "_").replace(":", "_"))
+        # {log_name: {"size", "first_ts", "last_ts", "next_pos", "pending", "samples": [[ts, pos], ...]}}
+        self.files = {}
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as fp:
+                    self.files = json.load(fp).get("files", {})
+            except (IOError, ValueError), e:
+                LOGGER.warning("ignore broken binlog index %s: %s" % (self.path, e))
+                self.files = {}
+        self._build_keys()
+
+    def _build_keys(self):
+        '''sorted keys bisected by lookup, rebuilt whenever self.files changes'''
+        self._log_names = [name for name in self.log_names if self.files[name]["first_ts"] is not None]
+        self._first_times = [self.files[name]["first_ts"] for name in self._log_names]
+        self._sample_times = dict((name, [ts for ts, _ in self.files[name]["samples"]])
+                                  for name in self._log_names)
+
+    def save(self):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write aside then rename, so readers never see a half written index
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".binlog_index")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"host": self.instance.host, "files": self.files}, fp)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    @property
+    def log_names(self):
+        return sorted(self.files)
+
+    def refresh(self):
+        '''Index the binlogs which appeared or grew since the last refresh,
+            forget the purged ones and persist the result.
+            returns:
+                names of the binlogs (re)scanned
+        '''
+        binlog_list = self.instance.get_binlog_list()
+        alive = set(each["Log_name"] for each in binlog_list)
+        purged = False
+        for log_name in list(self.files):
+            if log_name not in alive:
+                del self.files[log_name]
+                purged = True
+
+        scanned = []
+        for each in binlog_list:
+            log_name, size = each["Log_name"], int(each["File_size"])
+            entry = self.files.get(log_name)
+            if entry is not None and entry["size"] == size:
+                continue
+            if entry is None or entry["size"] > size:
+                entry = self.files[log_name] = {"size": 0, "first_ts": None, "last_ts": None,
+                                                "next_pos": 4, "pending": 0, "samples": []}
+            self._scan(log_name, entry)
+            entry["size"] = size
+            scanned.append(log_name)
+        if scanned:
+            self.save()
+        if scanned or purged:
+            self._build_keys()
+        return scanned
+
+    def _iter_event_times(self, log_name, start_pos):
+        '''yield (timestamp or None, pos, next_pos); timestamps are only read for
+            the events which end up in the index when they have to come from the server
+        '''
+        log_dir = self.instance.binlog_dir
+        if log_dir and os.path.isfile(os.path.join(log_dir, log_name)):
+            for header in binlog_parser.iter_binlog_file(os.path.join(log_dir, log_name), start_pos):
+                yield header.timestamp, header.position, header.position + header.event_length
+            return
+        for event in self.instance.iter_binlog_events(log_name, start_pos, stop_file=log_name,
+                                                      batch_size=self.batch_size):
+            yield None, event["Pos"], event["End_log_pos"]
+
+    def _scan(self, log_name, entry):
+        # the sampled events come in file order, so remote timestamps are
+        # read on by one binlog dump instead of a dump per sample
+        with self.instance.binlog_scan():
+            last = None
+            for ts, pos, next_pos in self._iter_event_times(log_name, entry["next_pos"]):
+                need_sample = entry["first_ts"] is None or entry["pending"] >= self.sample_every
+                if need_sample:
+                    if ts is None:
+                        ts = self.instance.get_binlog_event_time(log_name, pos, next_pos)
+                    if entry["first_ts"] is None:
+                        entry["first_ts"] = ts
+                    entry["samples"].append([ts, pos])
+                    entry["pending"] = 0
+                entry["pending"] += 1
+                last = (ts, pos, next_pos)
+            if last is None:
+                return
+            ts, pos, entry["next_pos"] = last
+            if ts is None:
+                ts = self.instance.get_binlog_event_time(log_name, pos, entry["next_pos"])
+            entry["last_ts"] = ts
+
+    def lookup(self, timestamp, refresh=False):
+        '''Find where to start reading the binlogs to get the events from `timestamp` on
+
+            params:
+                timestamp: unix timestamp or '%Y-%m-%d %H:%M:%S' string
+                refresh: index new binlogs first
+            returns:
+                (log_name, pos) of the closest sample at or before `timestamp`,
+                None if `timestamp` is earlier than all the binlogs
+        '''
+        if refresh:
+            self.refresh()
+        timestamp = _to_timestamp(timestamp)
+        idx = bisect.bisect_right(self._first_times, timestamp)
+        if idx == 0:
+            return None
+        log_name = self._log_names[idx - 1]
+        pos_idx = bisect.bisect_right(self._sample_times[log_name], timestamp)
+        return log_name, self.files[log_name]["samples"][max(pos_idx - 1, 0)][1]
+
+    def time_range(self, log_name):
+        '''returns: (first_ts, last_ts) of an indexed binlog, None if not indexed'''
+        entry = self.files.get(log_name)
+        return (entry["first_ts"], entry["last_ts"]) if entry else None
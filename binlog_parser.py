@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Minimal reader of the MySQL binlog (v4) event header, enough to get
+timestamps, event types and positions without spawning mysqlbinlog.
+
+Every event starts with a 19 bytes little-endian header:
+
+    timestamp      4   seconds since epoch when the statement began
+    type_code      1   see EVENT_TYPES
+    server_id      4
+    event_length   4   header + body (+ checksum)
+    next_position  4   offset of the next event in the file (0 for fake events)
+    flags          2
+
+Typical usage::
+
+    for header in iter_binlog_file("/u01/my3306/log/mysql-bin.000001"):
+        print header.position, header.type_name, header.timestamp
+
+    print binlog_file_start_time("/u01/my3306/log/mysql-bin.000001")
+'''
+
+import logging
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+BINLOG_MAGIC = b'\xfebin'
+EVENT_HEADER_LEN = 19
+EVENT_HEADER_FMT = '<IBIIIH'
+
+# set on events the server fakes while dumping (e.g. the leading rotate event)
+LOG_EVENT_ARTIFICIAL_F = 0x20
+
+COM_BINLOG_DUMP = 0x12
+BINLOG_DUMP_NON_BLOCK = 0x01
+
+# servers before 5.6 have no @@binlog_checksum
+ER_UNKNOWN_SYSTEM_VARIABLE = 1193
+
+EVENT_TYPES = {
+    0: 'UNKNOWN_EVENT',
+    1: 'START_EVENT_V3',
+    2: 'QUERY_EVENT',
+    3: 'STOP_EVENT',
+    4: 'ROTATE_EVENT',
+    5: 'INTVAR_EVENT',
+    6: 'LOAD_EVENT',
+    7: 'SLAVE_EVENT',
+    8: 'CREATE_FILE_EVENT',
+    9: 'APPEND_BLOCK_EVENT',
+    10: 'EXEC_LOAD_EVENT',
+    11: 'DELETE_FILE_EVENT',
+    12: 'NEW_LOAD_EVENT',
+    13: 'RAND_EVENT',
+    14: 'USER_VAR_EVENT',
+    15: 'FORMAT_DESCRIPTION_EVENT',
+    16: 'XID_EVENT',
+    17: 'BEGIN_LOAD_QUERY_EVENT',
+    18: 'EXECUTE_LOAD_QUERY_EVENT',
+    19: 'TABLE_MAP_EVENT',
+    20: 'PRE_GA_WRITE_ROWS_EVENT',
+    21: 'PRE_GA_UPDATE_ROWS_EVENT',
+    22: 'PRE_GA_DELETE_ROWS_EVENT',
+    23: 'WRITE_ROWS_EVENT_V1',
+    24: 'UPDATE_ROWS_EVENT_V1',
+    25: 'DELETE_ROWS_EVENT_V1',
+    26: 'INCIDENT_EVENT',
+    27: 'HEARTBEAT_LOG_EVENT',
+    28: 'IGNORABLE_LOG_EVENT',
+    29: 'ROWS_QUERY_LOG_EVENT',
+    30: 'WRITE_ROWS_EVENT',
+    31: 'UPDATE_ROWS_EVENT',
+    32: 'DELETE_ROWS_EVENT',
+    33: 'GTID_LOG_EVENT',
+    34: 'ANONYMOUS_GTID_LOG_EVENT',
+    35: 'PREVIOUS_GTIDS_LOG_EVENT',
+    36: 'TRANSACTION_CONTEXT_EVENT',
+    37: 'VIEW_CHANGE_EVENT',
+    38: 'XA_PREPARE_LOG_EVENT',
+}
+
+
+class BinlogFormatError(Exception):
+    pass
+
+
+class EventHeader(namedtuple('EventHeader', ['position', 'timestamp', 'type_code', 'server_id',
+                                             'event_length', 'next_position', 'flags'])):
+    __slots__ = ()
+
+    @property
+    def type_name(self):
+        return EVENT_TYPES.get(self.type_code, 'UNKNOWN_EVENT')
+
+    @property
+    def is_artificial(self):
+        return bool(self.flags & LOG_EVENT_ARTIFICIAL_F) or self.next_position == 0
+
+
+def parse_event_header(buf, offset=0, position=None):
+    '''Parse the event header found at `offset` of `buf` (str/bytes/mmap)
+
+        params:
+            position: binlog position of the event, default is `offset`
+        returns:
+            EventHeader
+    '''
+    if len(buf) - offset < EVENT_HEADER_LEN:
+        raise BinlogFormatError("truncated event header at %s" % offset)
+    fields = struct.unpack_from(EVENT_HEADER_FMT, buf, offset)
+    return EventHeader(offset if position is None else position, *fields)
+
+
+def iter_event_headers(buf, start_pos=4, stop_pos=None):
+    '''Yield the headers of the events in a binlog image, skipping the bodies.
+        An event that is only partially written (the active binlog) ends the scan.
+    '''
+    if buf[:4] != BINLOG_MAGIC:
+        raise BinlogFormatError("not a binlog file, bad magic number")
+    end = len(buf) if stop_pos is None else min(stop_pos, len(buf))
+    offset = start_pos
+    while offset + EVENT_HEADER_LEN <= end:
+        header = parse_event_header(buf, offset)
+        if header.event_length < EVENT_HEADER_LEN:
+            raise BinlogFormatError("bad event length %s at %s" % (header.event_length, offset))
+        if offset + header.event_length > len(buf):
+            break
+        yield header
+        offset += header.event_length
+
+
+def iter_binlog_file(path, start_pos=4, stop_pos=None):
+    '''Yield the event headers of a local binlog file, mapped with mmap so
+        only the pages holding headers are actually read.
+    '''
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < len(BINLOG_MAGIC):
+            raise BinlogFormatError("%s is too short to be a binlog" % path)
+        mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            for header in iter_event_headers(mm, start_pos, stop_pos):
+                yield header
+        finally:
+            mm.close()
+
+
+def read_event_header(path, pos=4):
+    '''Read the single event header at `pos` of a local binlog file'''
+    with open(path, 'rb') as fp:
+        if fp.read(4) != BINLOG_MAGIC:
+            raise BinlogFormatError("%s is not a binlog file, bad magic number" % path)
+        fp.seek(pos)
+        return parse_event_header(fp.read(EVENT_HEADER_LEN), position=pos)
+
+
+def binlog_file_start_time(path):
+    '''Timestamp of the first event (the format description event) of a binlog'''
+    return read_event_header(path, 4).timestamp
+
+
+def _start_dump(raw_conn, log_file, pos, server_id=0):
+    if not hasattr(raw_conn, '_execute_command'):
+        raise NotImplementedError("binlog dump needs a pymysql connection")
+    cursor = raw_conn.cursor()
+    try:
+        # since 5.6 the server refuses to dump to clients which don't know about checksums
+        cursor.execute("SET @master_binlog_checksum = @@global.binlog_checksum")
+    except Exception as e:
+        if not e.args or e.args[0] != ER_UNKNOWN_SYSTEM_VARIABLE:
+            raise
+        LOGGER.debug("no binlog checksums on this server: %s", e)
+    finally:
+        cursor.close()
+
+    if not isinstance(log_file, bytes):
+        log_file = log_file.encode('utf8')
+    prelude = struct.pack('<IHI', pos, BINLOG_DUMP_NON_BLOCK, server_id) + log_file
+    raw_conn._execute_command(COM_BINLOG_DUMP, prelude)
+
+
+def _read_dump_header(raw_conn):
+    '''Header of the next real event of a dump stream, None at its end'''
+    while True:
+        packet = raw_conn._read_packet()
+        if packet.is_eof_packet():
+            return None
+        data = packet.get_all_data()
+        # data[0] is the OK marker, the event follows
+        header = parse_event_header(data, 1)
+        if not header.is_artificial:
+            return header._replace(position=header.next_position - header.event_length)
+
+
+def read_remote_event_headers(raw_conn, log_file, pos=4, count=1, server_id=0):
+    '''Read event headers straight from the server with COM_BINLOG_DUMP
+
+        Works on a raw pymysql connection (it relies on its packet API) and
+        needs the REPLICATION SLAVE privilege. The connection is left in the
+        middle of a dump stream, so pass a dedicated one and close it afterwards.
+        Events faked by the server (leading rotate, re-sent format description)
+        are skipped.
+
+        params:
+            raw_conn: pymysql connection
+            count: stop after this many events, None for the whole file
+            server_id: 0 makes the server end the dump at the end of the log
+        returns:
+            list of EventHeader
+    '''
+    _start_dump(raw_conn, log_file, pos, server_id)
+    headers = []
+    while count is None or len(headers) < count:
+        header = _read_dump_header(raw_conn)
+        if header is None:
+            break
+        headers.append(header)
+        if header.type_code == 4:
+            # the real rotate event closes the file
+            break
+    return headers
+
+
+class RemoteHeaderReader(object):
+    '''Read many event headers of a server over one replication connection
+
+        A dump can't be stopped halfway without closing its connection, so
+        the reader keeps the stream of its last read open: reading at or a
+        little after the position the stream has reached goes on with the
+        same dump, skipping the events in between. Reading another file, an
+        earlier position or one more than `max_skip` bytes ahead replaces
+        the connection. Forward scans (sampling a binlog, galloping through
+        it) therefore cost one connection per file.
+
+        Typical usage::
+
+            reader = RemoteHeaderReader(lambda: pymysql.connect(**db_args))
+            try:
+                for pos in positions:
+                    print reader.read("mysql-bin.000042", pos).timestamp
+            finally:
+                reader.close()
+    '''
+
+    def __init__(self, connect, max_skip=1 << 20, server_id=0):
+        '''
+            params:
+                connect: callable returning a new pymysql connection
+                max_skip: read ahead on the open dump up to this many bytes
+                    before starting a new one at the wanted position
+        '''
+        self.connect = connect
+        self.max_skip = max_skip
+        self.server_id = server_id
+        # dumps started, each on its own connection
+        self.dumps = 0
+        self._conn = None
+        self._log_file = None
+        # position of the next event of the open dump, None once it ended
+        self._next_pos = None
+        self._last = None
+
+    def read(self, log_file, pos=4):
+        '''returns: EventHeader of the event at `pos`, None if there is no event starting there'''
+        last = self._last
+        if last is not None and self._log_file == log_file and last.position == pos:
+            return last
+        if (self._conn is None or self._next_pos is None or self._log_file != log_file
+                or not self._next_pos <= pos <= self._next_pos + self.max_skip):
+            self._start(log_file, pos)
+        try:
+            while self._next_pos is not None and self._next_pos <= pos:
+                header = _read_dump_header(self._conn)
+                if header is None or header.type_code == 4:
+                    self._next_pos = None
+                else:
+                    self._next_pos = header.position + header.event_length
+                if header is not None and header.position == pos:
+                    self._last = header
+                    return header
+        except Exception:
+            self.close()
+            raise
+        return None
+
+    def _start(self, log_file, pos):
+        self.close()
+        self._conn = self.connect()
+        self.dumps += 1
+        try:
+            _start_dump(self._conn, log_file, pos, self.server_id)
+        except Exception:
+            self.close()
+            raise
+        self._log_file, self._next_pos = log_file, pos
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._next_pos = self._last = None
+            conn.close()
@@ -4,8 +4,10 @@ from __future__ import absolute_import, division, with_statement
 
 import time
 import logging
+import contextlib
 import copy
 import os
+import re
 import sys
 
 try:
@@ -32,9 +34,21 @@ class ConnectionHangError(MySQLdb.OperationalError):
     def __init__(self, *args, **kwargs):
         pass
 
+class QueryTimeoutError(MySQLdb.OperationalError):
+    """The deadline of a call passed, see Connection.deadline"""
+    pass
+
 class NotSupportCursorType(Exception):
     pass
 
+# ER_QUERY_TIMEOUT, SELECT aborted by MAX_EXECUTION_TIME
+ER_QUERY_TIMEOUT = 3024
+# the socket timeout is this much longer than the time left, so the server
+# can report a MAX_EXECUTION_TIME abort before the connection is cut
+DEADLINE_SOCKET_GRACE = 0.5
+
+_SELECT_RE = re.compile(r"\s*select\b", re.I)
+
 def session(**kwargs):
     """
     Typical usage::
@@ -57,6 +71,9 @@ def session(**kwargs):
         # the results format between SSDictCursor and DictCursor are different, please check
         db.query("select * from a", cs_type="SSDictCursor")
         db.query("select * from a", cs_type="DictCursor")
+        # give up on the statements of a block after 2s
+        with db.deadline(2):
+            db.query("select * from a")
     Args:
         kwargs: args used by Connection
     Return: 
@@ -85,6 +102,9 @@ class Connection(object):
         self._max_idle_time = float(kwargs.pop("max_idle_time", 7 * 3600))
         self.cursor = "Cursor"
         self.max_retry = max_retry
+        self.host = host
+        self.user = user
+        self._deadline = None
 
         args = dict(conv=CONVERSIONS, use_unicode=use_unicode, charset=charset,
                     db=db, init_command=('SET time_zone = "%s"' % timezone),
@@ -217,7 +237,7 @@ class Connection(object):
         """
         cursor = self._cursor(None)
         try:
-            cursor.executemany(query, *parameters)
+            self._executemany(cursor, query, parameters)
             return cursor.lastrowid
         finally:
             cursor.close()
@@ -228,7 +248,7 @@ class Connection(object):
         """
         cursor = self._cursor(None)
         try:
-            cursor.executemany(query, *parameters)
+            self._executemany(cursor, query, parameters)
             return cursor.rowcount
         finally:
             cursor.close()
@@ -261,6 +281,69 @@ class Connection(object):
     def set_cursor(self, cs_type):
         self.cursor = cs_type
 
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Cut off the statements run in the block once `seconds` have passed.
+
+        Typical usage::
+            with db.deadline(2.5):
+                rows = db.query("select * from a")
+
+        Before each statement the time left is set as the socket read/write
+        timeout (pymysql only, MySQLdb keeps the read_timeout it connected with)
+        and SELECTs get a MAX_EXECUTION_TIME optimizer hint (MySQL 5.7.8+, older
+        servers ignore it), so the server stops working on them too. A statement
+        running past the deadline raises QueryTimeoutError and isn't retried;
+        if the socket timed out, the connection is reopened and the query killed.
+        A nested deadline can only be shorter than the outer one.
+        """
+        outer = self._deadline
+        deadline = time.time() + seconds
+        self._deadline = deadline if outer is None else min(deadline, outer)
+        try:
+            yield self
+        finally:
+            self._deadline = outer
+            if outer is None:
+                self._set_socket_timeouts(self._db_args.get("read_timeout"),
+                                          self._db_args.get("write_timeout"))
+
+    def _set_socket_timeouts(self, read_timeout, write_timeout):
+        # pymysql sets these on the socket before every read/write
+        if self._db is not None and hasattr(self._db, "_read_timeout"):
+            self._db._read_timeout = read_timeout
+            self._db._write_timeout = write_timeout
+
+    def _apply_deadline(self, query):
+        """Set the socket timeouts to the time left and add the
+        MAX_EXECUTION_TIME hint to a SELECT, returns the query to run.
+        """
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise QueryTimeoutError(ER_QUERY_TIMEOUT, "deadline passed before the query was sent")
+        self._set_socket_timeouts(remaining + DEADLINE_SOCKET_GRACE, remaining + DEADLINE_SOCKET_GRACE)
+        match = _SELECT_RE.match(query)
+        if match and "MAX_EXECUTION_TIME" not in query.upper():
+            query = "%s /*+ MAX_EXECUTION_TIME(%d) */%s" % (query[:match.end()],
+                                                           max(int(remaining * 1000), 1), query[match.end():])
+        return query
+
+    def _timeout_error(self, e, tid):
+        """Returns the QueryTimeoutError to raise for an error caused by the
+        deadline, None for other errors.
+        """
+        if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+            return QueryTimeoutError(*e.args)
+        if self._deadline is None or time.time() < self._deadline:
+            return None
+        # the socket timed out, but the server may still be running the query
+        try:
+            self.reconnect()
+            self._db.kill(tid)
+        except MySQLdb.MySQLError, kill_error:
+            logging.warning("Failed to kill query %s on %s: %s", tid, self.host, kill_error)
+        return QueryTimeoutError(ER_QUERY_TIMEOUT, "deadline passed: %s" % (e,))
+
     def _ensure_connected(self):
         '''Mysql by default closes client connections that are idle for
         8 hours, but the client library does not report this fact until
@@ -272,7 +355,7 @@ class Connection(object):
             self.reconnect()
         self._last_use_time = time.time()
 
-    def _cursor(self, cs_type):
+    def _cursor(self, cs_type=None):
         """Returns typical cursor
 
         """
@@ -292,8 +375,13 @@ class Connection(object):
         while True:
             tid = self._db.thread_id()
             try:
-                return cursor.execute(query, kwparameters or parameters)
+                if self._deadline is None:
+                    return cursor.execute(query, kwparameters or parameters)
+                return cursor.execute(self._apply_deadline(query), kwparameters or parameters)
             except MySQLdb.OperationalError, e:
+                timeout_error = self._timeout_error(e, tid)
+                if timeout_error is not None:
+                    raise timeout_error
                 logging.error("Error connecting to MySQL on %s", self.host)
                 self.close()
                 time.sleep(0.5)
@@ -313,6 +401,18 @@ class Connection(object):
                         raise ConnectionHangError('%s is hang!!!' % self.host)
                     raise
 
+    def _executemany(self, cursor, query, parameters):
+        if self._deadline is None:
+            return cursor.executemany(query, *parameters)
+        tid = self._db.thread_id()
+        try:
+            return cursor.executemany(self._apply_deadline(query), *parameters)
+        except MySQLdb.OperationalError, e:
+            timeout_error = self._timeout_error(e, tid)
+            if timeout_error is not None:
+                raise timeout_error
+            raise
+
     def __del__(self):
         self.close()
 
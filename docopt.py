@@ -10,7 +10,7 @@ import sys
 import re
 
 
-__all__ = ['docopt']
+__all__ = ['docopt', 'DocoptParser', 'get_parser']
 __version__ = '0.6.2'
 
 
@@ -498,6 +498,9 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
     --options, <positional-argument>, commands, which could be
     [optional], (required), (mutually | exclusive) or repeated...
 
+    The parsed description is cached by `doc` (see `get_parser`), so
+    calling `docopt` again with the same `doc` only parses `argv`.
+
     Parameters
     ----------
     doc : str
@@ -553,27 +556,76 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
       at https://github.com/docopt/docopt#readme
 
     """
-    if argv is None:
-        argv = sys.argv[1:]
-    DocoptExit.usage = printable_usage(doc)
-    options = parse_defaults(doc)
-    pattern = parse_pattern(formal_usage(DocoptExit.usage), options)
-    # [default] syntax for argument is disabled
-    #for a in pattern.flat(Argument):
-    #    same_name = [d for d in arguments if d.name == a.name]
-    #    if same_name:
-    #        a.value = same_name[0].value
-    argv = parse_argv(TokenStream(argv, DocoptExit), list(options),
-                      options_first)
-    pattern_options = set(pattern.flat(Option))
-    for ao in pattern.flat(AnyOptions):
-        doc_options = parse_defaults(doc)
-        ao.children = list(set(doc_options) - pattern_options)
-        #if any_options:
-        #    ao.children += [Option(o.short, o.long, o.argcount)
-        #                    for o in argv if type(o) is Option]
-    extras(help, version, argv, doc)
-    matched, left, collected = pattern.fix().match(argv)
-    if matched and left == []:  # better error message if left?
-        return Dict((a.name, a.value) for a in (pattern.flat() + collected))
-    raise DocoptExit()
+    return get_parser(doc).parse(argv, help, version, options_first)
+
+
+class DocoptParser(object):
+
+    """Command-line interface described in `doc`, compiled once.
+
+    The constructor does everything which depends on `doc` only: it finds
+    the usage section, parses the options and the usage pattern and fixes
+    the pattern. `parse` then only parses `argv` and matches it against
+    the pattern, so the same parser can be reused for any number of argv:
+
+    >>> parser = DocoptParser(doc)
+    >>> parser.parse(['tcp', '127.0.0.1', '80'])
+
+    Matching doesn't change the compiled pattern, it works on the options
+    parsed from `argv` (copies of ``self.options``) and on new argument
+    objects; `parse` returns copies of the list values of the pattern.
+
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.usage = printable_usage(doc)
+        self.options = parse_defaults(doc)
+        self.pattern = parse_pattern(formal_usage(self.usage), self.options)
+        # [default] syntax for argument is disabled
+        #for a in pattern.flat(Argument):
+        #    same_name = [d for d in arguments if d.name == a.name]
+        #    if same_name:
+        #        a.value = same_name[0].value
+        pattern_options = set(self.pattern.flat(Option))
+        for ao in self.pattern.flat(AnyOptions):
+            doc_options = parse_defaults(doc)
+            ao.children = list(set(doc_options) - pattern_options)
+        # fix() may change the values of options also in self.options, which
+        # parse_argv only uses for their names and argcount
+        self.pattern.fix()
+
+    def parse(self, argv=None, help=True, version=None, options_first=False):
+        """Parse `argv`, see `docopt` for the parameters."""
+        if argv is None:
+            argv = sys.argv[1:]
+        DocoptExit.usage = self.usage
+        argv = parse_argv(TokenStream(argv, DocoptExit), list(self.options),
+                          options_first)
+        extras(help, version, argv, self.doc)
+        matched, left, collected = self.pattern.match(argv)
+        if matched and left == []:  # better error message if left?
+            return Dict((a.name, a.value[:] if type(a.value) is list
+                         else a.value)
+                        for a in (self.pattern.flat() + collected))
+        raise DocoptExit()
+
+
+# compiled parsers by doc, see get_parser
+_parsers = {}
+PARSER_CACHE_SIZE = 64
+
+
+def get_parser(doc):
+    """Return the `DocoptParser` of `doc`, compiled on first use.
+
+    Up to PARSER_CACHE_SIZE parsers are kept, the cache is emptied when
+    it is full.
+
+    """
+    parser = _parsers.get(doc)
+    if parser is None:
+        if len(_parsers) >= PARSER_CACHE_SIZE:
+            _parsers.clear()
+        parser = _parsers[doc] = DocoptParser(doc)
+    return parser
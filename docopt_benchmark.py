@@ -0,0 +1,58 @@
+# -*- coding: UTF-8 -*-
+"""Benchmark of repeated docopt calls with the same doc.
+
+Usage::
+
+    python docopt_benchmark.py [calls]
+
+Compares compiling the doc on every call (what ``docopt`` did before the
+parser cache), ``docopt`` with its cache and reusing a ``DocoptParser``.
+
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from docopt import DocoptParser, docopt, get_parser
+
+DOC = """Usage:
+  agent.py run <task>... [--timeout=<seconds>] [--retries=<n>] [-v...]
+  agent.py status [<task>] [--json]
+  agent.py kill <task> [--signal=<sig>]
+  agent.py (-h | --help | --version)
+
+Options:
+  -h, --help           Show this screen.
+  --version            Show version.
+  -v                   More output, repeat for even more.
+  --timeout=<seconds>  Give up after this long [default: 30].
+  --retries=<n>        Retry failed tasks n times [default: 0].
+  --signal=<sig>       Signal to send [default: TERM].
+  --json               Print the status as json.
+"""
+
+ARGV = ['run', 'backup', 'purge', '--timeout', '60', '-vv']
+
+
+def bench(calls=10000):
+    get_parser(DOC)
+    parser = DocoptParser(DOC)
+    cases = [
+        ("compile every call", lambda: DocoptParser(DOC).parse(ARGV)),
+        ("docopt (cached)", lambda: docopt(DOC, ARGV)),
+        ("DocoptParser.parse", lambda: parser.parse(ARGV)),
+    ]
+    print("%d calls" % calls)
+    print("%-20s %12s %12s" % ("", "seconds", "us/call"))
+    for name, call in cases:
+        call()
+        start = time.time()
+        for i in range(calls):
+            call()
+        elapsed = time.time() - start
+        print("%-20s %12.3f %12.1f" % (name, elapsed, elapsed / calls * 1e6))
+
+
+if __name__ == '__main__':
+    bench(*[int(arg) for arg in sys.argv[1:]])
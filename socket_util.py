@@ -1,24 +1,195 @@
+import errno
+import os
 import socket
 import fcntl
 import struct
 import subprocess
-import time
+import threading
+from collections import namedtuple
+
+import timing
+
+try:
+    import numpy
+except ImportError:
+    # only needed for the bulk classification
+    numpy = None
 
 '''
     This module has left the exception handling and params check.
 '''
 
-def get_ifnames(cmd=None):
+SIOCGIFADDR = 0x8915
+SIOCGIFINDEX = 0x8933
+
+SYS_CLASS_NET = "/sys/class/net"
+PROC_IF_INET6 = "/proc/net/if_inet6"
+
+# rtnetlink constants, see linux/netlink.h, linux/rtnetlink.h and linux/if_addr.h
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+_NLMSGHDR = struct.Struct("=LHHLL")
+_IFADDRMSG = struct.Struct("=BBBBL")
+_RTATTR = struct.Struct("=HH")
+
+Interface = namedtuple('Interface', ['name', 'index', 'ipv4', 'ipv6'])
+
+# one socket for all the ioctls instead of one per call
+_ioctl_socket = None
+# the interface list, filled by get_interfaces on first use
+_interfaces = None
+_lock = threading.Lock()
+
+def _get_ioctl_socket():
+
+    global _ioctl_socket
+    with _lock:
+        if _ioctl_socket is None:
+            _ioctl_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return _ioctl_socket
+
+def _list_ifnames():
+
+    '''[(ifname, ifindex)] from /sys/class/net, socket.if_nameindex where there is no sysfs'''
+    try:
+        names = sorted(os.listdir(SYS_CLASS_NET))
+    except OSError:
+        if hasattr(socket, "if_nameindex"):
+            return [(name, index) for index, name in socket.if_nameindex()]
+        with open("/proc/net/dev") as fp:
+            names = [line.split(":", 1)[0].strip() for line in fp if ":" in line]
+    ifnames = []
+    for name in names:
+        try:
+            with open(os.path.join(SYS_CLASS_NET, name, "ifindex")) as fp:
+                index = int(fp.read())
+        except (IOError, OSError, ValueError):
+            try:
+                index = struct.unpack("16si", fcntl.ioctl(_get_ioctl_socket().fileno(), SIOCGIFINDEX,
+                                                          struct.pack("16si", name[:15], 0)))[1]
+            except IOError:
+                # gone meanwhile
+                continue
+        ifnames.append((name, index))
+    return ifnames
+
+def _netlink_addresses():
+
+    '''dump the addresses of all interfaces with one RTM_GETADDR request
+        returns:
+            {ifindex: ([ipv4 addresses], [ipv6 addresses])}
+    '''
+    addresses = {}
+    s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        s.bind((0, 0))
+        payload = _IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        s.send(_NLMSGHDR.pack(_NLMSGHDR.size + len(payload), RTM_GETADDR,
+                              NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + payload)
+        while True:
+            data = s.recv(65536)
+            offset = 0
+            while offset + _NLMSGHDR.size <= len(data):
+                length, msg_type, flags, seq, pid = _NLMSGHDR.unpack_from(data, offset)
+                if length < _NLMSGHDR.size:
+                    raise IOError("bad netlink message length %d" % length)
+                if msg_type == NLMSG_DONE:
+                    return addresses
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", data, offset + _NLMSGHDR.size)[0]
+                    raise IOError(error, os.strerror(error))
+                if msg_type == RTM_NEWADDR:
+                    family, prefixlen, ifa_flags, scope, index = _IFADDRMSG.unpack_from(data, offset + _NLMSGHDR.size)
+                    attrs = {}
+                    pos = offset + _NLMSGHDR.size + _IFADDRMSG.size
+                    while pos + _RTATTR.size <= offset + length:
+                        attr_len, attr_type = _RTATTR.unpack_from(data, pos)
+                        if attr_len < _RTATTR.size:
+                            break
+                        attrs[attr_type] = data[pos + _RTATTR.size:pos + attr_len]
+                        pos += (attr_len + 3) & ~3
+                    # IFA_ADDRESS is the peer on point to point links, IFA_LOCAL the own address
+                    addr = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+                    if addr and family in (socket.AF_INET, socket.AF_INET6):
+                        ipv4, ipv6 = addresses.setdefault(index, ([], []))
+                        (ipv4 if family == socket.AF_INET else ipv6).append(socket.inet_ntop(family, addr))
+                offset += (length + 3) & ~3
+    finally:
+        s.close()
+
+def _ioctl_addresses(ifnames):
+
+    '''same as _netlink_addresses with SIOCGIFADDR and /proc/net/if_inet6, only
+        the primary IPv4 address of each interface is found
+    '''
+    addresses = {}
+    for name, index in ifnames:
+        try:
+            addresses[index] = ([get_ip_address(name)], [])
+        except IOError:
+            # no IPv4 address
+            addresses[index] = ([], [])
+    try:
+        with open(PROC_IF_INET6) as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) < 6:
+                    continue
+                ipv6 = socket.inet_ntop(socket.AF_INET6, fields[0].decode("hex"))
+                addresses.setdefault(int(fields[1], 16), ([], []))[1].append(ipv6)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return addresses
+
+def get_interfaces(refresh=False):
+
+    '''Get all interfaces with their addresses, without running any command.
 
-    '''Get all ifnames using shell command `ifconfig -s` and return a ifname list. You can use your own `cmd` to get the ifname list
+        Names and indexes come from /sys/class/net, the addresses from a single
+        rtnetlink dump (SIOCGIFADDR and /proc/net/if_inet6 where netlink isn't
+        available). The result is cached, pass `refresh` to enumerate again,
+        e.g. after containers were started.
+
+        params:
+            refresh: ignore the cached list
+        returns:
+            list of Interface(name, index, ipv4, ipv6), ipv4/ipv6 being lists of string_ip
+    '''
+    global _interfaces
+    interfaces = _interfaces
+    if interfaces is not None and not refresh:
+        return interfaces
+    ifnames = _list_ifnames()
+    try:
+        addresses = _netlink_addresses()
+    except (AttributeError, socket.error, IOError):
+        # no AF_NETLINK on this platform or not allowed
+        addresses = _ioctl_addresses(ifnames)
+    interfaces = [Interface(name, index, *addresses.get(index, ([], []))) for name, index in ifnames]
+    _interfaces = interfaces
+    return interfaces
+
+def get_ifnames(cmd=None, refresh=False):
+
+    '''Get all ifnames and return a ifname list, see get_interfaces. You can use your own `cmd` to get the ifname list
 
         params: 
-            cmd: shell command. You may leave it as default
+            cmd: shell command printing the ifnames. You may leave it as default
+            refresh: ignore the cached list
         returns:
             (status, list of ifnames)
     '''
     if not cmd:
-        cmd = """ifconfig -s | grep -i -v Iface | awk '{print $1}'"""
+        return (0, [interface.name for interface in get_interfaces(refresh)])
 
     sp = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     sout, serr = sp.communicate()
@@ -41,64 +212,223 @@ def get_ip_address(ifname, convert=True):
         returns:
             string_ip (default) or four_bytes_ip
     '''
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    ip_int = fcntl.ioctl(s.fileno(),0x8915,struct.pack('256s', ifname[:15]))[20:24]
+    ip_int = fcntl.ioctl(_get_ioctl_socket().fileno(),SIOCGIFADDR,struct.pack('256s', ifname[:15]))[20:24]
     if convert:
         return socket.inet_ntoa(ip_int)
     else:
         return list(ip_int)
 
+def ip_to_int(ip):
+
+    '''Convert a string_ip to an int
+
+        params:
+            ip: IPv4/IPv6 string_ip, an int is taken as an IPv4 address
+        returns:
+            (version, int), IPv4-mapped IPv6 addresses (::ffff:a.b.c.d) are returned as IPv4
+    '''
+    if isinstance(ip, (int, long)):
+        return 4, ip
+    if ":" in ip:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip))
+        value = high << 64 | low
+        if value >> 32 == 0xffff:
+            return 4, value & 0xffffffff
+        return 6, value
+    return 4, struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def parse_cidr(cidr):
+
+    '''Parse "a.b.c.d/n" or "x:x::/n", a string_ip without a prefix length is a single address
+
+        returns:
+            (version, network, prefixlen), network being an int with the host bits cleared
+    '''
+    addr, _, prefix = cidr.strip().partition("/")
+    version, value = ip_to_int(addr)
+    bits = 32 if version == 4 else 128
+    if not prefix:
+        prefixlen = bits
+    elif ":" in addr and version == 4:
+        # ::ffff:0:0/96 style, the prefix covers the 96 mapping bits
+        prefixlen = int(prefix) - 96
+    else:
+        prefixlen = int(prefix)
+    if not 0 <= prefixlen <= bits:
+        raise ValueError("bad prefix length in %r" % cidr)
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+    return version, value & mask, prefixlen
+
+class CIDRTable(object):
+
+    '''A list of IPv4/IPv6 CIDRs compiled once for fast matching of many addresses.
+
+        An address matches the longest prefix containing it. Single addresses are
+        looked up with one dict probe per distinct prefix length; match_array
+        matches a numpy uint32 array of IPv4 addresses with one searchsorted per
+        prefix length instead of a python loop.
+    '''
+
+    def __init__(self, cidrs):
+
+        '''
+            params:
+                cidrs: iterable of cidrs or of (cidr, label) pairs, the label of a cidr is itself by default
+        '''
+        self.labels = []
+        # {version: {prefixlen: {network: label index}}}, the first of duplicate cidrs wins
+        tables = {4: {}, 6: {}}
+        for each in cidrs:
+            cidr, label = each if isinstance(each, tuple) else (each, each)
+            version, network, prefixlen = parse_cidr(cidr)
+            tables[version].setdefault(prefixlen, {}).setdefault(network, len(self.labels))
+            self.labels.append(label)
+        # {version: [(mask, {network: label index})]}, longest prefix first
+        self._probes = {}
+        for version, bits in ((4, 32), (6, 128)):
+            self._probes[version] = [(((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1), networks)
+                                     for prefixlen, networks in sorted(tables[version].items(), reverse=True)]
+        self._arrays = None
+
+    def match_index(self, ip):
+
+        '''index in self.labels of the cidr `ip` matches, -1 if none'''
+        version, value = ip_to_int(ip)
+        for mask, networks in self._probes[version]:
+            index = networks.get(value & mask)
+            if index is not None:
+                return index
+        return -1
+
+    def match(self, ip):
+
+        '''label of the cidr `ip` matches, None if none'''
+        index = self.match_index(ip)
+        return self.labels[index] if index >= 0 else None
+
+    def __contains__(self, ip):
+
+        return self.match_index(ip) >= 0
+
+    def _ipv4_arrays(self):
+
+        '''[(mask, sorted networks, their label indexes)] of the IPv4 cidrs as numpy arrays'''
+        if self._arrays is None:
+            arrays = []
+            for mask, networks in self._probes[4]:
+                items = sorted(networks.items())
+                arrays.append((numpy.uint32(mask),
+                               numpy.array([network for network, index in items], dtype=numpy.uint32),
+                               numpy.array([index for network, index in items], dtype=numpy.int32)))
+            self._arrays = arrays
+        return self._arrays
+
+    def match_array(self, ips):
+
+        '''Match many addresses at once
+
+            params:
+                ips: numpy uint32 array of IPv4 addresses (see ipv4_array) or a sequence of string_ips
+            returns:
+                label indexes (-1: no match), a numpy int32 array if numpy is available, a list if not
+        '''
+        if numpy is None:
+            return [self.match_index(ip) for ip in ips]
+        if not isinstance(ips, numpy.ndarray):
+            # a generator would be used up by a failed ipv4_array
+            ips = list(ips)
+            try:
+                ips = ipv4_array(ips)
+            except (socket.error, TypeError):
+                # IPv6 addresses or ints among them
+                return numpy.array([self.match_index(ip) for ip in ips], dtype=numpy.int32)
+        ips = ips.astype(numpy.uint32, copy=False)
+        result = numpy.full(len(ips), -1, dtype=numpy.int32)
+        for mask, networks, indexes in self._ipv4_arrays():
+            masked = ips & mask
+            pos = numpy.minimum(numpy.searchsorted(networks, masked), len(networks) - 1)
+            hit = (networks[pos] == masked) & (result < 0)
+            result[hit] = indexes[pos[hit]]
+        return result
+
+def ipv4_array(ips):
+
+    '''Convert a sequence of IPv4 string_ips to a numpy uint32 array, for CIDRTable.match_array'''
+    if numpy is None:
+        raise RuntimeError("numpy is required for ipv4_array")
+    packed = "".join(socket.inet_aton(ip) for ip in ips)
+    return numpy.frombuffer(packed, dtype=">u4").astype(numpy.uint32)
+
+# non internet address ranges, the labels are what classify_ip returns
+IP_CLASSES = [
+    ("10.0.0.0/8", "a_class"),
+    ("172.16.0.0/12", "b_class"),
+    ("192.168.0.0/16", "c_class"),
+    ("127.0.0.0/8", "loopback"),
+    ("::1/128", "loopback"),
+    ("fc00::/7", "unique_local"),
+    ("fe80::/10", "link_local"),
+]
+
+_ip_classes = CIDRTable(IP_CLASSES)
+
+def classify_ip(ip):
+
+    '''Class of an IPv4/IPv6 address, see IP_CLASSES
+
+        returns:
+            a label of IP_CLASSES, None for an internet ip
+    '''
+    return _ip_classes.match(ip)
+
+def classify_ips(ips):
+
+    '''classify_ip for many addresses, see CIDRTable.match_array
+
+        returns:
+            list of labels, None for internet ips
+    '''
+    labels = _ip_classes.labels + [None]
+    return [labels[index] for index in _ip_classes.match_array(ips)]
+
 def is_internet_ip(ip):
 
-    '''Check if is a internet ip and returns true if it is. Only for IPv4
+    '''Check if is a internet ip and returns true if it is. IPv6 addresses are classified too, see IP_CLASSES
 
         A: 10.0.0.0~10.255.255.255  mask 10.0.0.0/8
         B: 172.16.0.0~172.31.255.255  mask 172.16.0.0/12
         C: 192.168.0.0~192.168.255.255  mask 192.168.0.0/16
         loopback: 127.0.0.0~127.255.255.255  mask 127.0.0.0/8
     '''
+    label = classify_ip(ip)
+    if label is None:
+        return "true"
+    elif label == "a_class":
+        return "is an a_class ip"
+    return "is a %s ip" % label
 
+def are_internet_ips(ips):
 
-    a_class = convert_to_int("10.0.0.0") >> 24
-    b_class_1 = convert_to_int("172.16.0.0") >> 20
-    b_class_2 = convert_to_int("172.31.0.0") >> 20
-    c_class = convert_to_int("192.168.0.0") >> 16
-    local_loop = convert_to_int("127.0.0.0") >> 24
-
-    ret_int_a_or_loop = convert_to_int(ip) >> 24
-    ret_int_b = convert_to_int(ip) >> 20
-    ret_int_c = convert_to_int(ip) >> 16
+    '''is_internet_ip for many addresses, see CIDRTable.match_array
 
-    if ret_int_a_or_loop == a_class:
-        return "is an a_class ip"
-    elif ret_int_a_or_loop == local_loop:
-        return "is a loopback ip"
-    elif ret_int_b >= b_class_1 and ret_int_b <= b_class_2:
-        return "is a b_class ip"
-    elif ret_int_c == c_class:
-        return "is a c_class ip"
-    else:
-        return "true"
+        returns:
+            bool per address, a numpy array if numpy is available
+    '''
+    indexes = _ip_classes.match_array(ips)
+    if numpy is not None:
+        return indexes < 0
+    return [index < 0 for index in indexes]
 
 def time_it(func):
 
-    def wrapper(*args, **kargs):
+    '''Record the time used by func in the timing registry, see timing.timed and timing.report'''
+    return timing.timed(func)
 
-        start = time.time()
-        ret = func(*args, **kargs)
-        end = time.time()
-        print "===== %s time used =====" % func.__name__
-        print end - start
-        return ret
-    return wrapper
-
-@time_it
 def convert(ip):
     
     return sum(int(r) << ((3-i)<<3) for i, r in enumerate(ip.strip().split(r".")))
 
 
-@time_it
 def convert_to_int(ip):
 
     if isinstance(ip, str):
@@ -109,6 +439,9 @@ def convert_to_int(ip):
 
 if __name__ == "__main__":
 
+#    for interface in get_interfaces():
+#        print interface.name, interface.ipv4, interface.ipv6
+
 #    ret = get_ifnames()
 #    if ret[0] == 0:
 #        for ifname in ret[1]:
@@ -121,6 +454,8 @@ if __name__ == "__main__":
 #    print is_internet_ip("172.16.1.1")
 #    print is_internet_ip("172.31.1.1")
 #    print is_internet_ip("127.31.1.1")
+#    print is_internet_ip("fd00::1")
+#    print classify_ips(["8.8.8.8", "10.1.2.3", "172.20.0.1"])
 
     print convert("192.168.1.1")
     print convert_to_int("192.168.1.1")
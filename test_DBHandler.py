@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import struct
+import threading
+import time
+import unittest
+
+import DBHandler
+import binlog_parser
+from DBHandler import MySQLInstance, repoint_replicas
+
+
+class FakeConnection(object):
+    '''db_api.Connection stand-in serving SHOW BINARY LOGS and SHOW BINLOG EVENTS
+        of binlogs whose event i is written at base + i and takes 100 bytes
+    '''
+
+    def __init__(self, files):
+        # [(log_name, base timestamp, event count)]
+        self.files = files
+        self.queries = []
+        self._db_args = {}
+
+    def _events(self, log_name):
+        name, base, count = [each for each in self.files if each[0] == log_name][0]
+        return [{"Log_name": name, "Pos": 4 + i * 100, "End_log_pos": 104 + i * 100}
+                for i in range(count)]
+
+    def query(self, sql, cs_type=None, *params):
+        assert cs_type is None, "parameters passed as cs_type: %r" % (cs_type, )
+        self.queries.append((sql, params))
+        if sql == "SHOW BINARY LOGS":
+            return [{"Log_name": name, "File_size": 4 + count * 100} for name, base, count in self.files]
+        if sql == "SHOW BINLOG EVENTS IN %s FROM %s LIMIT %s":
+            log_name, pos, count = params
+            return [each for each in self._events(log_name) if each["Pos"] >= pos][:count]
+        if sql == "SHOW BINLOG EVENTS IN %s LIMIT %s, %s":
+            log_name, start, count = params
+            return self._events(log_name)[start:start + count]
+        raise AssertionError("unexpected query %s" % sql)
+
+
+class FakeInstance(MySQLInstance):
+
+    def __init__(self, files):
+        self.conn = FakeConnection(files)
+        self.host = "127.0.0.1:3306"
+        self.read_times = 0
+
+    def get_binlog_event_time(self, log_file, pos, end_pos):
+        self.read_times += 1
+        name, base, count = [each for each in self.conn.files if each[0] == log_file][0]
+        return base + (pos - 4) // 100
+
+    def __del__(self):
+        pass
+
+
+class SearchBinlogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = FakeInstance([("bin.000001", 1000, 10), ("bin.000002", 2000, 5000),
+                                      ("bin.000003", 9000, 1)])
+
+    def test_get_binlog_events(self):
+        self.assertEqual(self.instance.get_binlog_events("bin.000002", 3, 2),
+                         [{"Log_name": "bin.000002", "Pos": 304, "End_log_pos": 404},
+                          {"Log_name": "bin.000002", "Pos": 404, "End_log_pos": 504}])
+        self.assertEqual(self.instance.get_binlog_events_from("bin.000002", 304)[0]["Pos"], 304)
+
+    def test_search(self):
+        search = self.instance.search_binlog_by_time
+        self.assertEqual(search(999), None)
+        self.assertEqual(search(1000), ("bin.000001", 4))
+        self.assertEqual(search(1009), ("bin.000001", 904))
+        self.assertEqual(search(1500), ("bin.000001", 904))
+        self.assertEqual(search(2000), ("bin.000002", 4))
+        self.assertEqual(search(2001), ("bin.000002", 104))
+        self.assertEqual(search(4321), ("bin.000002", 232104))
+        self.assertEqual(search(6999), ("bin.000002", 499904))
+        self.assertEqual(search(9000), ("bin.000003", 4))
+        self.assertEqual(search(99999), ("bin.000003", 4))
+
+    def test_search_reads_few_events(self):
+        self.assertEqual(self.instance.search_binlog_by_time(5555), ("bin.000002", 355504))
+        # 2 * log2(5000) probes in the file plus the bisection of the files
+        self.assertTrue(self.instance.read_times <= 30, self.instance.read_times)
+        fetched = [params for sql, params in self.instance.conn.queries if params and params[-1] != 1]
+        self.assertEqual(fetched, [])
+
+
+class FakeServerError(Exception):
+    pass
+
+
+class FakePacket(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def is_eof_packet(self):
+        return self.data is None
+
+    def get_all_data(self):
+        return self.data
+
+
+class FakeDumpConnection(object):
+    '''raw pymysql connection stand-in answering COM_BINLOG_DUMP with the
+        events of FakeConnection's binlogs, after a fake rotate event
+    '''
+
+    def __init__(self, files, checksum_error=None):
+        self.files = files
+        self.checksum_error = checksum_error
+        self.packets = []
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        if self.checksum_error is not None:
+            raise self.checksum_error
+
+    def close(self):
+        self.closed = True
+
+    def _execute_command(self, command, prelude):
+        assert command == binlog_parser.COM_BINLOG_DUMP
+        pos, flags, server_id = struct.unpack_from('<IHI', prelude)
+        name, base, count = [each for each in self.files if each[0] == prelude[10:]][0]
+        fmt = binlog_parser.EVENT_HEADER_FMT
+        self.packets = [b'\x00' + struct.pack(fmt, 0, 4, 1, 19, 0, binlog_parser.LOG_EVENT_ARTIFICIAL_F)]
+        for i in range((pos - 4) // 100, count):
+            self.packets.append(b'\x00' + struct.pack(fmt, base + i, 2, 1, 100, 104 + i * 100, 0))
+        self.packets.append(None)
+
+    def _read_packet(self):
+        return FakePacket(self.packets.pop(0))
+
+
+class DumpInstance(FakeInstance):
+    get_binlog_event_time = MySQLInstance.__dict__["get_binlog_event_time"]
+    _binlog_dir = None
+
+
+class BinlogScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = DumpInstance([("bin.000001", 1000, 10), ("bin.000002", 2000, 5000)])
+        self.connections = []
+        self.checksum_error = None
+        self._connect = DBHandler.MySQLdb.connect
+        DBHandler.MySQLdb.connect = self.connect
+
+    def tearDown(self):
+        DBHandler.MySQLdb.connect = self._connect
+
+    def connect(self, **kwargs):
+        self.connections.append(FakeDumpConnection(self.instance.conn.files, self.checksum_error))
+        return self.connections[-1]
+
+    def timestamps(self, log_file, positions):
+        return [self.instance.get_binlog_event_header(log_file, pos).timestamp for pos in positions]
+
+    def test_a_connection_per_read_outside_of_a_scan(self):
+        self.assertEqual(self.timestamps("bin.000002", [4, 104]), [2000, 2001])
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(all(conn.closed for conn in self.connections))
+
+    def test_a_scan_reads_on_the_same_dump(self):
+        with self.instance.binlog_scan() as reader:
+            self.assertEqual(self.timestamps("bin.000002", [4, 4, 1004, 1104, 100004]),
+                             [2000, 2000, 2010, 2011, 3000])
+            self.assertEqual(len(self.connections), 1)
+            # going back or to another file needs a new dump
+            self.assertEqual(self.timestamps("bin.000002", [504]), [2005])
+            self.assertEqual(self.timestamps("bin.000001", [904]), [1009])
+            self.assertEqual(self.instance.get_binlog_event_header("bin.000001", 1004), None)
+            self.assertEqual(reader.dumps, 3)
+            # more than max_skip ahead starts over at the position too
+            reader.max_skip = 1000
+            self.assertEqual(self.timestamps("bin.000002", [4, 904, 5004]), [2000, 2009, 2050])
+            self.assertEqual(reader.dumps, 5)
+        self.assertTrue(all(conn.closed for conn in self.connections))
+
+    def test_search_shares_the_scan(self):
+        self.assertEqual(self.instance.search_binlog_by_time(4321), ("bin.000002", 232104))
+        self.assertTrue(len(self.connections) <= 10, len(self.connections))
+        self.assertTrue(all(conn.closed for conn in self.connections))
+
+    def test_checksum_variable(self):
+        self.checksum_error = FakeServerError(binlog_parser.ER_UNKNOWN_SYSTEM_VARIABLE, "Unknown system variable")
+        self.assertEqual(self.timestamps("bin.000001", [104]), [1001])
+        self.checksum_error = FakeServerError(1227, "Access denied")
+        self.assertRaises(FakeServerError, self.instance.get_binlog_event_header, "bin.000001", 104)
+        self.assertTrue(self.connections[-1].closed)
+
+
+class FakeMaster(object):
+    host = "10.0.0.1:3306"
+    gtid_mode_on = False
+
+    def show_master_status(self):
+        return {"File": "bin.000042", "Position": 1234}
+
+
+class FakeReplica(object):
+    '''`behaviour` is "ok", "fail" (change_master_to raises), "stopped"
+        (the slave threads don't start) or "hang" (until `release` is set)
+    '''
+
+    def __init__(self, host, behaviour, release=None):
+        self.host = host
+        self.behaviour = behaviour
+        self.release = release
+        self.change_master = None
+
+    def change_master_to(self, host, port, user, password, file_name=None, pos=None, auto_position=None,
+                         master=None):
+        self.change_master = (host, port, file_name, pos, auto_position)
+        if self.behaviour == "fail":
+            raise RuntimeError("Access denied")
+        if self.behaviour == "hang":
+            self.release.wait(10)
+
+    def wait_slave_ok(self, timeout=30):
+        return self.behaviour != "stopped"
+
+
+class RepointReplicasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def replicas(self, *behaviours):
+        return [FakeReplica("10.0.0.%d:3306" % (i + 2), each, self.release) for i, each in enumerate(behaviours)]
+
+    def test_errors_are_collected_per_replica(self):
+        replicas = self.replicas("ok", "fail", "stopped", "ok")
+        rs = repoint_replicas(replicas, FakeMaster(), "repl", "secret", timeout=5, max_workers=2)
+        self.assertEqual(sorted(rs), sorted(each.host for each in replicas))
+        self.assertEqual([rs[each.host].ok for each in replicas], [True, False, False, True])
+        self.assertEqual(rs["10.0.0.3:3306"].error, "Access denied")
+        self.assertEqual(rs["10.0.0.4:3306"].error, "slave is not running after 5s")
+        self.assertEqual(replicas[0].change_master, ("10.0.0.1", "3306", "bin.000042", 1234, False))
+
+    def test_deadline_with_hung_replicas(self):
+        replicas = self.replicas("hang", "hang", "ok", "ok")
+        start = time.time()
+        rs = repoint_replicas(replicas, FakeMaster(), "repl", "secret", timeout=0.3, max_workers=2)
+        # both workers hang, so the result comes once their replicas are past the timeout
+        self.assertTrue(time.time() - start < 1.5, time.time() - start)
+        self.assertEqual([rs[each.host].error for each in replicas],
+                         ["timeout after 0.3s", "timeout after 0.3s",
+                          "not started, all workers hung", "not started, all workers hung"])
+        self.assertEqual(replicas[2].change_master, None)
+
+    def test_max_workers_must_be_positive(self):
+        self.assertRaises(ValueError, repoint_replicas, self.replicas("ok"), FakeMaster(), "repl", "secret",
+                          max_workers=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
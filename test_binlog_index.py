@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import shutil
+import tempfile
+import unittest
+
+from binlog_index import BinlogTimeIndex
+
+
+class FakeInstance(object):
+    '''serves binlogs of `events` events each, event i of a file written at
+        base + i and taking 100 bytes
+    '''
+
+    binlog_dir = None
+
+    def __init__(self, files):
+        self.host = "127.0.0.1:3306"
+        # [(log_name, base timestamp, event count)]
+        self.files = files
+        self.in_scan = False
+
+    def _file(self, log_name):
+        return [each for each in self.files if each[0] == log_name][0]
+
+    def get_binlog_list(self):
+        return [{"Log_name": name, "File_size": 4 + count * 100} for name, base, count in self.files]
+
+    def iter_binlog_events(self, log_name, start_pos, stop_file=None, batch_size=1000):
+        name, base, count = self._file(log_name)
+        for i in range((start_pos - 4) // 100, count):
+            yield {"Pos": 4 + i * 100, "End_log_pos": 104 + i * 100}
+
+    @contextlib.contextmanager
+    def binlog_scan(self):
+        self.in_scan = True
+        try:
+            yield
+        finally:
+            self.in_scan = False
+
+    def get_binlog_event_time(self, log_name, pos, end_pos):
+        assert self.in_scan, "event time read outside of binlog_scan()"
+        name, base, count = self._file(log_name)
+        return base + (pos - 4) // 100
+
+
+class BinlogTimeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.instance = FakeInstance([("bin.000001", 1000, 50), ("bin.000002", 2000, 50)])
+        self.index = BinlogTimeIndex(self.instance, cache_dir=self.cache_dir, sample_every=10)
+        self.index.refresh()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(999), None)
+        self.assertEqual(self.index.lookup(1000), ("bin.000001", 4))
+        self.assertEqual(self.index.lookup(1015), ("bin.000001", 1004))
+        self.assertEqual(self.index.lookup(1500), ("bin.000001", 4004))
+        self.assertEqual(self.index.lookup(2025), ("bin.000002", 2004))
+
+    def test_lookup_after_refresh_and_reload(self):
+        self.instance.files = [("bin.000002", 2000, 50), ("bin.000003", 3000, 5)]
+        self.assertEqual(self.index.refresh(), ["bin.000003"])
+        self.assertEqual(self.index.lookup(1500), None)
+        self.assertEqual(self.index.lookup(3003), ("bin.000003", 4))
+        reloaded = BinlogTimeIndex(self.instance, cache_dir=self.cache_dir, sample_every=10)
+        self.assertEqual(reloaded.lookup(2031), ("bin.000002", 3004))
+        self.assertEqual(reloaded.lookup(3003), ("bin.000003", 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
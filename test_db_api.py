@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import unittest
+
+import db_api
+from db_api import QueryTimeoutError
+
+
+class FakeCursor(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.description = None
+        self.rows = []
+        self.lastrowid = self.rowcount = 0
+
+    def execute(self, query, parameters=None):
+        self.db.server.executed.append((query, self.db._read_timeout, self.db._write_timeout))
+        if self.db.server.errors:
+            error = self.db.server.errors.pop(0)
+            if error is not None:
+                # the server aborts the statement or the socket times out
+                time.sleep(error.delay)
+                raise error
+        self.description = [("a", )]
+        self.rows = [(1, )]
+        self.lastrowid = self.rowcount = 1
+        return 1
+
+    def executemany(self, query, parameters):
+        return self.execute(query, parameters)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeDB(object):
+    '''the part of a pymysql connection db_api.Connection uses'''
+
+    def __init__(self, server, read_timeout=None, write_timeout=None, **kwargs):
+        self.server = server
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        server.thread_ids += 1
+        self.tid = server.thread_ids
+        self.killed = []
+
+    def autocommit(self, value):
+        pass
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+    def thread_id(self):
+        return self.tid
+
+    def kill(self, tid):
+        self.killed.append(tid)
+
+    def close(self):
+        pass
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.executed = []
+        # raised by the next executes, None for a success
+        self.errors = []
+        self.thread_ids = 0
+        self.connections = []
+
+    def connect(self, **kwargs):
+        self.connections.append(FakeDB(self, **kwargs))
+        return self.connections[-1]
+
+
+def operational_error(code, message, delay=0):
+    error = db_api.MySQLdb.OperationalError(code, message)
+    error.delay = delay
+    return error
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self._connect = db_api.MySQLdb.connect
+        db_api.MySQLdb.connect = self.server.connect
+        self.db = db_api.Connection(host="127.0.0.1:3306", user="test", max_retry=2)
+
+    def tearDown(self):
+        db_api.MySQLdb.connect = self._connect
+
+    def last_query(self):
+        return self.server.executed[-1][0]
+
+    def test_select_gets_max_execution_time(self):
+        with self.db.deadline(2):
+            self.db.query("SELECT * FROM a WHERE id = %s", None, 1)
+            match = re.match(r"SELECT /\*\+ MAX_EXECUTION_TIME\((\d+)\) \*/ \* FROM a WHERE id = %s$",
+                             self.last_query())
+            self.assertTrue(match, self.last_query())
+            self.assertTrue(1900 <= int(match.group(1)) <= 2000, match.group(1))
+            self.db.query("  select 1")
+            self.assertTrue(self.last_query().startswith("  select /*+ MAX_EXECUTION_TIME("))
+            # the caller's own hint is kept
+            self.db.query("SELECT /*+ MAX_EXECUTION_TIME(10) */ 1")
+            self.assertEqual(self.last_query(), "SELECT /*+ MAX_EXECUTION_TIME(10) */ 1")
+        query, read_timeout, write_timeout = self.server.executed[0]
+        # the time left plus the grace for the server to report the abort
+        self.assertTrue(2 < read_timeout <= 2 + db_api.DEADLINE_SOCKET_GRACE, read_timeout)
+        self.assertEqual(read_timeout, write_timeout)
+
+    def test_other_statements_are_not_rewritten(self):
+        with self.db.deadline(2):
+            self.db.execute("UPDATE a SET b = 1")
+            self.db.insertmany("INSERT INTO a VALUES (%s)", [(1, ), (2, )])
+            self.db.query("SHOW PROCESSLIST")
+            self.db.query("SELECTED")
+        self.db.query("SELECT 1")
+        self.assertEqual([query for query, read_timeout, write_timeout in self.server.executed],
+                         ["UPDATE a SET b = 1", "INSERT INTO a VALUES (%s)", "SHOW PROCESSLIST", "SELECTED",
+                          "SELECT 1"])
+        # but they get the socket timeouts
+        self.assertTrue(all(read_timeout <= 2 + db_api.DEADLINE_SOCKET_GRACE
+                            for query, read_timeout, write_timeout in self.server.executed[:4]))
+        self.assertEqual(self.server.executed[-1][1:], (15, 10))
+
+    def test_server_abort_is_a_query_timeout(self):
+        self.server.errors = [operational_error(db_api.ER_QUERY_TIMEOUT, "maximum statement execution time exceeded")]
+        with self.db.deadline(2):
+            self.assertRaises(QueryTimeoutError, self.db.query, "SELECT SLEEP(3)")
+        # not retried, nothing killed
+        self.assertEqual(len(self.server.executed), 1)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_socket_timeout_after_the_deadline(self):
+        self.server.errors = [operational_error(2013, "Lost connection to MySQL server during query", delay=0.3)]
+        with self.db.deadline(0.2):
+            try:
+                self.db.execute("UPDATE a SET b = SLEEP(3)")
+            except QueryTimeoutError, e:
+                self.assertEqual(e.args[0], db_api.ER_QUERY_TIMEOUT)
+            else:
+                self.fail("no QueryTimeoutError")
+        self.assertEqual(len(self.server.executed), 1)
+        # reconnected and killed the query left running on the server
+        first, second = self.server.connections
+        self.assertEqual(second.killed, [first.tid])
+
+    def test_lost_connection_within_the_deadline_is_retried(self):
+        self.server.errors = [operational_error(2006, "MySQL server has gone away")]
+        with self.db.deadline(2):
+            self.assertEqual(self.db.query("SELECT 1"), [{"a": 1}])
+        self.assertTrue(len(self.server.executed) > 1)
+        self.assertTrue(all("MAX_EXECUTION_TIME" in query for query, read_timeout, write_timeout
+                            in self.server.executed))
+
+    def test_deadline_passed_before_the_query(self):
+        with self.db.deadline(0.01):
+            time.sleep(0.02)
+            self.assertRaises(QueryTimeoutError, self.db.query, "SELECT 1")
+        self.assertEqual(self.server.executed, [])
+
+    def test_socket_timeouts_restored(self):
+        with self.db.deadline(5):
+            with self.db.deadline(1):
+                self.db.query("SELECT 1")
+            # the outer deadline still applies
+            self.assertTrue(self.db._db._read_timeout <= 1 + db_api.DEADLINE_SOCKET_GRACE)
+            self.db.query("SELECT 1")
+            self.assertTrue(self.db._db._read_timeout > 1 + db_api.DEADLINE_SOCKET_GRACE)
+        self.assertEqual((self.db._db._read_timeout, self.db._db._write_timeout), (15, 10))
+
+        try:
+            with self.db.deadline(1):
+                self.db.query("SELECT 1")
+                raise ValueError("failed in the block")
+        except ValueError:
+            pass
+        self.assertEqual((self.db._db._read_timeout, self.db._db._write_timeout), (15, 10))
+        self.assertEqual(self.db._deadline, None)
+        self.db.query("SELECT 1")
+        self.assertEqual(self.last_query(), "SELECT 1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import docopt
+from docopt import DocoptExit, DocoptParser
+
+DOC = """Usage:
+  agent.py run <task>... [--timeout=<seconds>] [-v...]
+  agent.py status [<task>] [options]
+  agent.py (-h | --help)
+
+Options:
+  -h, --help           Show this screen.
+  -v                   More output.
+  --timeout=<seconds>  Give up after this long [default: 30].
+  --json               Print the status as json.
+"""
+
+ARGVS = [
+    ['run', 'backup'],
+    ['run', 'backup', 'purge', '--timeout', '60', '-vv'],
+    ['status'],
+    ['status', 'backup', '--json'],
+]
+
+
+class ParserCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        docopt._parsers.clear()
+
+    def test_same_results_as_a_new_parser(self):
+        for argv in ARGVS * 2:
+            self.assertEqual(docopt.docopt(DOC, argv), DocoptParser(DOC).parse(argv))
+        self.assertEqual(docopt.docopt(DOC, ['run', 'a', '-v'])['-v'], 1)
+        self.assertEqual(docopt.docopt(DOC, ['status', '--json'])['--json'], True)
+        self.assertEqual(docopt.docopt(DOC, ['status'])['--timeout'], '30')
+
+    def test_get_parser_memoizes(self):
+        parser = docopt.get_parser(DOC)
+        self.assertTrue(docopt.get_parser(DOC) is parser)
+        self.assertEqual(len(docopt._parsers), 1)
+
+    def test_cache_is_bounded(self):
+        for i in range(docopt.PARSER_CACHE_SIZE + 1):
+            docopt.get_parser(DOC.replace("agent.py", "agent%d.py" % i))
+        self.assertEqual(len(docopt._parsers), 1)
+
+    def test_mutating_results_is_safe(self):
+        # <task> is repeated in the usage, so an empty list when not given
+        docopt.docopt(DOC, ['status'])['<task>'].append('changed')
+        rs = docopt.docopt(DOC, ['run', 'a', 'b'])
+        rs['<task>'].append('c')
+        self.assertEqual(docopt.docopt(DOC, ['run', 'a', 'b'])['<task>'], ['a', 'b'])
+        self.assertEqual(docopt.docopt(DOC, ['status'])['<task>'], [])
+
+    def test_errors(self):
+        self.assertRaises(DocoptExit, docopt.docopt, DOC, ['kill'])
+        self.assertRaises(DocoptExit, docopt.docopt, DOC, ['run'])
+        # a failed match leaves the cached parser usable
+        self.assertEqual(docopt.docopt(DOC, ['run', 'a'])['<task>'], ['a'])
+        self.assertRaises(SystemExit, docopt.docopt, DOC, ['--help'])
+
+
+if __name__ == "__main__":
+    unittest.main()
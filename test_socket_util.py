@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import socket_util
+from socket_util import CIDRTable
+
+
+class CIDRTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = CIDRTable(["10.0.0.0/8", ("10.1.0.0/16", "inner"), "2001:db8::/32"])
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.table.match("10.1.2.3"), "inner")
+        self.assertEqual(self.table.match("10.2.0.0"), "10.0.0.0/8")
+        self.assertEqual(self.table.match("11.0.0.0"), None)
+        self.assertEqual(self.table.match("2001:db8::5"), "2001:db8::/32")
+        self.assertEqual(self.table.match("::ffff:10.1.0.1"), "inner")
+        self.assertTrue("10.9.9.9" in self.table)
+
+    def test_bad_prefix(self):
+        self.assertRaises(ValueError, CIDRTable, ["10.0.0.0/33"])
+
+    def test_match_array(self):
+        ips = ["10.1.2.3", "10.2.0.0", "1.1.1.1", "2001:db8::5"]
+        expected = [1, 0, -1, 2]
+        self.assertEqual(list(self.table.match_array(ips)), expected)
+        self.assertEqual(list(self.table.match_array(iter(ips))), expected)
+        self.assertEqual(list(self.table.match_array(ip for ip in ips[:3])), expected[:3])
+
+    @unittest.skipIf(socket_util.numpy is None, "needs numpy")
+    def test_match_uint32_array(self):
+        ips = socket_util.ipv4_array(["10.1.2.3", "10.2.0.0", "1.1.1.1"])
+        self.assertEqual(list(self.table.match_array(ips)), [1, 0, -1])
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_is_internet_ip(self):
+        self.assertEqual(socket_util.is_internet_ip("10.168.1.1"), "is an a_class ip")
+        self.assertEqual(socket_util.is_internet_ip("172.31.1.1"), "is a b_class ip")
+        self.assertEqual(socket_util.is_internet_ip("172.32.1.1"), "true")
+        self.assertEqual(socket_util.is_internet_ip("192.168.1.1"), "is a c_class ip")
+        self.assertEqual(socket_util.is_internet_ip("127.31.1.1"), "is a loopback ip")
+        self.assertEqual(socket_util.is_internet_ip("fd00::1"), "is a unique_local ip")
+        self.assertEqual(socket_util.is_internet_ip("8.8.8.8"), "true")
+
+    def test_classify_generator(self):
+        ips = ["8.8.8.8", "10.1.2.3", "fe80::1", "::1"]
+        expected = [None, "a_class", "link_local", "loopback"]
+        self.assertEqual(socket_util.classify_ips(ips), expected)
+        self.assertEqual(socket_util.classify_ips(ip for ip in ips), expected)
+        self.assertEqual(list(socket_util.are_internet_ips(ip for ip in ips)),
+                         [True, False, False, False])
+
+
+class InterfacesTest(unittest.TestCase):
+
+    def test_loopback(self):
+        interfaces = dict((each.name, each) for each in socket_util.get_interfaces(refresh=True))
+        self.assertTrue("127.0.0.1" in interfaces["lo"].ipv4)
+        self.assertEqual(socket_util.get_ifnames()[1], [each.name for each in socket_util.get_interfaces()])
+        self.assertEqual(socket_util.get_ip_address("lo"), "127.0.0.1")
+
+
+if __name__ == "__main__":
+    unittest.main()
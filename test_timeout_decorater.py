@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import unittest
+
+from timeout_decorater import TimeoutException, timeout_process, timeout_signal, timeout_thread
+
+
+@timeout_process(2)
+def process_call(action, value=None):
+    if action == "sleep":
+        time.sleep(value)
+    elif action == "raise":
+        raise ValueError(value)
+    elif action == "pid":
+        return os.getpid()
+    return value
+
+
+@timeout_thread(0.5)
+def thread_call(action, value=None):
+    if action == "sleep":
+        time.sleep(value)
+    elif action == "raise":
+        raise ValueError(value)
+    elif action == "thread":
+        return threading.current_thread()
+    return value
+
+
+@timeout_signal(1)
+def signal_call(action, value=None):
+    if action == "sleep":
+        time.sleep(value)
+    elif action == "raise":
+        raise ValueError(value)
+    return value
+
+
+class TimeoutProcessTest(unittest.TestCase):
+
+    def test_result_and_reuse(self):
+        self.assertEqual(process_call("return", {"a": [1]}), {"a": [1]})
+        self.assertEqual(process_call("pid"), process_call("pid"))
+        self.assertNotEqual(process_call("pid"), os.getpid())
+
+    def test_exception(self):
+        try:
+            process_call("raise", "bad")
+        except ValueError, e:
+            self.assertEqual(str(e), "bad")
+            self.assertTrue("process_call" in e.remote_traceback)
+        else:
+            self.fail("no ValueError")
+
+    def test_timeout_replaces_the_worker(self):
+        pid = process_call("pid")
+        start = time.time()
+        self.assertRaises(TimeoutException, process_call, "sleep", 10)
+        self.assertTrue(time.time() - start < 4)
+        self.assertNotEqual(process_call("pid"), pid)
+
+    def test_decorated_after_the_workers_started(self):
+        process_call("return")
+
+        @timeout_process(2)
+        def nested(x):
+            return x * 2
+        self.assertEqual(nested(21), 42)
+        self.assertEqual(process_call("return", 1), 1)
+
+    def test_unpicklable_arguments_dont_leak_workers(self):
+        process_call("return")
+        children = len(multiprocessing.active_children())
+        for i in range(3):
+            self.assertRaises(Exception, process_call, "return", threading.Lock())
+        self.assertTrue(len(multiprocessing.active_children()) <= children)
+        self.assertEqual(process_call("return", 1), 1)
+
+
+class TimeoutThreadTest(unittest.TestCase):
+
+    def test_result_and_reuse(self):
+        self.assertEqual(thread_call("return", 1), 1)
+        self.assertEqual(thread_call("thread"), thread_call("thread"))
+        self.assertTrue(thread_call("thread") is not threading.current_thread())
+
+    def test_exception(self):
+        self.assertRaises(ValueError, thread_call, "raise", "bad")
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(TimeoutException, thread_call, "sleep", 2)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(thread_call("return", 1), 1)
+
+
+class TimeoutSignalTest(unittest.TestCase):
+
+    def test_result_and_exception(self):
+        self.assertEqual(signal_call("return", 1), 1)
+        self.assertRaises(ValueError, signal_call, "raise", "bad")
+
+    def test_timeout_and_handler_restored(self):
+        handler = lambda signum, frame: None
+        old = signal.signal(signal.SIGALRM, handler)
+        try:
+            start = time.time()
+            self.assertRaises(TimeoutException, signal_call, "sleep", 3)
+            self.assertTrue(time.time() - start < 2.5)
+            self.assertTrue(signal.getsignal(signal.SIGALRM) is handler)
+            self.assertEqual(signal.alarm(0), 0)
+        finally:
+            signal.signal(signal.SIGALRM, old)
+
+
+if __name__ == "__main__":
+    unittest.main()
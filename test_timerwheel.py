@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+import timerwheel
+from timerwheel import TimerWheel
+
+
+class FakeClock(object):
+    '''timerwheel._clock replacement only moved by advance'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, wheel, seconds):
+        self.now += seconds
+        # wake the wheel thread up, it waits on the real clock
+        with wheel._cond:
+            wheel._cond.notify()
+        # and let it walk to the new time
+        now = int((self.now - wheel._start) / wheel.tick)
+        for i in range(500):
+            if wheel._current > now:
+                break
+            time.sleep(0.01)
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.005)
+        self.fired = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def record(self, name, last=False):
+        self.fired.append(name)
+        if last:
+            self.done.set()
+
+    def test_call_later_order(self):
+        start = time.time()
+        # beyond the 256 ticks of the first wheel, so cascaded down
+        self.wheel.call_later(1.5, self.record, "c", last=True)
+        self.wheel.call_later(0.2, self.record, "b")
+        self.wheel.call_later(0.01, self.record, "a")
+        self.assertEqual(len(self.wheel), 3)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, ["a", "b", "c"])
+        self.assertTrue(time.time() - start >= 1.5)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(0.1, self.record, "cancelled")
+        self.wheel.call_later(0.2, self.record, "kept", last=True)
+        self.assertTrue(timer.active)
+        self.assertTrue(timer.cancel())
+        self.assertFalse(timer.cancel())
+        self.assertFalse(timer.active)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, ["kept"])
+
+    def test_call_every(self):
+        def tick():
+            self.record("tick", last=len(self.fired) == 4)
+        timer = self.wheel.call_every(0.05, tick)
+        self.assertTrue(self.done.wait(5))
+        self.assertTrue(timer.cancel())
+        time.sleep(0.15)
+        self.assertEqual(self.fired, ["tick"] * 5)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_failing_callback_and_executor(self):
+        runs = []
+        wheel = TimerWheel(tick=0.005, executor=lambda func: runs.append(func) or func())
+        try:
+            wheel.call_later(0.01, lambda: 1 // 0)
+            wheel.call_later(0.02, self.record, "after", last=True)
+            self.assertTrue(self.done.wait(5))
+            self.assertEqual(len(runs), 2)
+        finally:
+            wheel.stop()
+
+    def test_sleeps_until_the_next_timer(self):
+        advances = []
+        advance = self.wheel._advance
+        self.wheel._advance = lambda now: advances.append(now) or advance(now)
+        start = time.time()
+        self.wheel.call_later(3, self.record, "far")
+        # earlier than what the thread sleeps for, wakes it up
+        self.wheel.call_later(0.2, self.record, "near", last=True)
+        self.assertTrue(self.done.wait(5))
+        self.assertTrue(time.time() - start < 0.5)
+        time.sleep(0.3)
+        self.assertEqual(self.fired, ["near"])
+        # not one per 5ms tick
+        self.assertTrue(len(advances) < 10, len(advances))
+
+    def test_stop(self):
+        self.wheel.call_later(0.05, self.record, "dropped")
+        self.wheel.stop()
+        time.sleep(0.1)
+        self.assertEqual(self.fired, [])
+        self.assertRaises(RuntimeError, self.wheel.call_later, 0.01, self.record, "late")
+
+
+class FarTimerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.real_clock, timerwheel._clock = timerwheel._clock, self.clock
+        # every tick up to now is walked through, keep them few
+        self.wheel = TimerWheel(tick=1)
+
+    def tearDown(self):
+        self.wheel.stop()
+        timerwheel._clock = self.real_clock
+
+    def test_cascade(self):
+        fired = []
+        first, done = threading.Event(), threading.Event()
+        # on the third wheel, moved down twice before firing
+        self.wheel.call_later(2 * 86400, lambda: fired.append("2 days") or first.set())
+        self.wheel.call_later(2 * 86400 + 300, lambda: fired.append("later") or done.set())
+        self.clock.advance(self.wheel, 2 * 86400 - 1)
+        self.assertEqual(fired, [])
+        self.clock.advance(self.wheel, 1)
+        self.assertTrue(first.wait(5))
+        self.assertEqual(fired, ["2 days"])
+        self.clock.advance(self.wheel, 300)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(fired, ["2 days", "later"])
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from timing import TimingRegistry
+
+
+class TimingRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = TimingRegistry(window=100)
+
+    def test_record_and_percentiles(self):
+        for ms in range(1, 201):
+            self.registry.record("query", ms / 1000.0)
+        stats = self.registry.stats("query")
+        self.assertEqual(stats["count"], 200)
+        self.assertAlmostEqual(stats["mean"], 0.1005)
+        self.assertEqual((stats["min"], stats["max"]), (0.001, 0.2))
+        # the percentiles only see the last `window` durations
+        self.assertEqual((stats["p50"], stats["p90"], stats["p99"]), (0.151, 0.19, 0.199))
+        # the clock was set back
+        self.registry.record("query", -1)
+        self.assertEqual(self.registry.stats("query")["min"], 0.0)
+        self.assertEqual(self.registry.stats("unknown"), None)
+
+    def test_timed_and_timer(self):
+        @self.registry.timed
+        def parse(line):
+            return line.split()
+
+        @self.registry.timed("custom")
+        def fail():
+            raise ValueError()
+        self.assertEqual(parse("a b"), ["a", "b"])
+        self.assertRaises(ValueError, fail)
+        with self.registry.timer("block"):
+            pass
+        self.assertEqual(sorted(stats["name"] for stats in self.registry.stats()),
+                         ["block", "custom", "test_timing.parse"])
+        self.assertEqual(parse.__name__, "parse")
+        self.assertTrue("test_timing.parse" in self.registry.report())
+
+    def test_disable(self):
+        self.registry.disable()
+
+        @self.registry.timed
+        def work():
+            return 1
+        self.assertEqual(work(), 1)
+        with self.registry.timer("block"):
+            pass
+        self.assertEqual(self.registry.stats(), [])
+        self.registry.enable()
+        work()
+        self.assertEqual(self.registry.stats("test_timing.work")["count"], 1)
+        self.registry.reset()
+        self.assertEqual(self.registry.stats(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import util
+
+
+class RunCommandTest(unittest.TestCase):
+
+    def test_output_and_returncode(self):
+        lines = []
+        rs = util.run_command("echo out1; echo err1 >&2; printf out2; exit 3",
+                              on_stdout=lines.append, on_stderr=lines.append)
+        self.assertEqual(rs.returncode, 3)
+        self.assertEqual(rs.stdout, "out1\nout2")
+        self.assertEqual(rs.stderr, "err1\n")
+        self.assertEqual(sorted(lines), ["err1", "out1", "out2"])
+        self.assertFalse(rs.timed_out)
+
+    def test_max_output(self):
+        rs = util.run_command("yes | head -c 300000", max_output=1000)
+        self.assertEqual(len(rs.stdout), 1000)
+        self.assertTrue(rs.truncated)
+
+    def test_timeout(self):
+        start = time.time()
+        rs = util.run_command("echo started; sleep 10", timeout=0.3)
+        self.assertTrue(rs.timed_out)
+        self.assertEqual(rs.stdout, "started\n")
+        self.assertTrue(time.time() - start < 3)
+
+    def test_timeout_while_writing(self):
+        lines = []
+        start = time.time()
+        rs = util.run_command("yes", timeout=0.5, on_stdout=lines.append, max_output=100)
+        self.assertTrue(rs.timed_out)
+        self.assertTrue(lines)
+        self.assertTrue(time.time() - start < 3)
+
+    def test_sigterm_ignored(self):
+        start = time.time()
+        rs = util.run_command("trap '' TERM; sleep 5", timeout=0.2, kill_grace=0.2)
+        self.assertTrue(rs.timed_out)
+        self.assertTrue(time.time() - start < 3)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+
+    def test_retries_failed_results(self):
+        results = [None, False, 0, "done"]
+
+        @util.retry(count=5, interval=1, backoff=2, max_interval=3, sleep=self.sleeps.append)
+        def flaky():
+            return results.pop(0)
+        # 0 is a success for the default retry_if, only False/None are failures
+        self.assertEqual(flaky(), 0)
+        self.assertEqual(self.sleeps, [1, 2])
+        self.assertEqual(flaky.retry_stats["attempts"], 3)
+        self.assertEqual(flaky.retry_stats["retries"], 2)
+        self.assertEqual(flaky.retry_stats["gave_up"], 0)
+
+    def test_gives_up_after_count(self):
+        @util.retry(count=4, interval=1, backoff=2, max_interval=3, sleep=self.sleeps.append)
+        def always_fails():
+            return False
+        self.assertEqual(always_fails(), False)
+        self.assertEqual(self.sleeps, [1, 2, 3])
+        stats = util.get_retry_stats()[always_fails]
+        self.assertEqual((stats["calls"], stats["attempts"], stats["gave_up"]), (1, 4, 1))
+
+    def test_stats_per_function(self):
+        # same name, different functions
+        def make(result):
+            @util.retry(count=2, interval=0, sleep=self.sleeps.append)
+            def check():
+                return result
+            return check
+        ok, failing = make(True), make(False)
+        ok()
+        failing()
+        failing()
+        stats = util.get_retry_stats()
+        self.assertEqual((stats[ok]["calls"], stats[ok]["attempts"]), (1, 1))
+        self.assertEqual((stats[failing]["calls"], stats[failing]["attempts"]), (2, 4))
+        self.assertEqual(stats[ok], ok.retry_stats)
+        # a wrapper gone is forgotten
+        del ok, stats
+        self.assertEqual(len([wrapper for wrapper in util.get_retry_stats() if wrapper.__name__ == "check"]), 1)
+
+    def test_retry_on(self):
+        calls = []
+
+        @util.retry(count=3, interval=0, retry_on=IOError, sleep=self.sleeps.append)
+        def raises(exc_class):
+            calls.append(exc_class)
+            raise exc_class("failed %d" % len(calls))
+        self.assertRaises(IOError, raises, IOError)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(raises.retry_stats["errors"], 3)
+        self.assertEqual(raises.retry_stats["last_error"], "IOError('failed 3',)")
+        # other exceptions are not retried
+        self.assertRaises(KeyError, raises, KeyError)
+        self.assertEqual(len(calls), 4)
+
+    def test_retry_if_and_jitter(self):
+        results = [1, 2, 3]
+
+        @util.retry(count=3, interval=10, jitter=0.5, retry_if=lambda rs: rs < 3,
+                    sleep=self.sleeps.append)
+        def count_up():
+            return results.pop(0)
+        self.assertEqual(count_up(), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(all(5 <= wait <= 15 for wait in self.sleeps))
+
+    def test_deadline(self):
+        @util.retry(count=100, interval=0.1, deadline=0.25)
+        def always_fails():
+            return None
+        start = time.time()
+        self.assertEqual(always_fails(), None)
+        self.assertTrue(time.time() - start <= 0.25)
+        self.assertEqual(always_fails.retry_stats["attempts"], 3)
+
+
+class FindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.now = time.time()
+        # {relative path: (size, age in seconds)}
+        self.files = {"ibdata1": (100, 0), "db1/a.ibd": (2048, 30 * 60), "db1/b.ibd": (0, 2 * 86400 + 60),
+                      "db1/part/c.ibd": (5 * 1024 ** 2, 90 * 60), "db2/D.IBD": (512, 10),
+                      "db2/d.frm": (10, 10), "mysql/user.ibd": (10, 10), "test_1/t.ibd": (10, 10)}
+        for path, (size, age) in self.files.items():
+            full_path = self.path(path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, "wb") as fp:
+                fp.truncate(size)
+            os.utime(full_path, (self.now - age, self.now - age))
+        # not followed, like find
+        os.symlink(self.path("db1"), self.path("db3"))
+        os.symlink(self.path("db1/a.ibd"), self.path("db2/link.ibd"))
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def path(self, relative):
+        return os.path.join(self.top, relative)
+
+    def scan(self, *args, **kwargs):
+        return sorted(os.path.relpath(entry.path, self.top) for entry in util.scan_files(self.top, *args, **kwargs))
+
+    def test_scan_files(self):
+        self.assertEqual(self.scan("*.ibd"), ["db1/a.ibd", "db1/b.ibd", "db1/part/c.ibd"])
+        self.assertEqual(self.scan(), ["db1/a.ibd", "db1/b.ibd", "db1/part/c.ibd", "db2/D.IBD", "db2/d.frm",
+                                       "ibdata1"])
+        self.assertEqual(self.scan("*.ibd", exclude_schemas=()),
+                         ["db1/a.ibd", "db1/b.ibd", "db1/part/c.ibd", "mysql/user.ibd", "test_1/t.ibd"])
+        self.assertEqual(self.scan(parallel=3), self.scan())
+        entry = [each for each in util.scan_files(self.top, "a.ibd")][0]
+        self.assertEqual((entry.size, int(entry.mtime)), (2048, int(self.now - 30 * 60)))
+
+    def test_scan_empty_or_missing_directory(self):
+        empty = self.path("empty")
+        os.mkdir(empty)
+        self.assertEqual(list(util.scan_files(empty)), [])
+        self.assertEqual(list(util.scan_files(self.path("missing"))), [])
+
+    def matches(self, strategy):
+        test = util.parse_find_strategy(strategy)
+        return sorted(path for path, (size, age) in self.files.items()
+                      if test(util.FileEntry(self.path(path), size, self.now - age), self.now))
+
+    def test_name_and_type(self):
+        self.assertEqual(self.matches("-name *.ibd -type f"),
+                         ["db1/a.ibd", "db1/b.ibd", "db1/part/c.ibd", "mysql/user.ibd", "test_1/t.ibd"])
+        self.assertEqual(self.matches("-iname '*.IBD' -name D*"), ["db2/D.IBD"])
+
+    def test_mmin_and_mtime(self):
+        self.assertEqual(self.matches("-mmin -31 -name *.ibd"), ["db1/a.ibd", "mysql/user.ibd", "test_1/t.ibd"])
+        self.assertEqual(self.matches("-mmin +31"), ["db1/b.ibd", "db1/part/c.ibd"])
+        # n means more than n-1 and at most n minutes
+        self.assertEqual(self.matches("-mmin 30"), ["db1/a.ibd"])
+        self.assertEqual(self.matches("-mmin 90"), ["db1/part/c.ibd"])
+        # whole days, fractions dropped
+        self.assertEqual(self.matches("-mtime 2"), ["db1/b.ibd"])
+        self.assertEqual(self.matches("-mtime +1"), ["db1/b.ibd"])
+        self.assertEqual(len(self.matches("-mtime -1")), len(self.files) - 1)
+
+    def test_size(self):
+        # rounded up to the unit, so -1G is only the empty files
+        self.assertEqual(self.matches("-size -1G"), ["db1/b.ibd"])
+        self.assertEqual(self.matches("-size +1k"), ["db1/a.ibd", "db1/part/c.ibd"])
+        self.assertEqual(self.matches("-size 5M"), ["db1/part/c.ibd"])
+        self.assertEqual(self.matches("-size 2048c"), ["db1/a.ibd"])
+        # 512 bytes blocks by default
+        self.assertEqual(self.matches("-size 1 -name *.IBD"), ["db2/D.IBD"])
+
+    def test_bad_strategies(self):
+        for strategy in ("-type d", "-mmin", "-newer x", "-size +1T"):
+            self.assertRaises(ValueError, util.parse_find_strategy, strategy)
+
+    def test_get_proper_file(self):
+        strategies = ["-mmin -60 -size +1M", "-mmin -60 -size -2M", "-mmin -120 -size -10M"]
+        # the last strategy matching any file wins
+        self.assertEqual(sorted(util.get_proper_file(self.top, strategies, '"*.ibd"').split("\n")),
+                         [self.path("db1/a.ibd"), self.path("db1/part/c.ibd")])
+        self.assertEqual(util.get_proper_file(self.top, strategies[:2], "*.ibd"), self.path("db1/a.ibd"))
+        self.assertEqual(util.get_proper_file(self.top, ["-mmin -1"], "*.ibd"), None)
+        os.mkdir(self.path("empty"))
+        self.assertEqual(util.get_proper_file(self.path("empty"), strategies, "*.ibd"), None)
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def test_map_runs_concurrently(self):
+        runner = util.CommandRunner(concurrency=4, timeout=5)
+        try:
+            start = time.time()
+            results = runner.map(["sleep 0.3; echo %d" % i for i in range(4)])
+            self.assertTrue(time.time() - start < 1.0)
+            self.assertEqual([rs.stdout for rs in results], ["0\n", "1\n", "2\n", "3\n"])
+        finally:
+            runner.close()
+
+    def test_start_failure(self):
+        runner = util.CommandRunner(concurrency=1)
+        try:
+            self.assertRaises(OSError, runner.submit(["/nonexistent"]).result, 5)
+        finally:
+            runner.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,135 @@
 #!/usr/local/sinasrv2/bin/python2.7
 # -*- coding: utf-8 -*-
 
-#####################################################################
-# option 1
-# pros: common used
-# cons: if the func need to return something, you should use a queue
-#       to communicate with other process
-#####################################################################
-import multiprocessing
 import functools
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+import traceback
+import Queue
+
+import timerwheel
+
 class TimeoutException(Exception):
     pass
 
+#####################################################################
+# option 1
+# pros: the func really stops on timeout, even when it's stuck in C code
+# cons: 1: func, its arguments and result must be picklable
+#       2: a worker process only knows the @timeout_process functions
+#          decorated before it was forked, it is replaced by a new one
+#          when it would have to call a later one
+# the worker processes are reused, a call costs a round trip over a
+# pipe instead of forking a process
+#####################################################################
+
+# {number: func} of the functions decorated with timeout_process, numbered
+# in the order they were decorated; the forked workers look them up here
+# when the func can't be pickled because its name refers to the wrapper
+_PROCESS_FUNCS = {}
+_PROCESS_FUNCS_LOCK = threading.Lock()
+
+def _process_target(func, key):
+    '''what to send to the worker to call func: itself if it's picklable, its key if not'''
+    if getattr(sys.modules.get(func.__module__), func.__name__, None) is func:
+        return func
+    return key
+
+def _process_main(conn):
+    '''loop of a worker process: run the calls sent over `conn`, send back
+        (True, result, None) or (False, exception, formatted traceback)
+    '''
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            break
+        if call is None:
+            break
+        target, args, kwargs = call
+        try:
+            if isinstance(target, int):
+                target = _PROCESS_FUNCS[target]
+            reply = (True, target(*args, **kwargs), None)
+        except Exception, e:
+            reply = (False, e, traceback.format_exc())
+        try:
+            conn.send(reply)
+        except Exception, e:
+            # unpicklable result or exception
+            conn.send((False, RuntimeError("can't send back %r: %s" % (reply[1], e)), None))
+
+class _ProcessWorker(object):
+
+    def __init__(self):
+        # the functions numbered below this one are known to the process
+        self.known = len(_PROCESS_FUNCS)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_process_main, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def call(self, target, args, kwargs, seconds):
+        self.conn.send((target, args, kwargs))
+        if not self.conn.poll(seconds):
+            raise TimeoutException("timeout")
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+class _ProcessWorkers(object):
+    '''worker processes for timeout_process, one per concurrent call'''
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def call(self, target, args, kwargs, seconds):
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is not None and isinstance(target, int) and target >= worker.known:
+            # forked before func was decorated
+            worker.kill()
+            worker = None
+        if worker is None:
+            worker = _ProcessWorker()
+        reusable = False
+        try:
+            try:
+                ok, value, formatted = worker.call(target, args, kwargs, seconds)
+            except (EOFError, IOError), e:
+                raise RuntimeError("worker process died: %s" % e)
+            reusable = True
+        finally:
+            if reusable:
+                with self._lock:
+                    self._idle.append(worker)
+            else:
+                # timed out (stuck, the only way to stop it), died, or the
+                # call couldn't be sent: don't leave the process behind
+                worker.kill()
+        if not ok:
+            if formatted:
+                value.remote_traceback = formatted
+            raise value
+        return value
+
+_process_workers = _ProcessWorkers()
+
 def timeout_process(seconds):
   def decorated(func):
+    with _PROCESS_FUNCS_LOCK:
+      key = len(_PROCESS_FUNCS)
+      _PROCESS_FUNCS[key] = func
     def wrapper(*args, **kwargs):
-      prs = multiprocessing.Process(target=func, args=args, kwargs=kwargs)
-      prs.start()
-      prs.join(seconds)
-      if prs.is_alive():
-        prs.terminate()
-        raise TimeoutException("timeout")
+      return _process_workers.call(_process_target(func, key), args, kwargs, seconds)
     return functools.wraps(func)(wrapper)
   return decorated
 
@@ -29,33 +138,150 @@ def timeout_process(seconds):
 # pros: looks simple
 # cons: 1: func must not be uninteruptable
 #       2: must catch the exception or the caller thread/process will die
-#       3: There is no return when func is timeout
+#       3: only one alarm per process, only works on the main thread
 #####################################################################
-import sys
-import signal, functools
 
 def timeout_signal(seconds, error_message="Exception: <{0} seconds timeout>"):
     def decorated(func):
         def _handle_timeout(signum, frame):
             raise TimeoutException(error_message.format(seconds))
         def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
+            old_handler = signal.signal(signal.SIGALRM, _handle_timeout)
             signal.alarm(seconds)
             try:
                 # func must not be uninteruptable
-                result = func(*args, **kwargs)
+                return func(*args, **kwargs)
             finally:
                 signal.alarm(0)
-                return result
+                signal.signal(signal.SIGALRM, old_handler)
+        return functools.wraps(func)(wrapper)
+    return decorated
+
+#####################################################################
+# option 3
+# pros: 1: cheap, the call runs on a reused thread
+#       2: works on any thread, any number of timeouts at a time
+# cons: a timed out func can't be stopped, it keeps running (and holds
+#       its thread) until it returns, its result is dropped
+# the timeout is set by a timerwheel timer: a blocking wait with a
+# timeout polls with sleeps in python 2, an untimed one doesn't
+#####################################################################
+
+class _Call(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.timed_out = False
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def expire(self):
+        if not self.done.is_set():
+            self.timed_out = True
+            self.done.set()
+
+class _ThreadWorkers(object):
+    '''daemon threads running the calls of timeout_thread; a new thread is
+        started when all are busy, at most `max_idle` wait for more work
+    '''
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self._calls = Queue.Queue()
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, call):
+        with self._lock:
+            if self._idle:
+                # reserve the idle thread for this call
+                self._idle -= 1
+                start = False
+            else:
+                start = True
+        self._calls.put(call)
+        if start:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            self._calls.get().run()
+            with self._lock:
+                if self._idle >= self.max_idle:
+                    return
+                self._idle += 1
+
+_thread_workers = _ThreadWorkers()
+
+def timeout_thread(seconds):
+    def decorated(func):
+        def wrapper(*args, **kwargs):
+            call = _Call(func, args, kwargs)
+            timer = timerwheel.call_later(seconds, call.expire)
+            _thread_workers.submit(call)
+            call.done.wait()
+            timer.cancel()
+            if call.timed_out:
+                raise TimeoutException("timeout")
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
         return functools.wraps(func)(wrapper)
     return decorated
 
 @timeout_process(3)
 def slowfunc(sleep_time):
     a = 1
-    import time
     time.sleep(sleep_time)
     return a
 
+def _timeout_process_per_call(seconds):
+    '''what timeout_process used to do: fork a process per call, no result'''
+    def decorated(func):
+        def wrapper(*args, **kwargs):
+            prs = multiprocessing.Process(target=func, args=args, kwargs=kwargs)
+            prs.start()
+            prs.join(seconds)
+            if prs.is_alive():
+                prs.terminate()
+                raise TimeoutException("timeout")
+        return functools.wraps(func)(wrapper)
+    return decorated
+
+def _noop(x):
+    return x
+
+def benchmark(calls=2000):
+    '''per call overhead of each option, calling a function doing nothing'''
+    options = [("timeout_signal", timeout_signal(5), calls),
+               ("timeout_thread", timeout_thread(5), calls),
+               ("timeout_process", timeout_process(5), calls),
+               ("process per call", _timeout_process_per_call(5), max(calls / 20, 1))]
+    print "%-18s %8s %12s" % ("option", "calls", "us/call")
+    for name, decorator, count in options:
+        func = decorator(_noop)
+        func(0)
+        start = time.time()
+        for i in xrange(count):
+            func(i)
+        print "%-18s %8d %12.1f" % (name, count, (time.time() - start) / count * 1e6)
+
 if __name__ == "__main__":
-    print slowfunc(11)
+    print slowfunc(1)
+    try:
+        slowfunc(11)
+    except TimeoutException:
+        print "slowfunc(11) timed out"
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
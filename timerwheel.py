@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Hierarchical timer wheel: lots of timers and periodic tasks on one thread,
+without signals.
+
+Time is cut into ticks (10ms by default). The first wheel has a slot per
+tick for the next 256 ticks, each further wheel has 64 slots covering 64
+slots of the wheel below it, so 4 wheels reach 2^26 ticks (~7.7 days at
+10ms); later timers are parked at the end and re-placed when they get
+closer. Adding and cancelling a timer is a set operation on its slot; the
+timers of a far slot are moved down one wheel when the time reaches it.
+
+Typical usage::
+
+    wheel = TimerWheel()
+    heartbeat = wheel.call_every(1, update_heartbeat, conn)
+    timer = wheel.call_later(30, kill_query, conn, query_id)
+    ...
+    timer.cancel()
+
+Callbacks run on the wheel's thread, so they should be quick; pass an
+`executor` (e.g. ThreadPool.submit) to run them elsewhere. Timers never
+fire early, but up to a tick late (later if a callback blocks the thread).
+'''
+
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# time.time() may jump, use a monotonic clock where there is one
+_clock = getattr(time, 'monotonic', time.time)
+
+# bits of the slot index per wheel, the first wheel is the finest
+WHEEL_BITS = (8, 6, 6, 6)
+# ticks covered by all the wheels
+MAX_TICKS = 1 << sum(WHEEL_BITS)
+
+
+class Timer(object):
+    '''A pending call of a TimerWheel, see TimerWheel.call_later'''
+
+    __slots__ = ('wheel', 'expires', 'interval', 'func', 'args', 'kwargs', 'slot', 'cancelled')
+
+    def __init__(self, wheel, expires, interval, func, args, kwargs):
+        self.wheel = wheel
+        # tick at which the timer fires
+        self.expires = expires
+        # ticks between two calls of a periodic timer, None for one-shot ones
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # set of the wheel slot holding the timer, None when not scheduled
+        self.slot = None
+        self.cancelled = False
+
+    @property
+    def active(self):
+        '''True until the timer fired (for one-shot timers) or is cancelled'''
+        return self.slot is not None
+
+    def cancel(self):
+        '''Returns True if the timer was still pending'''
+        return self.wheel._cancel(self)
+
+    def __repr__(self):
+        return "<Timer %s at tick %s%s>" % (getattr(self.func, '__name__', self.func), self.expires,
+                                           " every %s ticks" % self.interval if self.interval else "")
+
+
+class TimerWheel(object):
+
+    def __init__(self, tick=0.01, executor=None, name="timerwheel"):
+        '''
+            params:
+                tick: resolution in seconds
+                executor: called with a function to run the callbacks of the due
+                          timers, by default they run on the wheel's thread
+        '''
+        self.tick = tick
+        self.executor = executor
+        self._shifts = [sum(WHEEL_BITS[:i]) for i in range(len(WHEEL_BITS))]
+        self._wheels = [[set() for i in range(1 << bits)] for bits in WHEEL_BITS]
+        self._start = _clock()
+        # next tick to process
+        self._current = 0
+        self._count = 0
+        # tick the thread sleeps until, None when it isn't waiting for one
+        self._wakeup = None
+        self._stopped = False
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        '''number of pending timers'''
+        return self._count
+
+    def _ticks(self, seconds):
+        # round up, timers must not fire early
+        ticks = int(seconds / self.tick)
+        return ticks + 1 if ticks * self.tick < seconds else ticks
+
+    def _place(self, timer):
+        '''put a timer into the slot matching its distance from now'''
+        delta = timer.expires - self._current
+        if delta < 0:
+            delta = 0
+        expires = self._current + min(delta, MAX_TICKS - 1)
+        for level, shift in enumerate(self._shifts):
+            if delta < 1 << (shift + WHEEL_BITS[level]):
+                break
+        slot = self._wheels[level][(expires >> shift) & ((1 << WHEEL_BITS[level]) - 1)]
+        slot.add(timer)
+        timer.slot = slot
+
+    def _schedule(self, delay, interval, func, args, kwargs):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("timer wheel is stopped")
+            now = self._ticks(_clock() - self._start)
+            if not self._count:
+                # nothing pending, nothing to process until now
+                self._current = max(self._current, now)
+            timer = Timer(self, max(now + self._ticks(delay), self._current), interval, func, args, kwargs)
+            self._place(timer)
+            self._count += 1
+            if self._count == 1 or self._wakeup is not None and timer.expires < self._wakeup:
+                self._cond.notify()
+        return timer
+
+    def call_later(self, delay, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) in `delay` seconds
+            returns:
+                Timer, to cancel it
+        '''
+        return self._schedule(delay, None, func, args, kwargs)
+
+    def call_at(self, when, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) at `when`, a time.time() timestamp'''
+        return self._schedule(max(when - time.time(), 0), None, func, args, kwargs)
+
+    def call_every(self, interval, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) every `interval` seconds, the first time in
+            `interval` seconds. Calls are scheduled from the previous due time, so
+            they don't drift; if the wheel falls behind, missed calls are skipped.
+            returns:
+                Timer, cancel it to stop
+        '''
+        ticks = max(self._ticks(interval), 1)
+        return self._schedule(interval, ticks, func, args, kwargs)
+
+    def _cancel(self, timer):
+        with self._cond:
+            if timer.slot is None:
+                return False
+            timer.cancelled = True
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+            return True
+
+    def _cascade(self):
+        '''move the timers of the slots the current tick enters down one wheel'''
+        for level in range(1, len(WHEEL_BITS)):
+            shift = self._shifts[level]
+            if self._current & ((1 << shift) - 1):
+                break
+            slot = self._wheels[level][(self._current >> shift) & ((1 << WHEEL_BITS[level]) - 1)]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+
+    def _advance(self, now):
+        '''process the ticks up to `now`, returns the due timers'''
+        due = []
+        while self._current <= now:
+            self._cascade()
+            slot = self._wheels[0][self._current & ((1 << WHEEL_BITS[0]) - 1)]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    if timer.expires > self._current:
+                        # parked beyond the last wheel, not due yet
+                        self._place(timer)
+                        continue
+                    timer.slot = None
+                    self._count -= 1
+                    if timer.interval:
+                        timer.expires += timer.interval
+                        if timer.expires <= now:
+                            # fell behind, skip the missed calls
+                            timer.expires += (now - timer.expires) // timer.interval * timer.interval + timer.interval
+                        self._place(timer)
+                        self._count += 1
+                    due.append(timer)
+            self._current += 1
+        return due
+
+    def _next_busy_tick(self):
+        '''first tick from the current one which has due timers or moves timers
+            down a wheel, the thread has nothing to do before it
+        '''
+        current = self._current
+        # a slot of the first wheel only holds timers of its next turn
+        mask = (1 << WHEEL_BITS[0]) - 1
+        busy = current + mask + 1
+        for tick in range(current, current + mask + 1):
+            if self._wheels[0][tick & mask]:
+                busy = tick
+                break
+        for level in range(1, len(WHEEL_BITS)):
+            shift, mask = self._shifts[level], (1 << WHEEL_BITS[level]) - 1
+            # the ticks cascading this wheel, from the first one not processed yet
+            tick = -(-current >> shift) << shift
+            for i in range(mask + 1):
+                if tick >= busy:
+                    break
+                if self._wheels[level][(tick >> shift) & mask]:
+                    busy = tick
+                    break
+                tick += 1 << shift
+        return busy
+
+    def _fire(self, timer):
+        try:
+            timer.func(*timer.args, **timer.kwargs)
+        except Exception:
+            LOGGER.exception("timer %r failed" % timer)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._count:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                due = self._advance(int((_clock() - self._start) / self.tick))
+                if not due:
+                    # sleep until there is something to do instead of a tick at a time,
+                    # _schedule wakes the thread up for an earlier timer
+                    self._wakeup = self._next_busy_tick()
+                    self._cond.wait(max(self._start + self._wakeup * self.tick - _clock(), 0))
+                    self._wakeup = None
+                    continue
+            for timer in due:
+                if timer.cancelled:
+                    # a periodic timer cancelled since it was taken out
+                    continue
+                if self.executor is not None:
+                    self.executor(lambda timer=timer: self._fire(timer))
+                else:
+                    self._fire(timer)
+
+    def stop(self):
+        '''Stop the wheel thread, the pending timers are dropped'''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+
+_default_wheel = None
+_default_lock = threading.Lock()
+
+
+def default_wheel():
+    '''The process wide TimerWheel, created on first use'''
+    global _default_wheel
+    with _default_lock:
+        if _default_wheel is None:
+            _default_wheel = TimerWheel()
+    return _default_wheel
+
+
+def call_later(delay, func, *args, **kwargs):
+    '''TimerWheel.call_later on the default wheel'''
+    return default_wheel().call_later(delay, func, *args, **kwargs)
+
+
+def call_every(interval, func, *args, **kwargs):
+    '''TimerWheel.call_every on the default wheel'''
+    return default_wheel().call_every(interval, func, *args, **kwargs)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Timing registry: wall time of functions and code blocks, aggregated per name.
+
+Typical usage::
+
+    @timing.timed
+    def parse(line):
+        ...
+
+    with timing.timer("load config"):
+        ...
+
+    print timing.report()       # or timing.report_at_exit() once at startup
+
+Every name keeps a count, total, min and max plus the last `window`
+durations, from which report() computes percentiles. Recording takes no
+lock, concurrent threads may rarely lose an update of the same name; the
+registry lock is only taken the first time a name is seen.
+
+disable() turns all of it into a flag check: timed functions are called
+directly and timer() returns a shared no-op context manager.
+
+The clock is time.perf_counter where there is one (python 3). Python 2 has
+no monotonic clock short of ctypes, whose call costs ~2us against ~0.1us for
+time.time(), so time.time() is used there and a negative duration (the
+clock was set back) is recorded as 0.
+'''
+
+import atexit
+import functools
+import sys
+import threading
+import time
+from collections import deque
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# durations kept per name for the percentiles
+DEFAULT_WINDOW = 1024
+PERCENTILES = (50, 90, 99)
+
+
+def _percentile(ordered, percent):
+    '''nearest rank percentile of a sorted list'''
+    if not ordered:
+        return 0.0
+    rank = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class TimingStats(object):
+    '''Durations recorded under one name, see TimingRegistry.record'''
+
+    __slots__ = ('name', 'count', 'total', 'min', 'max', 'samples')
+
+    def __init__(self, name, window=DEFAULT_WINDOW):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+
+    def snapshot(self):
+        '''returns: dict of count, total, mean, min, max and the p<n> of PERCENTILES, in seconds'''
+        ordered = sorted(self.samples)
+        result = {'name': self.name, 'count': self.count, 'total': self.total,
+                  'mean': self.total / self.count if self.count else 0.0,
+                  'min': self.min or 0.0, 'max': self.max}
+        for percent in PERCENTILES:
+            result['p%d' % percent] = _percentile(ordered, percent)
+        return result
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.record(self.name, _clock() - self.start)
+        return False
+
+
+class TimingRegistry(object):
+
+    def __init__(self, window=DEFAULT_WINDOW, enabled=True):
+        '''
+            params:
+                window: durations kept per name for the percentiles
+                enabled: record from the start, see enable/disable
+        '''
+        self.window = window
+        self.enabled = enabled
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._at_exit = False
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _get(self, name):
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.get(name)
+                if stats is None:
+                    stats = self._stats[name] = TimingStats(name, self.window)
+        return stats
+
+    def record(self, name, seconds):
+        '''Add a duration to `name`, even when disabled'''
+        if seconds < 0:
+            seconds = 0.0
+        self._get(name).add(seconds)
+
+    def timer(self, name):
+        '''Context manager recording the time spent in its block under `name`'''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name=None):
+        '''Decorator recording the time spent in the function, under `name` or
+            "module.function". Works as @timed and as @timed("name").
+        '''
+        if callable(name):
+            return self.timed()(name)
+
+        def decorated(func):
+            key = name or "%s.%s" % (func.__module__, func.__name__)
+
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = _clock()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(key, _clock() - start)
+            return functools.wraps(func)(wrapper)
+        return decorated
+
+    def stats(self, name=None):
+        '''returns: TimingStats.snapshot of `name`, of all names sorted by total time if None'''
+        if name is not None:
+            stats = self._stats.get(name)
+            return stats.snapshot() if stats is not None else None
+        return sorted((stats.snapshot() for stats in list(self._stats.values())),
+                      key=lambda snapshot: snapshot['total'], reverse=True)
+
+    def reset(self):
+        '''Forget everything recorded so far'''
+        with self._lock:
+            self._stats = {}
+
+    def report(self):
+        '''returns: a table of the stats of all names, times in milliseconds'''
+        columns = ['count', 'total', 'mean', 'min'] + ['p%d' % percent for percent in PERCENTILES] + ['max']
+        lines = ["%-40s" % "name" + "".join("%12s" % column for column in columns)]
+        for snapshot in self.stats():
+            line = "%-40s%12d" % (snapshot['name'], snapshot['count'])
+            line += "".join("%12.3f" % (snapshot[column] * 1000) for column in columns[1:])
+            lines.append(line)
+        return "\n".join(lines)
+
+    def report_at_exit(self, stream=None):
+        '''Write the report to `stream` (stderr by default) when the process exits,
+            registered once however often it is called
+        '''
+        if self._at_exit:
+            return
+        self._at_exit = True
+
+        def dump():
+            if self._stats:
+                (stream or sys.stderr).write(self.report() + "\n")
+        atexit.register(dump)
+
+
+# the process wide registry behind the module level functions
+registry = TimingRegistry()
+
+enable = registry.enable
+disable = registry.disable
+record = registry.record
+timer = registry.timer
+timed = registry.timed
+stats = registry.stats
+reset = registry.reset
+report = registry.report
+report_at_exit = registry.report_at_exit
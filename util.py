@@ -1,25 +1,271 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
 import time
 import traceback
 
 import commands
 import signal
 import functools
+import fnmatch
+import logging
+import os
+import random
+import select
+import stat
+import subprocess
+import threading
+import weakref
+import Queue
+from collections import deque, namedtuple
 
-def exec_shell_local(shell_cmd):
+import timerwheel
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport of os.scandir for python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
+def exec_shell_local(shell_cmd, timeout=None):
     '''exec shell command, returns results as shell does
+        params:
+            timeout: seconds, then the command's process group is killed (see run_command)
         Returns
             (-1,e) when exception, (status, output) when executed
     '''
     try:
-        status, output = commands.getstatusoutput(shell_cmd)
+        if timeout is None:
+            status, output = commands.getstatusoutput(shell_cmd)
+        else:
+            rs = run_command(shell_cmd, timeout=timeout, merge_stderr=True)
+            # same encoding as os.wait, like getstatusoutput
+            status = rs.returncode << 8 if rs.returncode >= 0 else -rs.returncode
+            output = rs.stdout[:-1] if rs.stdout.endswith('\n') else rs.stdout
     except Exception, e:
         logger.error(e)
         return (-1, e)
     return (status, output)
 
+CommandResult = namedtuple('CommandResult', ['cmd', 'returncode', 'stdout', 'stderr', 'elapsed',
+                                             'timed_out', 'truncated'])
+
+# bytes of stdout/stderr kept per command by default
+MAX_OUTPUT = 1 << 20
+
+class _OutputCapture(object):
+    '''keeps the last `limit` bytes of a stream and hands each complete line to `callback`'''
+    def __init__(self, limit, callback=None):
+        self.limit = limit
+        self.callback = callback
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+        self._partial = ''
+
+    def feed(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.limit:
+            drop = self._size - self.limit
+            head = self._chunks[0]
+            if len(head) <= drop:
+                self._chunks.popleft()
+                self._size -= len(head)
+            else:
+                self._chunks[0] = head[drop:]
+                self._size -= drop
+            self.truncated = True
+        if self.callback is not None:
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            if len(self._partial) > self.limit:
+                # no newline in sight, don't buffer it forever
+                lines.append(self._partial)
+                self._partial = ''
+            for line in lines:
+                self._emit(line)
+
+    def _emit(self, line):
+        try:
+            self.callback(line)
+        except Exception:
+            logger.error("output callback failed: %s" % traceback.format_exc())
+
+    def close(self):
+        if self.callback is not None and self._partial:
+            self._emit(self._partial)
+            self._partial = ''
+
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+def _killpg(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        # all gone already
+        pass
+
+def run_command(cmd, timeout=None, on_stdout=None, on_stderr=None, max_output=MAX_OUTPUT,
+                merge_stderr=False, kill_grace=2):
+    '''Run a command in its own process group, streaming its output
+
+        params:
+            cmd: shell command string, or argument list run without a shell
+            timeout: seconds, then the whole process group gets SIGTERM and,
+                     `kill_grace` seconds later, SIGKILL
+            on_stdout/on_stderr: called with each output line (without the newline)
+                                 as soon as it is read
+            max_output: only the last max_output bytes of stdout and of stderr are kept
+            merge_stderr: send stderr to stdout, like 2>&1
+        Returns
+            CommandResult, returncode is -N when killed by signal N
+    '''
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=isinstance(cmd, basestring), close_fds=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+                            preexec_fn=os.setsid)
+    stdout = _OutputCapture(max_output, on_stdout)
+    stderr = _OutputCapture(max_output, on_stderr)
+    captures = {proc.stdout.fileno(): stdout}
+    if not merge_stderr:
+        captures[proc.stderr.fileno()] = stderr
+    # poll(), unlike select(), copes with fds above FD_SETSIZE
+    poller = select.poll()
+    for fd in captures:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    deadline = start + timeout if timeout is not None else None
+    # signals sent so far on timeout: SIGTERM, then SIGKILL
+    kills = [signal.SIGTERM, signal.SIGKILL]
+    timed_out = False
+    try:
+        while captures:
+            # checked on every round, a command writing all the time never lets poll() time out
+            if deadline is not None and time.time() >= deadline:
+                if not kills:
+                    # a child left the process group and holds the pipes, stop waiting for it
+                    break
+                timed_out = True
+                _killpg(proc, kills.pop(0))
+                deadline = time.time() + kill_grace
+            wait = None if deadline is None else max(deadline - time.time(), 0) * 1000
+            events = poller.poll(wait)
+            for fd, event in events:
+                data = os.read(fd, 65536)
+                if data:
+                    captures[fd].feed(data)
+                else:
+                    poller.unregister(fd)
+                    captures.pop(fd).close()
+    finally:
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe:
+                pipe.close()
+        if timed_out:
+            _killpg(proc, signal.SIGKILL)
+        returncode = proc.wait()
+    return CommandResult(cmd, returncode, stdout.getvalue(), stderr.getvalue(), time.time() - start,
+                         timed_out, stdout.truncated or stderr.truncated)
+
+class CommandJob(object):
+    '''a command queued on a CommandRunner'''
+    def __init__(self, cmd, kwargs, callback):
+        self.cmd = cmd
+        self.kwargs = kwargs
+        self.callback = callback
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''wait for the command to finish
+            Returns
+                CommandResult, raises the error if the command couldn't be started
+        '''
+        if not self._done.wait(timeout) and not self._done.is_set():
+            raise RuntimeError("command still running: %s" % self.cmd)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _run(self):
+        try:
+            self._result = run_command(self.cmd, **self.kwargs)
+        except Exception, e:
+            logger.error("run %s failed: %s" % (self.cmd, e))
+            self._error = e
+        self._done.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                logger.error("callback of %s failed: %s" % (self.cmd, traceback.format_exc()))
+
+class CommandRunner(object):
+    '''Run shell commands concurrently, at most `concurrency` at a time
+
+        runner = CommandRunner(concurrency=16, timeout=600)
+        jobs = [runner.submit("du -sh %s" % path) for path in paths]
+        for job in jobs:
+            print job.result().stdout
+
+        Keyword arguments are the defaults for run_command of every command.
+        Callbacks are called on the runner's threads.
+    '''
+    def __init__(self, concurrency=8, **defaults):
+        self.defaults = defaults
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in range(concurrency):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            job._run()
+
+    def submit(self, cmd, callback=None, **kwargs):
+        '''queue a command
+            params:
+                callback: called with the CommandJob when the command finished
+                kwargs: run_command arguments, override the runner's defaults
+            Returns
+                CommandJob
+        '''
+        options = dict(self.defaults)
+        options.update(kwargs)
+        job = CommandJob(cmd, options, callback)
+        self._jobs.put(job)
+        return job
+
+    def map(self, cmds, **kwargs):
+        '''run all the commands, returns their CommandResult in the same order'''
+        return [job.result() for job in [self.submit(cmd, **kwargs) for cmd in cmds]]
+
+    def close(self, wait=True):
+        '''stop the threads once the queued commands are done'''
+        for thread in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
 class op_signal(object):
     '''python 程序里处理外部信号的简单例子，主要针对 unix 系统
        **WARNING**
@@ -36,53 +282,301 @@ class op_signal(object):
         for sig, handler in sig_and_handler_map.iteritems():
             signal.signal(sig, handler)
     @staticmethod
-    def tick(interval=5):
-        '''like time clock, one tick per 5s
+    def tick(interval=5, func=None):
+        '''like time clock, one tick per `interval` seconds
+           runs on the timerwheel thread instead of SIGALRM, so it works from any
+           thread and leaves the process' only alarm alone
+           returns the periodic timer, cancel() it to stop
         '''
-        def signal_handler(signum, frame):
-            print 'Received signal: %d'%signum
-        while True:
-            signal.signal(signal.SIGALRM, signal_handler)
-            signal.alarm(5)
-            while True:
-               print('waiting')
-               time.sleep(1)
+        def print_tick():
+            print 'tick'
+        return timerwheel.call_every(interval, func or print_tick)
          
-def retry(count=5, interval=1):
+# {retry wrapper: its stats dict}, see retry; weak so wrappers of nested
+# functions don't pile up, keyed by the wrapper as names aren't unique
+_RETRY_STATS = weakref.WeakKeyDictionary()
+_RETRY_STATS_LOCK = threading.Lock()
+
+def _failed_result(rs):
+    return rs is False or rs is None
+
+def get_retry_stats():
+    '''Returns
+            {wrapper: {"calls", "attempts", "retries", "gave_up", "errors", "last_error"}}
+            copied from the live functions decorated with retry, wrapper.__module__
+            and wrapper.__name__ tell which function it is
+    '''
+    with _RETRY_STATS_LOCK:
+        return dict((wrapper, dict(stats)) for wrapper, stats in _RETRY_STATS.items())
+
+def retry(count=5, interval=1, backoff=1, max_interval=None, jitter=0, deadline=None,
+          retry_on=(), retry_if=_failed_result, sleep=time.sleep):
+    '''Call the function up to `count` times until it succeeds
+
+        params:
+            interval: seconds to sleep before the first retry
+            backoff: the sleep is multiplied by this after each retry, capped at max_interval
+            jitter: randomize each sleep by +-jitter (a fraction, 0.1 is +-10%)
+            deadline: total seconds for all the attempts, no retry is started
+                      when its sleep would end after it
+            retry_on: exception class(es) to retry on, others are raised at once;
+                      the last one is raised when giving up
+            retry_if: result predicate, by default False/None mean failure;
+                      the last result is returned when giving up
+            sleep: called with the seconds to wait between attempts
+        The statistics of every decorated function are kept in wrapper.retry_stats
+        and returned by get_retry_stats
+    '''
     def decorator(func):
+        stats = {"calls": 0, "attempts": 0, "retries": 0, "gave_up": 0, "errors": 0, "last_error": None}
+
+        def count_stat(key, value=1):
+            with _RETRY_STATS_LOCK:
+                stats[key] += value
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            count_stat("calls")
+            end_time = time.time() + deadline if deadline is not None else None
+            delay = interval
             for i in range(count):
-                rs = func(*args, **kwargs)
-                if rs is not False and rs is not None:
-                   return rs
-                else:
-                   time.sleep(interval)
+                count_stat("attempts")
+                try:
+                    rs = func(*args, **kwargs)
+                    error = None
+                except retry_on, e:
+                    error = sys.exc_info()
+                    count_stat("errors")
+                    with _RETRY_STATS_LOCK:
+                        stats["last_error"] = repr(e)
+                if error is None and not retry_if(rs):
+                    return rs
+                wait = delay * (1 + random.uniform(-jitter, jitter)) if jitter else delay
+                if i == count - 1 or (end_time is not None and time.time() + wait > end_time):
+                    break
+                count_stat("retries")
+                sleep(wait)
+                delay = delay * backoff
+                if max_interval is not None:
+                    delay = min(delay, max_interval)
+            count_stat("gave_up")
+            if error is not None:
+                raise error[0], error[1], error[2]
             return rs
+        wrapper.retry_stats = stats
+        with _RETRY_STATS_LOCK:
+            _RETRY_STATS[wrapper] = stats
         return wrapper
     return decorator
 
-def get_proper_file(dir, strategys, regx):
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'mtime'])
+
+# schema directories (first level under the datadir) get_proper_file skips
+EXCLUDED_SCHEMAS = ('test*', 'mysql', 'information_schema', 'performance_schema', 'sys', '*recycle_bin*')
+
+# find -size units, the default is 512 bytes blocks
+_SIZE_UNITS = {'b': 512, 'c': 1, 'w': 2, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def _find_number(arg):
+    '''split a find numeric argument: "-60" -> ('-', 60), "+1G" -> ('+', '1G')'''
+    if arg[:1] in ('-', '+'):
+        return arg[0], arg[1:]
+    return '', arg
+
+def _compare(sign, value, n):
+    if sign == '-':
+        return value < n
+    if sign == '+':
+        return value > n
+    return value == n
+
+def parse_find_strategy(strategy):
+    '''Turn find tests like "-mmin -60 -size +1G -size -3G" into a predicate,
+        following the rounding of GNU find:
+            -mmin n    age in minutes, n means (n-1, n] minutes
+            -mtime n   age in whole days, fractions are dropped
+            -size n[cwbkMG]  size rounded up to the unit, so "-size -1G" only matches empty files
+            -name/-iname pattern, -type f
+        Returns
+            func(entry, now) -> bool, entry being a FileEntry
+    '''
+    tokens = strategy.split()
+    tests = []
+    while tokens:
+        opt = tokens.pop(0)
+        if not tokens:
+            raise ValueError("find test %s needs an argument in %r" % (opt, strategy))
+        arg = tokens.pop(0).strip('"\'')
+        if opt == '-type':
+            if arg != 'f':
+                raise ValueError("only -type f is supported: %r" % strategy)
+        elif opt in ('-name', '-iname'):
+            if opt == '-iname':
+                tests.append(lambda entry, now, arg=arg.lower():
+                             fnmatch.fnmatchcase(os.path.basename(entry.path).lower(), arg))
+            else:
+                tests.append(lambda entry, now, arg=arg:
+                             fnmatch.fnmatchcase(os.path.basename(entry.path), arg))
+        elif opt == '-mmin':
+            sign, n = _find_number(arg)
+            n = float(n) * 60
+            if sign:
+                tests.append(lambda entry, now, sign=sign, n=n: _compare(sign, now - entry.mtime, n))
+            else:
+                tests.append(lambda entry, now, n=n: n - 60 < now - entry.mtime <= n)
+        elif opt == '-mtime':
+            sign, n = _find_number(arg)
+            tests.append(lambda entry, now, sign=sign, n=int(n):
+                         _compare(sign, int((now - entry.mtime) // 86400), n))
+        elif opt == '-size':
+            sign, n = _find_number(arg)
+            unit = _SIZE_UNITS.get(n[-1:])
+            if unit is None:
+                unit = 512
+            else:
+                n = n[:-1]
+            tests.append(lambda entry, now, sign=sign, n=int(n), unit=unit:
+                         _compare(sign, (entry.size + unit - 1) // unit, n))
+        else:
+            raise ValueError("unsupported find test %s in %r" % (opt, strategy))
+    return lambda entry, now: all(test(entry, now) for test in tests)
+
+def _scan_dir(path, pattern, subdirs):
+    '''yield FileEntry of the regular files in `path` matching `pattern`, append
+        the subdirectories to `subdirs`; symlinks are not followed, like find does
+    '''
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif fnmatch.fnmatchcase(entry.name, pattern) and entry.is_file(follow_symlinks=False):
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        # dropped meanwhile
+                        continue
+                    yield FileEntry(entry.path, st.st_size, st.st_mtime)
+        else:
+            for name in os.listdir(path):
+                full_path = os.path.join(path, name)
+                try:
+                    st = os.lstat(full_path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(full_path)
+                elif stat.S_ISREG(st.st_mode) and fnmatch.fnmatchcase(name, pattern):
+                    yield FileEntry(full_path, st.st_size, st.st_mtime)
+    except OSError, e:
+        logger.warning("skip %s: %s" % (path, e))
+
+def _walk_files(top, pattern):
+    dirs = [top]
+    while dirs:
+        for entry in _scan_dir(dirs.pop(), pattern, dirs):
+            yield entry
+
+def _walk_parallel(dirs, pattern, parallel, batch_size=256):
+    '''walk `dirs` with `parallel` threads, yielding their FileEntry as they come'''
+    todo = Queue.Queue()
+    for each in dirs:
+        todo.put(each)
+    # bounded, so the walkers don't run far ahead of a slow consumer
+    results = Queue.Queue(parallel * 4)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def walker():
+        try:
+            while not stop.is_set():
+                try:
+                    top = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                batch = []
+                for entry in _walk_files(top, pattern):
+                    batch.append(entry)
+                    if len(batch) >= batch_size:
+                        put(batch)
+                        batch = []
+                        if stop.is_set():
+                            return
+                if batch:
+                    put(batch)
+        finally:
+            put(None)
+
+    threads = [threading.Thread(target=walker) for i in range(min(parallel, len(dirs)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            batch = results.get()
+            if batch is None:
+                running -= 1
+                continue
+            for entry in batch:
+                yield entry
+    finally:
+        stop.set()
+
+def scan_files(top, pattern="*", exclude_schemas=EXCLUDED_SCHEMAS, parallel=1):
+    '''Walk `top` once, lazily yielding FileEntry(path, size, mtime) of the regular
+        files whose name matches the glob `pattern`, like find -type f -name does.
+        Uses os.scandir (or the scandir package), falls back to os.listdir + lstat.
+
+        params:
+            exclude_schemas: globs of the directories right under `top` to skip
+            parallel: threads walking the directories under `top` concurrently,
+                      the results come in no particular order then
+    '''
+    schema_dirs = []
+    for entry in _scan_dir(top, pattern, schema_dirs):
+        yield entry
+    schema_dirs = [path for path in schema_dirs
+                   if not any(fnmatch.fnmatchcase(os.path.basename(path), exclude)
+                              for exclude in exclude_schemas or ())]
+    if parallel > 1 and len(schema_dirs) > 1:
+        for entry in _walk_parallel(schema_dirs, pattern, parallel):
+            yield entry
+    else:
+        for schema_dir in schema_dirs:
+            for entry in _walk_files(schema_dir, pattern):
+                yield entry
+
+def get_proper_file(dir, strategys, regx, exclude_schemas=EXCLUDED_SCHEMAS, parallel=1):
     '''For example:
         dir = "/u01/my3306/data"
         strategys = ["-mmin -60 -size +1G -size -3G", "-mmin -60 -size -3G", "-mmin -300 -size -5G", "-mmin -4320 -size -5G"]
         regx = \"*.ibd\"
-    
+
+        The datadir is walked once (see scan_files) and every file is checked against all the
+        strategies, which are find tests (see parse_find_strategy).
+
         Returns:
-            files/None
+            files matched by the last strategy matching any, joined by "\\n"/None
     '''
-    files = None
-    cmd = ("find %s -type f -name %s %s | grep -v test "
-           "| grep -v mysql | grep -v information_schema | grep -v performance_schema "
-           "| grep -v sys | grep -v recycle_bin")
-    for i in range(len(strategys)):
-        time.sleep(1)
-        stra = strategys[i]
-        real_cmd = cmd%(dir, regx, stra)
-        status, output = exec_shell_local(real_cmd)
-        if status == 0 and output:
-            files = output
-    return files
+    tests = [parse_find_strategy(stra) for stra in strategys]
+    matched = [[] for stra in strategys]
+    now = time.time()
+    for entry in scan_files(dir, regx.strip('"\''), exclude_schemas, parallel):
+        for i, test in enumerate(tests):
+            if test(entry, now):
+                matched[i].append(entry.path)
+    for files in reversed(matched):
+        if files:
+            return "\n".join(files)
+    return None
 
 def get_slave_delay(port):
     ''' fetch slave delay, depends on heartbeat table but not SBM